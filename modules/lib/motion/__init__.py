@@ -3,6 +3,9 @@
 """ Class to manage motion detection with ESP32CAM """
 from motion.motion import *
 from motion.historic import *
+from motion.savequeue import *
+from motion.cliprecorder import *
+from motion.motionmask import *
 from video.video import Camera
 from tools import info
 
@@ -0,0 +1,206 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Record the motion events in a single clip file, with the images before and after the detection.
+The clip is the concatenation of jpeg images (playable as mjpeg), followed by an index of images :
+	- for each image : offset, length, milliseconds since the clip start (3 unsigned 32 bits little endian)
+	- the footer : b"CLIP", number of images, offset of index (unsigned 32 bits little endian) """
+import struct
+import uasyncio
+from motion.historic import Historic
+from motion.storagequota import StorageQuota
+from tools import logger,sdcard,strings,date,info
+
+CLIP_MAGIC = b"CLIP"
+CLIP_EXTENSION = ".mjpeg"
+MAX_PENDING_SIZE = 128*1024
+MIN_FREE_MEMORY = 64*1024
+
+class ClipRecorder:
+	""" Record the images of a motion event in one clip file, written sequentially by a writer task.
+	The clip replaces the images saved for each detection, it is added in the historic when it is closed """
+	def __init__(self, config):
+		""" Constructor """
+		self.config = config
+		self.recording = False
+		self.last_detection = 0
+		self.last_index = 0
+		self.pending = []
+		self.pending_size = 0
+		self.writer = None
+		self.event = None
+		self.file = None
+		self.path = ""
+		self.name = ""
+		self.informations = None
+		self.thumbnail = None
+		self.closed = None
+		self.index = []
+		self.start = 0
+		self.offset = 0
+		self.dropped = 0
+		self.busy = False
+
+	def is_recording(self):
+		""" Indicates if a clip is in recording """
+		return self.recording
+
+	def trigger(self, images):
+		""" Motion detected, start a clip with the images before the detection, or extend the clip in recording.
+		The images before the detection are limited to those kept in the ring (max_motion_images) """
+		self.last_detection = strings.ticks()
+		# The clip starts only with an image compared, its differences are indexed in the historic
+		if self.recording is False and len(images) > 0 and images[0].get_comparison() is not None:
+			self.recording = True
+			newest = images[0]
+			# Keep the images of the pre event duration, from the older to the newer
+			selected = []
+			for image in images:
+				if image.motion is not None and newest.ticks - image.ticks <= self.config.clip_pre_duration*1000 and image.index > self.last_index:
+					selected.insert(0, image)
+			if len(selected) > 0:
+				first = selected[0]
+				informations = newest.get_informations()
+				informations["image"] = "%s_clip%s"%(date.date_to_filename(first.time), CLIP_EXTENSION)
+				self.put(["open", strings.tostrings(first.get_path()), informations["image"], first.ticks, informations])
+				for image in selected:
+					self.add(image, image is newest)
+
+	def add(self, image, thumbnail=False):
+		""" Add the image captured in the clip, stop the clip after the post event duration """
+		if self.recording:
+			if strings.ticks() - self.last_detection > self.config.clip_post_duration*1000:
+				self.stop()
+			elif image.motion is not None and image.index > self.last_index:
+				self.last_index = image.index
+				# The image is not copied if the memory is low
+				free = info.mem_free()
+				if free is not None and free < MIN_FREE_MEMORY:
+					self.dropped += 1
+				else:
+					self.put(["image", image.get(), image.ticks, thumbnail])
+
+	def stop(self):
+		""" Stop the clip in recording """
+		if self.recording:
+			self.recording = False
+			self.put(["close"])
+
+	def drop_older(self):
+		""" Drop the older image waiting, the image of thumbnail is kept. Returns False if no image can be dropped """
+		for i in range(len(self.pending)):
+			if self.pending[i][0] == "image" and self.pending[i][3] is False:
+				self.pending_size -= len(self.pending[i][1])
+				del self.pending[i]
+				self.dropped += 1
+				return True
+		return False
+
+	def put(self, item):
+		""" Add an item to write, the older images are dropped if the writer is late to bound the memory used """
+		if self.event is None:
+			self.event = uasyncio.Event()
+		if self.writer is None:
+			self.writer = uasyncio.create_task(self.task())
+		if item[0] == "image":
+			while self.pending_size + len(item[1]) > MAX_PENDING_SIZE:
+				if self.drop_older() is False:
+					break
+			self.pending_size += len(item[1])
+		self.pending.append(item)
+		self.event.set()
+
+	def open(self, path, name, start, informations):
+		""" Create the clip file """
+		self.close()
+		self.index = []
+		self.offset = 0
+		self.start = start
+		self.path = path
+		self.name = name
+		self.informations = informations
+		self.thumbnail = None
+		root = Historic.get_root()
+		if root:
+			self.file = sdcard.SdCard.create_file(root + "/" + path, name, "wb")
+		if self.file is None:
+			logger.syslog("Cannot create clip %s/%s"%(path, name))
+
+	def write(self, image, image_ticks):
+		""" Write the image at the end of clip, with the milliseconds elapsed since the start of clip """
+		if self.file is not None:
+			self.file.write(image)
+			self.index.append((self.offset, len(image), image_ticks - self.start))
+			self.offset += len(image)
+
+	def close(self):
+		""" Write the index and close the clip, the clip closed must be added in the historic """
+		if self.file is not None:
+			try:
+				index = self.offset
+				for offset, length, duration in self.index:
+					self.file.write(struct.pack("<III", offset, length, duration))
+				self.file.write(CLIP_MAGIC + struct.pack("<II", len(self.index), index))
+				StorageQuota.add(self.path, self.offset + (len(self.index) + 1)*12)
+				self.closed = [self.path, self.name, self.informations, self.thumbnail]
+			finally:
+				self.file.close()
+				self.file = None
+
+	async def task(self):
+		""" Writer task of clips """
+		while True:
+			try:
+				if len(self.pending) == 0:
+					self.event.clear()
+					await self.event.wait()
+				else:
+					item = self.pending.pop(0)
+					self.busy = True
+					try:
+						if item[0] == "image":
+							self.pending_size -= len(item[1])
+							if item[3]:
+								# The thumbnail is encoded without the historic lock
+								self.thumbnail = Historic.create_thumbnail(item[1])
+								await uasyncio.sleep_ms(0)
+						await Historic.acquire_shared()
+						try:
+							if item[0] == "open":
+								self.open(item[1], item[2], item[3], item[4])
+							elif item[0] == "image":
+								self.write(item[1], item[2])
+							else:
+								self.close()
+						finally:
+							await Historic.release_shared()
+
+						# Add the clip closed in the historic
+						if self.closed is not None:
+							path, name, informations, thumbnail = self.closed
+							self.closed = None
+							await Historic.add_clip(path, name, informations, thumbnail)
+					finally:
+						self.busy = False
+					await uasyncio.sleep_ms(0)
+			except Exception as err:
+				logger.syslog(err)
+
+	async def flush(self):
+		""" Wait that all pending items are written """
+		while len(self.pending) > 0 or self.busy:
+			await uasyncio.sleep_ms(20)
+
+def read_index(filename):
+	""" Read the index of a clip file, returns the list of (offset, length, milliseconds) """
+	result = []
+	with open(filename, "rb") as file:
+		file.seek(-12, 2)
+		footer = file.read(12)
+		if footer[0:4] != CLIP_MAGIC:
+			raise ValueError("Not a clip file")
+		count, index = struct.unpack("<II", footer[4:])
+		file.seek(index)
+		for i in range(count):
+			result.append(struct.unpack("<III", file.read(12)))
+	return result
@@ -0,0 +1,62 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Run length encoding of the motion differences map stored in historic.
+The map is a string starting with "R", followed by the lengths in hexadecimal separated by commas of the runs of squares,
+alternatively without and with difference, beginning with the squares without difference. The last run without difference is omitted.
+Example : "R7b,2,11,2" """
+RLE_PREFIX = "R"
+
+class DiffMap:
+	""" Convert the differences map between the list of 32 bits words and the run length encoding """
+	@staticmethod
+	def get_squares(width, height, squarex, squarey):
+		""" Get the number of squares in differences map """
+		return (width // squarex) * (height // squarey)
+
+	@staticmethod
+	def is_encoded(diffs):
+		""" Indicates if the differences map is run length encoded """
+		return type(diffs) == type("") and diffs[:1] == RLE_PREFIX
+
+	@staticmethod
+	def encode(words, squares):
+		""" Encode the list of 32 bits words, the first square is the most significant bit of first word """
+		runs = []
+		current = 0
+		length = 0
+		for i in range(min(squares, len(words)*32)):
+			bit = (words[i >> 5] >> (31 - (i & 31))) & 1
+			if bit != current:
+				runs.append("%x"%length)
+				current = bit
+				length = 0
+			length += 1
+		if current == 1:
+			runs.append("%x"%length)
+		return RLE_PREFIX + ",".join(runs)
+
+	@staticmethod
+	def decode(diffs, squares):
+		""" Decode the run length encoding into a list of 32 bits words """
+		words = [0]*((squares + 31) // 32)
+		if len(diffs) > len(RLE_PREFIX):
+			position = 0
+			current = 0
+			for run in diffs[len(RLE_PREFIX):].split(","):
+				length = int(run, 16)
+				if current == 1:
+					for i in range(position, min(position + length, squares)):
+						words[i >> 5] |= 0x80000000 >> (i & 31)
+				position += length
+				current ^= 1
+		return words
+
+	@staticmethod
+	def from_legacy(diffs):
+		""" Convert the old format (one character by square, '#' for difference) into run length encoding """
+		words = [0]*((len(diffs) + 31) // 32)
+		for i in range(len(diffs)):
+			if diffs[i] == "#":
+				words[i >> 5] |= 0x80000000 >> (i & 31)
+		return DiffMap.encode(words, len(diffs))
@@ -4,23 +4,39 @@
 """ Manage the motion detection history file """
 import re
 import json
+import random
 import uasyncio
-from tools import logger,sdcard,tasking,filesystem,strings,info
+from motion.historicindex import HistoricIndex
+from motion.diffmap import DiffMap
+from motion.storagequota import StorageQuota
+from tools import logger,sdcard,tasking,filesystem,strings,info,rwlock
+if info.iscamera():
+	import camera
 
 MAX_DAYS_DISPLAYED = 28
 MAX_DAYS_REMOVED   = 14
 MAX_MOTIONS        = 400
+THUMBNAIL_SUFFIX   = ".thumb.jpg"
+THUMBNAIL_QUALITY  = 60
 
 class Historic:
 	""" Manage the motion detection history file """
 	motion_in_progress  = [False]
 	historic = []
 	first_extract = [False]
-	lock = uasyncio.Lock()
+	thumbnail_supported = [True]
+	quota_loaded = [False]
+	# Shared to read or add files, exclusive to remove or rewrite files
+	lock = rwlock.RwLock()
+	# Json of historic cached and its version, the version starts randomly to not reuse the etags of the previous boot
+	json_cache = [None]
+	version = [random.getrandbits(30)]
+	# Index of historic items per day, updated with each item added or removed, rebuilt when the historic is reloaded
+	days_index = [None]
 
 	@staticmethod
 	async def acquire():
-		""" Lock historic """
+		""" Lock historic exclusive, to remove or rewrite files """
 		await Historic.lock.acquire()
 
 	@staticmethod
@@ -28,11 +44,39 @@ class Historic:
 		""" Release historic """
 		Historic.lock.release()
 
+	@staticmethod
+	async def acquire_shared():
+		""" Lock historic shared, to read or add files """
+		await Historic.lock.acquire_read()
+
+	@staticmethod
+	async def release_shared():
+		""" Release historic shared """
+		Historic.lock.release_read()
+
+	@staticmethod
+	def get_lock_counters():
+		""" Get the counters of waiting time of historic lock """
+		return Historic.lock.get_counters()
+
 	@staticmethod
 	async def locked():
 		""" Indicates if historic is locked """
 		return Historic.lock.locked()
 
+	@staticmethod
+	def invalidate(days=True):
+		""" Indicates that the historic changed, the json cached must be rebuilt, and the index per day if it was not updated """
+		Historic.version[0] += 1
+		Historic.json_cache[0] = None
+		if days:
+			Historic.days_index[0] = None
+
+	@staticmethod
+	def get_etag():
+		""" Get the etag of the historic json """
+		return b'"%08x"'%Historic.version[0]
+
 	@staticmethod
 	def get_root():
 		""" Get the root path of sdcard and mount it """
@@ -41,34 +85,101 @@ class Historic:
 		return None
 
 	@staticmethod
-	async def add_motion(path, name, image, motion_info):
-		""" Add motion detection in the historic """
+	async def add_motion(path, name, image, motion_info, thumbnail=None):
+		""" Add motion detection in the historic, the thumbnail is created before by the caller to not hold the lock during its encoding """
 		root = Historic.get_root()
 		result = False
 		if root:
 			try:
-				await Historic.acquire()
+				await Historic.acquire_shared()
 				path = strings.tostrings(path)
 				name = strings.tostrings(name)
 				item = Historic.create_item(root + "/" + path + "/" + name +".json", motion_info)
+				content = json.dumps(item, separators=(',', ':'))
 				res1 = sdcard.SdCard.save(path, name + ".jpg" , image)
-				res2 = sdcard.SdCard.save(path, name + ".json", json.dumps(item, separators=(',', ':')))
+				thumbnail = Historic.save_thumbnail(path, name, thumbnail)
+				res2 = sdcard.SdCard.save(path, name + ".json", content)
+				StorageQuota.add(path, len(image) + len(content) + thumbnail, 3 if thumbnail else 2)
+				HistoricIndex.append(root, item)
 				Historic.add_item(item)
 				result = res1 and res2
 			except Exception as err:
 				logger.syslog(err)
 			finally:
-				await Historic.release()
+				await Historic.release_shared()
+		return result
+
+	@staticmethod
+	async def add_clip(path, filename, motion_info, thumbnail=None):
+		""" Add the clip of a motion event in the historic, the clip replaces the images of each detection """
+		root = Historic.get_root()
+		result = False
+		if root:
+			try:
+				await Historic.acquire_shared()
+				path = strings.tostrings(path)
+				filename = strings.tostrings(filename)
+				name, extension = filesystem.splitext(filename)
+				item = Historic.create_item(root + "/" + path + "/" + filename, motion_info, extension)
+				content = json.dumps(item, separators=(',', ':'))
+				thumbnail = Historic.save_thumbnail(path, name, thumbnail)
+				result = sdcard.SdCard.save(path, name + ".json", content)
+				StorageQuota.add(path, len(content) + thumbnail, 2 if thumbnail else 1)
+				HistoricIndex.append(root, item)
+				Historic.add_item(item)
+			except Exception as err:
+				logger.syslog(err)
+			finally:
+				await Historic.release_shared()
 		return result
 
 	@staticmethod
-	def create_item(filename, motion_info):
+	def create_thumbnail(image):
+		""" Create the thumbnail of image, reduced by the jpeg decoder, returns None if the thumbnail cannot be created """
+		if Historic.thumbnail_supported[0]:
+			try:
+				return camera.thumbnail(image, THUMBNAIL_QUALITY)
+			except (AttributeError, NotImplementedError):
+				# Firmware without thumbnail, or jpeg encoder not available
+				Historic.thumbnail_supported[0] = False
+				logger.syslog("Thumbnail not supported")
+			except (ValueError, OSError) as err:
+				# Image corrupted, the motion is saved without thumbnail
+				logger.syslog(err, display=False)
+			except Exception as err:
+				logger.syslog(err)
+		return None
+
+	@staticmethod
+	def save_thumbnail(path, name, thumbnail):
+		""" Save the thumbnail, returns the size of thumbnail saved """
+		if thumbnail is not None:
+			try:
+				if sdcard.SdCard.save(path, name + THUMBNAIL_SUFFIX, thumbnail):
+					return len(thumbnail)
+			except Exception as err:
+				logger.syslog(err)
+		return 0
+
+	@staticmethod
+	def get_thumbnail(filename):
+		""" Get the thumbnail filename of image, or the image filename if the thumbnail not existing """
+		thumbnail = filesystem.splitext(strings.tostrings(filename))[0] + THUMBNAIL_SUFFIX
+		if filesystem.exists(thumbnail):
+			return thumbnail
+		return filename
+
+	@staticmethod
+	def create_item(filename, motion_info, extension=".jpg"):
 		""" Create historic item """
-		name = filesystem.splitext(filename)[0] + ".jpg"
+		name = filesystem.splitext(filename)[0] + extension
 		result = None
 		if "geometry" in motion_info:
-			# Add json file to the historic
-			result = [name, motion_info["geometry"]["width"],motion_info["geometry"]["height"], motion_info["diff"]["diffs"], motion_info["diff"]["squarex"], motion_info["diff"]["squarey"]]
+			# Add json file to the historic, with the differences run length encoded
+			width, height = motion_info["geometry"]["width"],motion_info["geometry"]["height"]
+			squarex, squarey = motion_info["diff"]["squarex"], motion_info["diff"]["squarey"]
+			diffs = DiffMap.encode(motion_info["diff"]["diffs"], DiffMap.get_squares(width, height, squarex, squarey))
+			result = [name, width, height, diffs, squarex, squarey]
 		return result
 
 	@staticmethod
@@ -81,26 +192,15 @@ class Historic:
 
 			# If the differences are in an old format
 			if type(item[3]) == type(""):
-				diffs = []
-				diff_val = 0
-				i = 0
-				for diff in item[3]:
-					if diff == "#":
-						diff_val |= 1
-
-					if (i %32 == 31):
-						diffs.append(diff_val)
-						diff_val = 0
-					else:
-						diff_val <<= 1
-					i += 1
-				diff_max = len(item[3])
-				diff_val <<= (31 - (diff_max%32))
-				diffs.append(diff_val)
-				item[3] = diffs
+				if DiffMap.is_encoded(item[3]) is False:
+					item[3] = DiffMap.from_legacy(item[3])
+			else:
+				item[3] = DiffMap.encode(item[3], DiffMap.get_squares(item[1], item[2], item[4], item[5]))
 
 			# Add json file to the historic
 			Historic.historic.insert(0,item)
+			Historic.add_day_item(item)
+			Historic.invalidate(days=False)
 
 	@staticmethod
 	async def build(motions):
@@ -108,8 +208,10 @@ class Historic:
 		root = Historic.get_root()
 		if root:
 			try:
-				await Historic.acquire()
+				# Shared lock, the motions added during the build are kept
+				await Historic.acquire_shared()
 				Historic.historic.clear()
+				Historic.invalidate()
 				last_day = ""
 				# For all motions
 				for motion in motions:
@@ -140,25 +242,68 @@ class Historic:
 						await uasyncio.sleep_ms(2)
 			except Exception as err:
 				logger.syslog(err)
+			finally:
+				await Historic.release_shared()
+
+	@staticmethod
+	async def load_index():
+		""" Load the historic from the index file, returns False if the index is not available """
+		root = Historic.get_root()
+		result = False
+		if root:
+			try:
+				await Historic.acquire_shared()
+				previous = Historic.historic[:]
+				Historic.historic.clear()
+				items = await HistoricIndex.load(root, MAX_MOTIONS)
+				if items is None:
+					Historic.historic[0:0] = previous
+				else:
+					# Keep the motions added during the loading, without duplicating those already in index
+					names = set([item[0].lstrip("/") for item in Historic.historic])
+					Historic.invalidate()
+					for item in items:
+						if item[0].lstrip("/") not in names:
+							Historic.add_item(item)
+					result = True
+			except Exception as err:
+				logger.syslog(err)
+			finally:
+				await Historic.release_shared()
+		return result
+
+	@staticmethod
+	async def build_index():
+		""" Create the index file with the historic built """
+		root = Historic.get_root()
+		if root:
+			try:
+				await Historic.acquire()
+				HistoricIndex.rebuild(root, Historic.historic)
+			except Exception as err:
+				logger.syslog(err)
 			finally:
 				await Historic.release()
 
 	@staticmethod
 	async def get_json():
-		""" Read the historic from disk """
+		""" Read the historic from disk, the json is cached until the historic changes """
 		root = Historic.get_root()
 		result = b"[]"
 		if root:
 			await Historic.reduce_history()
+			if Historic.json_cache[0] is not None:
+				return Historic.json_cache[0]
 			try:
-				await Historic.acquire()
+				await Historic.acquire_shared()
 				Historic.historic.sort()
 				Historic.historic.reverse()
 				result = strings.tobytes(json.dumps(Historic.historic, separators=(',', ':')))
+				Historic.json_cache[0] = result
 			except Exception as err:
 				logger.syslog(err)
 			finally:
-				await Historic.release()
+				await Historic.release_shared()
 		return result
 
 	@staticmethod
@@ -169,14 +314,19 @@ class Historic:
 			Historic.first_extract[0] = True
 			try:
 				logger.syslog("Start historic creation")
-				# Scan sd card and get more recent motions
-				motions, lastdays = await Historic.scan_directories(MAX_DAYS_DISPLAYED, False)
-
-				# Build historic file
-				files = await Historic.build(motions)
-				logger.syslog("Historic contains :")
-				for day in lastdays:
-					logger.syslog("   %s"%day)
+				# Read the index with a single sequential read
+				if await Historic.load_index():
+					logger.syslog("Historic loaded from index")
+				else:
+					# Scan sd card and get more recent motions
+					motions, lastdays = await Historic.scan_directories(MAX_DAYS_DISPLAYED, False)
+
+					# Build historic file
+					await Historic.build(motions)
+					await Historic.build_index()
+					logger.syslog("Historic contains :")
+					for day in lastdays:
+						logger.syslog("   %s"%day)
 				logger.syslog("End   historic creation")
 				logger.syslog(strings.tostrings(info.flashinfo(mountpoint=sdcard.SdCard.get_mountpoint())))
 			except Exception as err:
@@ -212,7 +362,7 @@ class Historic:
 		root = Historic.get_root()
 		if root:
 			try:
-				await Historic.acquire()
+				await Historic.acquire_shared()
 				years = await Historic.scan_dir(root, r"\d\d\d\d", older)
 				for year in years:
 					path_year = root + "/" + year
@@ -246,7 +396,7 @@ class Historic:
 			except Exception as err:
 				logger.syslog(err)
 			finally:
-				await Historic.release()
+				await Historic.release_shared()
 		return motions, lastdays
 
 	@staticmethod
@@ -255,67 +405,103 @@ class Historic:
 		Historic.motion_in_progress[0] = state
 
 	@staticmethod
-	async def remove_files(directory, simulate=False, force=False):
-		""" Remove all files in the directory """
-		import shellcore
-		dir_not_empty = False
-		enough_space = False
-		force = True
-		if filesystem.exists(directory):
-			files_to_remove = []
-			dirs_to_remove  = []
-
-			# Parse all directories in sdcard (WARNING : TO AVOID CRASH, NEVER DELETE DIRECTORY OR FILE IN ilistdir LOOP)
-			for fileinfo in filesystem.list_directory(directory):
-				filename = fileinfo[0]
-				typ      = fileinfo[1]
-				# If file found
-				if typ & 0xF000 != 0x4000:
-					files_to_remove.append(directory + "/" + filename)
-				else:
-					dirs_to_remove.append(directory + "/" + filename)
-				dir_not_empty = True
-
-			for file_to_remove in files_to_remove:
-				shellcore.rmfile(file_to_remove, simulate=simulate, force=force)
-				if sdcard.SdCard.is_not_enough_space(low=False) is False:
-					enough_space = True
-					break
-
-			if enough_space is False:
-				for dir_to_remove in dirs_to_remove:
-					await Historic.remove_files(dir_to_remove, simulate=simulate, force=force)
-				if dir_not_empty:
-					shellcore.rm(directory, recursive=True, simulate=simulate, force=force)
-				else:
-					shellcore.rmdir(directory, recursive=True, simulate=simulate, force=force)
+	async def reduce_history():
+		""" Reduce the history length, only the list in memory is changed, the lock is shared """
+		if len(Historic.historic) > MAX_MOTIONS:
+			try:
+				await Historic.acquire_shared()
+				while len(Historic.historic) > MAX_MOTIONS:
+					Historic.remove_day_item(Historic.historic.pop())
+				Historic.invalidate(days=False)
+			finally:
+				await Historic.release_shared()
 
 	@staticmethod
-	async def reduce_history():
-		""" Reduce the history length """
-		try:
-			await Historic.acquire()
+	def get_day(item):
+		""" Get the day of historic item (year/month/day) """
+		filename = item[0].lstrip("/").split("/")
+		return strings.tobytes("%s/%s/%s"%(filename[1], filename[2], filename[3]))
 
-			if len(Historic.historic) > MAX_MOTIONS:
-				while len(Historic.historic) > MAX_MOTIONS:
-					del Historic.historic[-1]
+	@staticmethod
+	def get_days_index():
+		""" Get the index of historic items per day, the more recent items first """
+		if Historic.days_index[0] is None:
+			index = {}
+			for item in Historic.historic:
+				try:
+					day = Historic.get_day(item)
+					if day in index:
+						index[day].append(item)
+					else:
+						index[day] = [item]
+				except Exception as err:
+					logger.syslog(err)
+			for items in index.values():
+				items.sort(key=lambda item: item[0])
+				items.reverse()
+			Historic.days_index[0] = index
+		return Historic.days_index[0]
 
-		finally:
-			await Historic.release()
+	@staticmethod
+	def add_day_item(item):
+		""" Add the item in the index per day if it is built, the more recent items first """
+		if Historic.days_index[0] is not None:
+			try:
+				items = Historic.days_index[0].setdefault(Historic.get_day(item), [])
+				# The items are mostly added in chronological order, the search stops at the beginning
+				position = 0
+				while position < len(items) and items[position][0] > item[0]:
+					position += 1
+				items.insert(position, item)
+			except Exception as err:
+				logger.syslog(err)
+
+	@staticmethod
+	def remove_day_item(item):
+		""" Remove the item from the index per day if it is built """
+		if Historic.days_index[0] is not None:
+			try:
+				day = Historic.get_day(item)
+				items = Historic.days_index[0].get(day)
+				if items is not None:
+					items.remove(item)
+					if len(items) == 0:
+						del Historic.days_index[0][day]
+			except Exception as err:
+				logger.syslog(err)
 
 	@staticmethod
-	async def get_last_days():
-		""" Return the list of last days """
-		last_days = set()
+	async def get_days():
+		""" Return the list of days, the more recent first """
+		days = []
 		try:
-			await Historic.acquire()
-			for item in Historic.historic:
-				filename = item[0].lstrip("/").split("/")
-				path = b"%s/%s/%s"%(strings.tobytes(filename[1]),strings.tobytes(filename[2]),strings.tobytes(filename[3]))
-				last_days.add(path)
+			await Historic.acquire_shared()
+			days = list(Historic.get_days_index().keys())
 		finally:
-			await Historic.release()
-		return last_days
+			await Historic.release_shared()
+		days.sort()
+		days.reverse()
+		return days
+
+	@staticmethod
+	def get_day_items(day, offset=0, limit=MAX_MOTIONS):
+		""" Return a part of the motions of the day, the historic lock must be acquired by the caller """
+		return Historic.get_days_index().get(strings.tobytes(day), [])[offset:offset+limit]
+
+	@staticmethod
+	async def get_day_json(day, offset=0, limit=MAX_MOTIONS):
+		""" Return the json of a part of the motions of the day """
+		result = b"[]"
+		if Historic.get_root():
+			await Historic.reduce_history()
+			try:
+				await Historic.acquire_shared()
+				result = strings.tobytes(json.dumps(Historic.get_day_items(day, offset, limit), separators=(',', ':')))
+			except Exception as err:
+				logger.syslog(err)
+			finally:
+				await Historic.release_shared()
+		return result
 
 	@staticmethod
 	async def remove_older(force=False):
@@ -328,24 +514,41 @@ class Historic:
 			if sdcard.SdCard.is_not_enough_space(low=True) or force:
 				logger.syslog("Start cleanup historic")
 				Historic.first_extract[0] = False
-				olders, lastdays = await Historic.scan_directories(MAX_DAYS_REMOVED, True)
-				previous = ""
+				if Historic.quota_loaded[0] is False:
+					await StorageQuota.load(root)
+					Historic.quota_loaded[0] = True
 
-				for motion in olders:
+				# Select the older days to remove with the space used by each day
+				for day in StorageQuota.select(StorageQuota.get_needed()):
 					try:
-						await Historic.acquire()
-						directory = filesystem.split(motion)[0]
-						if previous != directory:
-							await Historic.remove_files(directory, simulate=False, force=force)
-							previous = directory
+						removed = await StorageQuota.remove_day(root, day, Historic.lock)
+						logger.syslog("Cleanup historic day %s : %d files removed"%(day, removed))
 					except Exception as err:
 						logger.syslog(err)
-					finally:
-						await Historic.release()
 					if sdcard.SdCard.is_not_enough_space(low=False) is False:
 						break
+
+				# Remove the motions deleted from the index
+				await HistoricIndex.compact(root, Historic.lock)
+				try:
+					await Historic.acquire()
+					StorageQuota.save(root)
+					Historic.invalidate()
+				finally:
+					await Historic.release()
 				logger.syslog("End cleanup historic : %s"%(strings.tostrings(info.flashinfo(mountpoint=sdcard.SdCard.get_mountpoint()))))
 
+	@staticmethod
+	async def save_quota():
+		""" Load the storage quota at the first call, and save it when modified """
+		root = Historic.get_root()
+		if root:
+			if Historic.quota_loaded[0] is False:
+				await StorageQuota.load(root)
+				Historic.quota_loaded[0] = True
+			else:
+				StorageQuota.save(root)
+
 	@staticmethod
 	async def periodic():
 		""" Internal periodic task """
@@ -361,6 +564,7 @@ class Historic:
 			if sdcard.SdCard.is_mounted():
 				await Historic.remove_older()
 				await Historic.extract()
+				await Historic.save_quota()
 		return True
 
 	@staticmethod
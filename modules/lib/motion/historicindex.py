@@ -0,0 +1,204 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Persistent index of the motion historic, to load the historic with a single sequential read.
+The index file starts with a header (b"HIDX", version, record size), followed by fixed size records :
+	- width, height, squarex, squarey of motion (unsigned 16 bits little endian)
+	- number of differences words, length of filename (unsigned 8 bits)
+	- filename of image (padded with zeros)
+	- differences words (unsigned 32 bits little endian, padded with zeros)
+The records have a fixed size to read the more recent ones directly at the end of file, the differences are stored bit packed
+(one bit by square), and are run length encoded in the items of historic.
+The records are appended at each motion saved, and the index is compacted after the cleanup of older motions, it keeps at most MAX_RECORDS records """
+import struct
+import uasyncio
+from motion.diffmap import DiffMap
+from tools import logger,filesystem,strings
+
+INDEX_NAME    = "historic.idx"
+INDEX_MAGIC   = b"HIDX"
+INDEX_VERSION = 1
+INDEX_HEADER  = "<4sHH"
+MAX_NAME      = 118
+MAX_WORDS     = 32
+RECORD_FORMAT = "<HHHHBB%ds%dI"%(MAX_NAME, MAX_WORDS)
+RECORD_SIZE   = struct.calcsize(RECORD_FORMAT)
+HEADER_SIZE   = struct.calcsize(INDEX_HEADER)
+READ_RECORDS  = 16
+MAX_RECORDS   = 2000
+
+class HistoricIndex:
+	""" Binary index of historic, the historic lock must be acquired by the caller """
+	@staticmethod
+	def get_filename(root):
+		""" Get the index filename """
+		return root + "/" + INDEX_NAME
+
+	@staticmethod
+	def pack(item):
+		""" Convert an historic item into record, returns None if the item cannot be stored """
+		name  = strings.tobytes(item[0])
+		diffs = item[3]
+		if DiffMap.is_encoded(diffs):
+			diffs = DiffMap.decode(diffs, DiffMap.get_squares(item[1], item[2], item[4], item[5]))
+		if len(name) > MAX_NAME or len(diffs) > MAX_WORDS or type(diffs) == type(""):
+			return None
+		return struct.pack(RECORD_FORMAT, item[1], item[2], item[4], item[5], len(diffs), len(name), name, *(list(diffs) + [0]*(MAX_WORDS-len(diffs))))
+
+	@staticmethod
+	def unpack(record):
+		""" Convert a record into historic item """
+		values = struct.unpack(RECORD_FORMAT, record)
+		width, height, squarex, squarey, words, length, name = values[:7]
+		return [strings.tostrings(name[:length]), width, height, DiffMap.encode(values[7:7+words], DiffMap.get_squares(width, height, squarex, squarey)), squarex, squarey]
+
+	@staticmethod
+	def create(filename):
+		""" Create an empty index file """
+		with open(filename, "wb") as file:
+			file.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, INDEX_VERSION, RECORD_SIZE))
+
+	@staticmethod
+	def is_valid(filename):
+		""" Indicates if the index file exists and has the expected format """
+		try:
+			with open(filename, "rb") as file:
+				magic, version, size = struct.unpack(INDEX_HEADER, file.read(HEADER_SIZE))
+				if magic == INDEX_MAGIC and version == INDEX_VERSION and size == RECORD_SIZE:
+					return True
+		except Exception:
+			pass
+		return False
+
+	@staticmethod
+	def append(root, item):
+		""" Append the item at the end of index, only if the index exists """
+		result = False
+		filename = HistoricIndex.get_filename(root)
+		record = HistoricIndex.pack(item) if item is not None else None
+		if record is not None and filesystem.exists(filename):
+			try:
+				with open(filename, "ab") as file:
+					file.write(record)
+				result = True
+			except Exception as err:
+				logger.syslog(err)
+		return result
+
+	@staticmethod
+	async def load(root, max_items):
+		""" Read the more recent items of index, returns None if the index is not available """
+		filename = HistoricIndex.get_filename(root)
+		if HistoricIndex.is_valid(filename) is False:
+			return None
+		result = []
+		try:
+			with open(filename, "rb") as file:
+				count = (filesystem.filesize(filename) - HEADER_SIZE) // RECORD_SIZE
+				first = max(0, count - max_items)
+				file.seek(HEADER_SIZE + first * RECORD_SIZE)
+				remaining = count - first
+				while remaining > 0:
+					records = min(READ_RECORDS, remaining)
+					data = file.read(records * RECORD_SIZE)
+					for i in range(len(data) // RECORD_SIZE):
+						result.append(HistoricIndex.unpack(data[i*RECORD_SIZE:(i+1)*RECORD_SIZE]))
+					remaining -= records
+					if filesystem.ismicropython():
+						await uasyncio.sleep_ms(2)
+		except Exception as err:
+			logger.syslog(err)
+			result = None
+		return result
+
+	@staticmethod
+	def rebuild(root, items):
+		""" Rewrite the index with the items given """
+		filename = HistoricIndex.get_filename(root)
+		temporary = filename + ".tmp"
+		try:
+			HistoricIndex.create(temporary)
+			with open(temporary, "ab") as file:
+				for item in sorted(items, key=lambda item: item[0]):
+					record = HistoricIndex.pack(item)
+					if record is not None:
+						file.write(record)
+			filesystem.rename(temporary, filename)
+		except Exception as err:
+			logger.syslog(err)
+			filesystem.remove(temporary)
+
+	@staticmethod
+	def is_removed(record, directories):
+		""" Indicates if the motion of record was deleted, the motions are removed by directory so only the directory of each motion is checked """
+		length = record[9]
+		directory = filesystem.split(strings.tostrings(record[10:10+length]))[0]
+		if directory not in directories:
+			directories[directory] = filesystem.exists(directory)
+		return directories[directory] is False
+
+	@staticmethod
+	async def compact(root, lock):
+		""" Remove from the index the records of motions deleted, and the older records beyond the maximal size.
+		The file is only read and copied with the lock shared, the lock exclusive is taken to copy the records appended meanwhile and replace the file """
+		filename = HistoricIndex.get_filename(root)
+		temporary = filename + ".tmp"
+		directories = {}
+		kept = 0
+		removed = 0
+		try:
+			await lock.acquire_read()
+			try:
+				if HistoricIndex.is_valid(filename) is False:
+					return
+				with open(filename, "rb") as source:
+					# The size is read on the file opened, the informations of filesystem can be cached
+					count = (source.seek(0, 2) - HEADER_SIZE) // RECORD_SIZE
+					# The older records beyond the maximal size are dropped
+					first = max(0, count - MAX_RECORDS)
+					removed = first
+
+					# Count the records removed, the file is not rewritten if all are kept
+					source.seek(HEADER_SIZE + first * RECORD_SIZE)
+					for i in range(first, count, READ_RECORDS):
+						data = source.read(min(READ_RECORDS, count - i) * RECORD_SIZE)
+						for j in range(len(data) // RECORD_SIZE):
+							if HistoricIndex.is_removed(data[j*RECORD_SIZE:(j+1)*RECORD_SIZE], directories):
+								removed += 1
+						if filesystem.ismicropython():
+							await uasyncio.sleep_ms(2)
+					if removed == 0:
+						return
+
+					HistoricIndex.create(temporary)
+					with open(temporary, "ab") as destination:
+						source.seek(HEADER_SIZE + first * RECORD_SIZE)
+						for i in range(first, count, READ_RECORDS):
+							data = source.read(min(READ_RECORDS, count - i) * RECORD_SIZE)
+							for j in range(len(data) // RECORD_SIZE):
+								record = data[j*RECORD_SIZE:(j+1)*RECORD_SIZE]
+								if HistoricIndex.is_removed(record, directories) is False:
+									destination.write(record)
+									kept += 1
+							if filesystem.ismicropython():
+								await uasyncio.sleep_ms(2)
+			finally:
+				lock.release_read()
+
+			await lock.acquire()
+			try:
+				# Copy the records appended during the compaction, and replace the index
+				with open(filename, "rb") as source:
+					source.seek(HEADER_SIZE + count * RECORD_SIZE)
+					data = source.read()
+				if len(data) >= RECORD_SIZE:
+					with open(temporary, "ab") as destination:
+						destination.write(data[:(len(data) // RECORD_SIZE) * RECORD_SIZE])
+					kept += len(data) // RECORD_SIZE
+				filesystem.rename(temporary, filename)
+			finally:
+				lock.release()
+			logger.syslog("Historic index compacted : %d kept, %d removed"%(kept, removed))
+		except Exception as err:
+			logger.syslog(err)
+			filesystem.remove(temporary)
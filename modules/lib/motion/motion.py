@@ -3,6 +3,7 @@
 # pylint:disable=consider-using-f-string
 """ Motion detection only work with ESP32CAM (Requires specially modified ESP32CAM firmware to handle motion detection.) """
 from gc import collect
+from array import array
 import sys
 import time
 import uasyncio
@@ -12,10 +13,20 @@ from server.server   import Server
 from server.presence import Presence
 from server.webhook  import WebhookConfig
 from motion.historic import Historic
+from motion.savequeue import SaveQueue
+from motion.cliprecorder import ClipRecorder
+from motion.motionmask import MotionMask
 from video.video     import Camera
+from video.framehub  import FrameHub
 from tools import logger,jsonconfig,lang,linearfunction,tasking,strings,filesystem,date
 
 STATE_DURATION = 30
+ACTIVITY_DURATION = 20
+DARK_LIGHT = 20
+SLOW_INTERVAL = 5000
+PIR_START_INTERVAL = 3
+QUALITY_MIN = 0
+QUALITY_MAX = 63
 class MotionConfig(jsonconfig.JsonConfig):
 	""" Configuration class of motion detection """
 	def __init__(self):
@@ -57,41 +68,195 @@ class MotionConfig(jsonconfig.JsonConfig):
 		# To keep all motion detection in the presence of occupants
 		self.permanent_detection = False
 
-		# Empty mask is equal disable masking
+		# Empty mask is equal disable masking (bitmap of squares ignored, see MotionMask)
 		self.mask = b""
 
+		# Named masks profiles
+		self.mask_profiles = {}
+
+		# Name of mask profile used when an occupant is present
+		self.mask_presence = b""
+
+		# Masks profiles used by schedule, list of [start minute of day, end minute of day, profile name]
+		self.mask_schedule = []
+
+		# Target size of jpeg images for each resolution (the max possible is 64K)
+		self.jpeg_sizes = {b"320x240":16*1024, b"640x480":40*1024, b"800x600":56*1024, b"1024x768":58*1024, b"1280x720":58*1024}
+
+		# Record the motion events in a clip file, with the images before and after the detection
+		self.clip_recording = False
+
+		# Duration in seconds of clip before the motion detection, limited by the images kept in the ring (max_motion_images)
+		self.clip_pre_duration = 1
+
+		# Duration in seconds of clip after the last motion detection
+		self.clip_post_duration = 10
+
+		# Minimum size in squares of a blob of contiguous differences to detect movement (0 = disabled, differences_detection used)
+		self.min_blob_size = 0
+
+		# Minimal interval in milliseconds between two captures (max rate), used when a motion is in progress
+		self.polling_min = 10
+
+		# Maximal interval in milliseconds between two captures (min rate), used when nothing happens
+		self.polling_max = 50
+
+		# Compare the new motions with a background learned slowly, to ignore the slow changes of light
+		self.background_model = False
+
+		# Speed of background learning, the background moves of 1/2^n of the difference with each image
+		self.background_learning = 5
+
+def get_error_lights(sensitivity):
+	""" Return the points of the light error function according to the sensitivity """
+	errorLight = linearfunction.get_fx(sensitivity, linearfunction.get_linear(100,8,0,64))
+	return [[0,10],[30,10],[128,errorLight],[256,errorLight]]
+
+def label_blobs(diffs, width, height):
+	""" Label in one pass the blobs of contiguous differences (8-connectivity) in the bitmap of squares.
+	Returns the list of blobs [x, y, width, height, area] in squares, sorted by decreasing area """
+	parents = [0]
+	stats = [None]
+	previous = [0]*(width+1)
+	current  = [0]*(width+1)
+	bit = 0
+	for y in range(height):
+		for x in range(width):
+			label = 0
+			if diffs[bit >> 5] & (0x80000000 >> (bit & 31)):
+				# Search the neighbours already labelled : left, upper left, upper, upper right
+				for neighbour in (current[x-1] if x > 0 else 0, previous[x-1] if x > 0 else 0, previous[x], previous[x+1]):
+					if neighbour:
+						# Find the root of neighbour
+						while parents[neighbour] != neighbour:
+							parents[neighbour] = parents[parents[neighbour]]
+							neighbour = parents[neighbour]
+						if label == 0:
+							label = neighbour
+						elif neighbour != label:
+							# Merge the two blobs
+							parents[neighbour] = label
+							merged, stat = stats[neighbour], stats[label]
+							stat[0] += merged[0]
+							stat[1] = min(stat[1], merged[1])
+							stat[2] = min(stat[2], merged[2])
+							stat[3] = max(stat[3], merged[3])
+							stat[4] = max(stat[4], merged[4])
+				if label == 0:
+					# New blob
+					label = len(parents)
+					parents.append(label)
+					stats.append([0, x, y, x, y])
+				stat = stats[label]
+				stat[0] += 1
+				if x < stat[1]:
+					stat[1] = x
+				if x > stat[3]:
+					stat[3] = x
+				stat[4] = y
+			current[x] = label
+			bit += 1
+		previous, current = current, previous
+	blobs = []
+	for label in range(1, len(parents)):
+		if parents[label] == label:
+			area, x1, y1, x2, y2 = stats[label]
+			blobs.append([x1, y1, x2 - x1 + 1, y2 - y1 + 1, area])
+	blobs.sort(key=lambda blob: blob[4], reverse=True)
+	return blobs
+
+def get_blobs(comparison):
+	""" Return the blobs of the comparison : count, largest area and boxes, computed once and kept in the comparison """
+	blobs = comparison.get("blobs")
+	if blobs is None:
+		diff = comparison["diff"]
+		boxes = label_blobs(diff["diffs"], diff["width"], diff["height"])
+		blobs = {"count":len(boxes), "largest":boxes[0][4] if len(boxes) > 0 else 0, "boxes":boxes}
+		comparison["blobs"] = blobs
+	return blobs
+
 class ImageMotion:
-	""" Class managing a motion detection image """
+	""" Class managing a motion detection image, it is a reusable slot of the motion ring """
 	baseIndex = [0]
 	motionBaseId = [0]
 	created = [0]
-	def __init__(self, motion, config):
-		""" Constructor """
+	def __init__(self, config, counted=True):
+		""" Constructor, the motions of a slot not counted (the background) are not in the number of motions created """
+		self.motion = None
+		self.config = config
+		self.counted = counted
+		self.index = 0
+		self.motion_id = None
+		self.time = 0
+		self.ticks = 0
+		self.motion_detected = False
+		self.comparison = None
+		self.date = None
+		self.filename = None
+		self.path = None
+
+	def set(self, motion):
+		""" Fill the slot with a new motion captured """
 		self.motion = motion
 		self.baseIndex[0] += 1
-		self.created[0] += 1
+		if motion is not None and self.counted:
+			self.created[0] += 1
 		self.index    = self.baseIndex[0]
-		self.filename = None
 		self.motion_id = None
-		self.date     = date.date_to_string()
-		self.filename = date.date_to_filename()
-		path = date.date_to_path()
-		if path[-1] in [0x30,0x31,0x32,0x33,0x34]:
-			path = path[:-1] + b"0"
-		else:
-			path = path[:-1] + b"5"
-		self.path     = path
+		self.time     = time.time()
+		self.ticks    = strings.ticks()
 		self.motion_detected = False
-		self.config = config
+		self.comparison = None
+		# The date, filename and path are only computed when the image is saved or notified
+		self.date     = None
+		self.filename = None
+		self.path     = None
+
+	def share(self, other):
+		""" Share the motion of an other image slot (used by the background) """
+		self.motion    = other.motion
+		self.index     = other.index
+		self.motion_id = other.motion_id
+		self.time      = other.time
+		self.ticks     = other.ticks
+		self.motion_detected = False
+		self.comparison = None
+		self.date     = None
+		self.filename = None
+		self.path     = None
+
+	def detach(self):
+		""" Forget the motion without releasing it, because it is shared with the background which owns it now """
+		if self.motion and self.counted:
+			self.created[0] -= 1
+		self.motion = None
 		self.comparison = None
 
+	def get_date(self):
+		""" Get the capture date """
+		if self.date is None:
+			self.date = date.date_to_string(self.time)
+		return self.date
+
+	def get_path(self):
+		""" Get the storage path of image (the images are grouped by five minutes) """
+		if self.path is None:
+			path = date.date_to_path(self.time)
+			if path[-1] in [0x30,0x31,0x32,0x33,0x34]:
+				path = path[:-1] + b"0"
+			else:
+				path = path[:-1] + b"5"
+			self.path = path
+		return self.path
+
 	def deinit(self):
 		""" Destructor """
-		self.created[0] -= 1
-		if self.created[0] >= 32:
-			print("Destroy %d"%self.created[0])
 		if self.motion:
+			if self.counted:
+				self.created[0] -= 1
 			self.motion.deinit()
+		self.motion = None
+		self.comparison = None
 
 	def set_motion_id(self, motion_id = None):
 		""" Set the unique image identifier """
@@ -110,11 +275,13 @@ class ImageMotion:
 
 	def get_filename(self):
 		""" Get the storage filename """
+		if self.filename is None:
+			self.filename = date.date_to_filename(self.time)
 		return "%s Id=%d D=%d"%(self.filename, self.index, self.get_diff_count())
 
 	def get_message(self):
 		""" Get the message of motion """
-		return "%s %s D=%d"%(strings.tostrings(lang.motion_detected), self.date[-8:], self.get_diff_count())
+		return "%s %s D=%d"%(strings.tostrings(lang.motion_detected), self.get_date()[-8:], self.get_diff_count())
 
 	def get_informations(self):
 		""" Return the informations of motion """
@@ -123,15 +290,15 @@ class ImageMotion:
 		else:
 			result = {}
 		result["image"]    = self.get_filename() + ".jpg"
-		result["path"]     = self.path
+		result["path"]     = self.get_path()
 		result["index"]    = self.index
-		result["date"]     = self.date
+		result["date"]     = self.get_date()
 		result["motion_id"] = self.motion_id
 		return result
 
 	async def save(self):
-		""" Save the image on sd card """
-		return await Historic.add_motion(strings.tostrings(self.path), self.get_filename(), self.motion.get_image(), self.get_informations())
+		""" Queue the image to save on sd card, return False if it was dropped """
+		return await SaveQueue.put(strings.tostrings(self.get_path()), self.get_filename(), self.motion.get_image(), self.get_informations(), self.get_motion_detected(), self.config.notify)
 
 	def compare(self, previous):
 		""" Compare two motion images to get differences """
@@ -184,17 +351,316 @@ class ImageMotion:
 	def refresh_config(self):
 		""" Refresh the motion detection configuration """
 		if self.motion is not None:
-			mask = strings.tobytes(self.config.mask)
-			if not b"/" in mask:
-				mask = b""
-			errorLight = linearfunction.get_fx(self.config.sensitivity, linearfunction.get_linear(100,8,0,64))
 			self.motion.configure(\
 				{
-					"mask":mask,
-					"errorLights":[[0,10],[30,10],[128,errorLight],[256,errorLight]],
+					"mask":MotionMask.get_firmware(self.config, SnapConfig.get().max),
+					"errorLights":get_error_lights(self.config.sensitivity),
 					"errorHistos":[[0,0],[32,32],[128,128],[256,256]]
 				})
 
+class ImageRing:
+	""" Ring buffer with a fixed capacity of reusable motion images slots.
+	The index 0 is the most recent image, the last index is the older image.
+	An additional slot keeps the last image evicted, until the next capture, to let it be saved or notified. """
+	def __init__(self, config, capacity):
+		""" Constructor """
+		self.config = config
+		self.slots = []
+		self.head = 0
+		self.count = 0
+		self.capacity = 0
+		self.resize(capacity)
+
+	def resize(self, capacity):
+		""" Change the capacity of ring, all images are forgotten (the motions must be released before) """
+		if capacity < 1:
+			capacity = 1
+		if capacity != self.capacity:
+			self.capacity = capacity
+			self.slots = []
+			for i in range(capacity + 1):
+				self.slots.append(ImageMotion(self.config))
+		self.head = 0
+		self.count = 0
+
+	def get_capacity(self):
+		""" Return the maximal number of images kept """
+		return self.capacity
+
+	def is_full(self):
+		""" Indicates if the ring is full """
+		return self.count >= self.capacity
+
+	def __len__(self):
+		""" Number of images in the ring """
+		return self.count
+
+	def __getitem__(self, index):
+		""" Get image, 0 is the more recent """
+		if index < 0:
+			index += self.count
+		if index < 0 or index >= self.count:
+			raise IndexError("Image ring index out of range")
+		return self.slots[(self.head - index) % len(self.slots)]
+
+	def __iter__(self):
+		""" Iterate images from the more recent to the older """
+		slots_count = len(self.slots)
+		for index in range(self.count):
+			yield self.slots[(self.head - index) % slots_count]
+
+	def __contains__(self, image):
+		""" Indicates if the image slot is in the ring """
+		for current in self:
+			if current is image:
+				return True
+		return False
+
+	def pop(self):
+		""" Remove the older image of the ring, the slot stays valid until the next push """
+		if self.count > 0:
+			self.count -= 1
+			return self.slots[(self.head - self.count) % len(self.slots)]
+		return None
+
+	def next_slot(self):
+		""" Return the slot which will be reused by the next push """
+		return self.slots[(self.head + 1) % len(self.slots)]
+
+	def push(self, motion):
+		""" Add a new motion in the ring, the older image is evicted if the ring is full """
+		if self.count >= self.capacity:
+			self.pop()
+		self.head = (self.head + 1) % len(self.slots)
+		slot = self.slots[self.head]
+		slot.set(motion)
+		self.count += 1
+		return slot
+
+	def clear(self):
+		""" Forget all images """
+		self.head = 0
+		self.count = 0
+
+	def all_slots(self):
+		""" Return all slots including the evicted one """
+		return self.slots
+
+class BackgroundModel:
+	""" Background with the exponential moving average of the light of each square,
+	the slow changes of light (cloud, sunset) are learned and not detected as motion """
+	FIXED = 4
+	def __init__(self, config):
+		""" Constructor """
+		self.config = config
+		self.lights = None
+		self.frame_lights = None
+		self.diffs = None
+		self.learned = 0
+		self.sensitivity = None
+		self.errors = None
+
+	def reset(self):
+		""" Forget the background learned """
+		self.lights = None
+		self.diffs = None
+		self.learned = 0
+
+	def get_errors(self):
+		""" Return the table of light error for each level of light """
+		if self.sensitivity != self.config.sensitivity:
+			self.sensitivity = self.config.sensitivity
+			points = get_error_lights(self.sensitivity)
+			self.errors = bytearray(256)
+			for i in range(1, len(points)):
+				linear = linearfunction.get_linear(points[i-1][0], points[i-1][1], points[i][0], points[i][1])
+				for light in range(points[i-1][0], min(points[i][0], 256)):
+					self.errors[light] = max(0, min(255, linearfunction.get_fx(light, linear)))
+		return self.errors
+
+	def process(self, image, compare=True):
+		""" Compare the image with the background, then learn the image.
+		Returns the comparison in the same format as the motion comparison, or None if nothing learned """
+		# The lights are read in the same buffer at each image, without copying the jpeg image
+		try:
+			lights = image.motion.get_lights(self.frame_lights)
+		except ValueError:
+			lights = image.motion.get_lights()
+		self.frame_lights = lights
+		squares = len(lights)
+		if self.lights is None or len(self.lights) != squares:
+			self.lights = array("H", [light << self.FIXED for light in lights])
+			self.diffs = bytearray(squares)
+			self.learned = 1
+			return None
+
+		errors = self.get_errors()
+
+		# Compare the lights with the background
+		background = self.lights
+		diffs = self.diffs
+		for i in range(squares):
+			light = lights[i]
+			previous = background[i] >> self.FIXED
+			if abs(light - previous) > errors[max(light, previous)]:
+				diffs[i] = 1
+			else:
+				diffs[i] = 0
+
+		# Learn the image, the squares different are learned slowly to not absorb the moving objects
+		shift = self.config.background_learning
+		if self.learned < (1 << shift):
+			self.learned += 1
+			shift = 0
+			while (1 << shift) < self.learned:
+				shift += 1
+		for i in range(squares):
+			value = lights[i] << self.FIXED
+			if diffs[i]:
+				background[i] += (value - background[i]) >> (shift + 2)
+			else:
+				background[i] += (value - background[i]) >> shift
+
+		if compare is False:
+			return None
+		return self.get_comparison()
+
+	def get_comparison(self):
+		""" Build the comparison result with the last differences, the squares masked are removed """
+		squares = len(self.diffs)
+		diffs, count = MotionMask.apply(MotionMask.pack(self.diffs), MotionMask.get_applied(squares))
+		snap = SnapConfig.get()
+		return {
+			"diff":
+			{
+				"count"    : count,
+				"max"      : squares,
+				"squarex"  : snap.square_x,
+				"squarey"  : snap.square_y,
+				"width"    : snap.diff_x,
+				"height"   : snap.diff_y,
+				"diffhisto": 256,
+				"errhisto" : 256,
+				"diffs"    : diffs
+			},
+			"geometry": {"width": snap.width, "height": snap.height}
+		}
+
+class QualityController:
+	""" Controller of the jpeg quality to keep the size of images near the target size of the resolution.
+	It is a proportional integral controller with a dead band (hysteresis) and a rate limit,
+	the gain is learned with the sizes observed for each quality """
+	DEAD_BAND   = 8     # Dead band in percent of target
+	HARD_LIMIT  = 62*1024
+	MIN_FRAMES  = 4     # Minimal number of images between two changes
+	MAX_STEP    = 2     # Maximal change of quality
+	STABLE      = 8     # Number of images in the dead band to consider the size converged
+	def __init__(self, config, quality=15):
+		""" Constructor """
+		self.config = config
+		self.quality = quality
+		self.resolution = None
+		self.target = 0
+		self.reset()
+
+	def reset(self):
+		""" Forget the learning, used when the resolution changed """
+		self.sizes = {}
+		self.slope = 0
+		self.integral = 0
+		self.frames = 0
+		self.stable = 0
+		self.converged = False
+		self.start = strings.ticks()
+		self.convergence = None
+
+	def get_target(self):
+		""" Get the target size of current resolution """
+		resolution = b"%dx%d"%(SnapConfig.get().width, SnapConfig.get().height)
+		if resolution != self.resolution:
+			self.resolution = resolution
+			self.reset()
+		target = None
+		if self.config is not None:
+			target = self.config.jpeg_sizes.get(resolution, None)
+		if target is None:
+			# Estimate with the number of pixels, 56K for 800x600
+			target = min(56*1024, (SnapConfig.get().width * SnapConfig.get().height * 56*1024)//(800*600))
+		self.target = target
+		return target
+
+	def learn(self, size):
+		""" Learn the size of the current quality, and the slope between sizes and qualities """
+		previous = self.sizes.get(self.quality)
+		if previous is None:
+			self.sizes[self.quality] = size
+		else:
+			self.sizes[self.quality] = (previous*3 + size)//4
+
+		# Compute the mean slope (bytes by quality step) with the qualities learned
+		qualities = sorted(self.sizes.keys())
+		slopes = 0
+		count = 0
+		for i in range(1, len(qualities)):
+			slope = (self.sizes[qualities[i-1]] - self.sizes[qualities[i]]) // (qualities[i] - qualities[i-1])
+			if slope > 0:
+				slopes += slope
+				count += 1
+		if count > 0:
+			self.slope = slopes // count
+		else:
+			# Default slope when not enough learned
+			self.slope = max(1, self.target // 32)
+
+	def update(self, size):
+		""" Update the controller with the size of last image, return the new quality or None if not changed """
+		target = self.get_target()
+		self.learn(size)
+		self.frames += 1
+		error = size - target
+		# Hysteresis : once converged, the size must go further to react
+		if self.converged:
+			dead_band = (target * self.DEAD_BAND * 3)//200
+		else:
+			dead_band = (target * self.DEAD_BAND)//100
+
+		# If the size is in the dead band
+		if abs(error) <= dead_band and size < self.HARD_LIMIT:
+			self.integral = 0
+			self.stable += 1
+			if self.converged is False and self.stable >= self.STABLE:
+				self.converged = True
+				self.convergence = strings.ticks() - self.start
+				logger.syslog("Jpeg size %d converged with quality %d in %d ms"%(size, self.quality, self.convergence), display=False)
+			return None
+
+		# The size leaves the dead band
+		if self.converged:
+			self.converged = False
+			self.start = strings.ticks()
+		self.stable = 0
+
+		# Limit the rate of changes, except if the size is near the max possible
+		if self.frames < self.MIN_FRAMES and size < self.HARD_LIMIT:
+			return None
+
+		# Proportional integral in quality steps
+		self.integral = max(-4*self.slope, min(4*self.slope, self.integral + error//4))
+		step = (error + self.integral) // self.slope
+		step = max(-self.MAX_STEP, min(self.MAX_STEP, step))
+		if step == 0:
+			step = 1 if error > 0 else -1
+		quality = max(QUALITY_MIN, min(QUALITY_MAX, self.quality + step))
+		if quality == self.quality:
+			return None
+		self.quality = quality
+		self.frames = 0
+		return quality
+
+	def get_status(self):
+		""" Return the status of controller : quality, target, slope and convergence time in milliseconds """
+		return {"quality":self.quality, "target":self.target, "slope":self.slope, "converged":self.converged, "convergence":self.convergence}
+
 class SnapConfig:
 	""" Store last motion information """
 	info = None
@@ -228,14 +694,16 @@ class SnapConfig:
 class Motion:
 	""" Class to manage the motion capture """
 	def __init__(self, config= None, pir_detection=False):
-		self.images = []
+		self.images = ImageRing(config, config.max_motion_images)
 		self.index  = 0
 		self.config = config
 		self.pir_detection = pir_detection
-		self.image_background = None
+		self.image_background = ImageMotion(config, counted=False)
+		self.background_model = BackgroundModel(config)
+		self.clip = ClipRecorder(config)
 		self.must_refresh_config = True
-		self.quality = 15
-		self.previous_quality = 0
+		self.quality_controller = QualityController(config)
+		self.quality = self.quality_controller.quality
 		self.flash_level = 0
 
 	def __del__(self):
@@ -244,13 +712,15 @@ class Motion:
 
 	def cleanup(self):
 		""" Clean up all images """
-		for image in self.images:
-			if id(image) != id(self.image_background):
+		for image in self.images.all_slots():
+			if image.motion is not None and image.motion is self.image_background.motion:
+				image.detach()
+			else:
 				image.deinit()
-		self.images = []
-		if self.image_background:
-			self.image_background.deinit()
-		self.image_background = None
+		self.images.clear()
+		self.image_background.deinit()
+		self.background_model.reset()
+		self.clip.stop()
 
 	def open(self):
 		""" Open camera """
@@ -261,14 +731,16 @@ class Motion:
 
 	def resume(self):
 		""" Resume the camera, restore the camera configuration after an interruption """
-		video.Camera.framesize(b"%dx%d"%(SnapConfig.get().width, SnapConfig.get().height))
-		video.Camera.pixformat(b"JPEG")
-		video.Camera.quality(self.quality)
-		video.Camera.brightness(0)
-		video.Camera.contrast(0)
-		video.Camera.saturation(0)
-		video.Camera.hmirror(0)
-		video.Camera.vflip(0)
+		# Only the settings changed by the streaming are programmed on the sensor
+		video.Camera.apply([
+			("framesize",  b"%dx%d"%(SnapConfig.get().width, SnapConfig.get().height)),
+			("pixformat",  b"JPEG"),
+			("quality",    self.quality),
+			("brightness", 0),
+			("contrast",   0),
+			("saturation", 0),
+			("hmirror",    0),
+			("vflip",      0)], video.OWNER_MOTION)
 		video.Camera.flash(self.flash_level)
 
 		detected, change_polling = self.detect(False)
@@ -304,8 +776,16 @@ class Motion:
 	async def capture(self):
 		""" Capture motion image """
 		result = None
+		# If the number of images in historic changed
+		if self.images.get_capacity() != self.config.max_motion_images:
+			self.cleanup()
+			self.images.resize(self.config.max_motion_images)
+
+		# Release the slot evicted during the previous capture, it will be reused
+		self.deinit_image(self.images.next_slot())
+
 		# If enough image taken
-		if len(self.images) >= self.config.max_motion_images:
+		if self.images.is_full():
 			# Get older image
 			image = self.images.pop()
 
@@ -314,23 +794,37 @@ class Motion:
 				# Notification of motion
 				result = (image.get_message(), image)
 
-				# Save image to sdcard
-				if await image.save() is False:
-					Notifier.notify(lang.failed_to_save, enabled=self.config.notify)
+				# Queue the image to save on sdcard, the writer task notifies if the save failed.
+				# With the clip recording, the event is saved in its clip instead of an image for each detection
+				if self.config.clip_recording is False:
+					await image.save()
 			else:
 				# Destroy image
 				self.deinit_image(image)
 
-		motion = video.Camera.motion()
+		motion = await video.Camera.motion()
+		FrameHub.feed(motion)
+		# If the camera failed, no image is added
+		if motion is None:
+			return result
 		self.manage_flash(motion)
-		image = ImageMotion(motion, self.config)
+		image = self.images.push(motion)
+		if self.config.clip_recording:
+			self.clip.add(image)
+		else:
+			self.clip.stop()
 		if self.must_refresh_config:
 			image.refresh_config()
 			self.must_refresh_config = False
-		self.images.insert(0, image)
 		self.index += 1
 		return result
 
+	def get_light(self):
+		""" Return the light of the last image captured, or None """
+		if len(self.images) > 0 and self.images[0].motion is not None:
+			return self.images[0].motion.get_light()
+		return None
+
 	def stop_light(self):
 		""" Stop the light """
 		# If flash led working and compensation disabled
@@ -358,30 +852,24 @@ class Motion:
 	def is_detected(self, comparison):
 		""" Indicates if motion detected """
 		if comparison:
+			# If the scattered differences must be ignored
+			if self.config.min_blob_size > 0:
+				# If not enough differences to make a blob large enough
+				if comparison["diff"]["count"] < self.config.min_blob_size:
+					return False
+				return get_blobs(comparison)["largest"] >= self.config.min_blob_size
 			# If image seem not equal to previous
-			if comparison["diff"]["count"] >= self.config.differences_detection:
+			elif comparison["diff"]["count"] >= self.config.differences_detection:
 				return True
 		return False
 
 	def adjust_quality(self, current):
 		""" Adjust the image quality according to the size of image (the max possible is 64K) """
 		if len(self.images) >= self.config.max_motion_images:
-			changed = False
-			size = current.get_size()
-			if size > 62*1024:
-				if self.quality < 63:
-					self.quality += 1
-					changed = True
-					video.Camera.quality(self.quality, False)
-			else:
-				if self.quality >= 1:
-					if size < 50*1024:
-						self.quality -= 1
-						changed = True
-						video.Camera.quality(self.quality, False)
-			if changed is False:
-				if self.previous_quality != self.quality:
-					self.previous_quality = self.quality
+			quality = self.quality_controller.update(current.get_size())
+			if quality is not None:
+				self.quality = quality
+				video.Camera.quality(self.quality, video.OWNER_MOTION)
 
 	def compare(self, display=True):
 		""" Compare all images captured and search differences """
@@ -391,8 +879,12 @@ class Motion:
 
 			self.adjust_quality(current)
 
+			learned = False
+
 			# Compute the motion identifier
-			for previous in self.images[1:]:
+			for index in range(1, len(self.images)):
+				previous = self.images[index]
+
 				# # If image not already compared
 				comparison = current.compare(previous)
 
@@ -403,7 +895,7 @@ class Motion:
 					break
 
 				# If image is too dark
-				if current.motion.get_light() <= 20:
+				if current.motion.get_light() <= DARK_LIGHT:
 					# Reuse the motion identifier
 					current.set_motion_id(previous.motion_id)
 					break
@@ -417,10 +909,18 @@ class Motion:
 				# Create new motion id
 				current.set_motion_id()
 
+				# Compare the image with the background learned, and learn it
+				if self.config.background_model and self.background_model.learned > 0:
+					current.comparison = self.background_model.process(current)
+					learned = True
 				# Compare the image with the background if existing and extract modification
-				if self.image_background is not None:
+				elif self.image_background.motion is not None:
 					comparison = current.compare(self.image_background)
 
+			# Learn the image in the background
+			if self.config.background_model and learned is False:
+				self.background_model.process(current, False)
+
 			# Compute the list of differences
 			diffs = b""
 			index = 0
@@ -449,9 +949,26 @@ class Motion:
 		""" Release image allocated """
 		if image:
 			if not image in self.images:
-				if image != self.image_background:
+				if image.motion is not None and image.motion is self.image_background.motion:
+					image.detach()
+				else:
 					image.deinit()
 
+	def is_referenced(self, motion):
+		""" Indicates if the motion is used by an image slot of the ring """
+		for image in self.images.all_slots():
+			if image.motion is motion:
+				return True
+		return False
+
+	def set_background(self, image):
+		""" Replace the background by the image """
+		previous = self.image_background.motion
+		self.image_background.share(image)
+		if previous is not None and previous is not image.motion:
+			if not self.is_referenced(previous):
+				previous.deinit()
+
 	def detect(self, display=True):
 		""" Detect motion """
 		detected = False
@@ -466,9 +983,7 @@ class Motion:
 			change_polling = True
 		# If no differences
 		elif len(list(differences.keys())) == 1:
-			image = self.image_background
-			self.image_background = self.images[0]
-			self.deinit_image(image)
+			self.set_background(self.images[0])
 			detected = False
 		# If not enough differences
 		elif len(list(differences.keys())) <= self.config.threshold_glitch:
@@ -490,6 +1005,10 @@ class Motion:
 				# If image seem not equal to previous
 				if self.is_detected(image.get_comparison()):
 					image.set_motion_detected()
+
+			# Record the clip of motion
+			if self.config.clip_recording:
+				self.clip.trigger(self.images)
 		return detected, change_polling
 
 class Detection:
@@ -499,11 +1018,7 @@ class Detection:
 		self.pir_detection = pir_detection
 		self.load_config()
 		self.motion = None
-
-		if self.pir_detection is True:
-			self.polling_frequency = 3
-		else:
-			self.polling_frequency = 100
+		self.scheduler = DetectionScheduler(self.motion_config, self.pir_detection)
 		self.detection = None
 		self.activated = None
 		self.refresh_config_counter = 0
@@ -530,6 +1045,9 @@ class Detection:
 				logger.syslog("Change motion config %s"%self.motion_config.to_string(), display=False)
 				if self.motion:
 					self.motion.refresh_config()
+			# If the mask selected by schedule or presence changed
+			elif self.motion and MotionMask.is_changed(self.motion_config):
+				self.motion.refresh_config()
 			# If configuration changed
 			if self.webhook.is_changed():
 				self.webhook.load()
@@ -555,6 +1073,7 @@ class Detection:
 		# If the motion detection activated
 		activated = await self.is_activated()
 		if activated or self.is_permanent():
+			FrameHub.set_feeding(True)
 			try:
 				# Capture motion
 				result = await self.capture(activated)
@@ -563,6 +1082,7 @@ class Detection:
 				self.release_image()
 
 		else:
+			FrameHub.set_feeding(False)
 			if self.motion:
 				self.motion.stop_light()
 			await uasyncio.sleep(10)
@@ -654,14 +1174,7 @@ class Detection:
 
 		# If camera not stabilized speed start
 		if self.motion and self.motion.is_stabilized() is True:
-			frequency = self.polling_frequency*500 if Server.is_slow() else self.polling_frequency
-			if frequency > 1000:
-				while frequency > 0:
-					await uasyncio.sleep_ms(500)
-					frequency -= 500
-					await Server.wait_resume(name="motion")
-			else:
-				await uasyncio.sleep_ms(frequency)
+			await self.scheduler.wait()
 
 		try:
 			# Waits for the camera's availability
@@ -673,6 +1186,8 @@ class Detection:
 				await self.init_motion()
 
 				# Capture motion image
+				start = strings.ticks()
+				index = self.motion.index
 				self.detection = await self.motion.capture()
 
 				# If motion detected and detection activated
@@ -703,18 +1218,14 @@ class Detection:
 								# Send webhook no motion detected
 								Notifier.webhook("Motion",self.webhook.no_motion_detected)
 							self.last_detection = 0
-				# Detect motion
-				detected, change_polling = self.motion.detect()
-
-				# If motion found
-				if change_polling is True:
-					# Speed up the polling frequency
-					self.polling_frequency = 10
-					Historic.set_motion_state(True)
-				else:
-					# Slow down the polling frequency
-					self.polling_frequency = 50
-					Historic.set_motion_state(False)
+				# If a new image captured
+				if self.motion.index != index:
+					# Detect motion
+					detected, change_polling = self.motion.detect()
+
+					# Adapt the polling according to the motion found
+					self.scheduler.update(change_polling, self.motion.get_light(), strings.ticks() - start)
+					Historic.set_motion_state(change_polling)
 				result = True
 			else:
 				if self.last_notification_suspended + 120 < int(time.time()):
@@ -727,6 +1238,99 @@ class Detection:
 				await video.Camera.unreserve(self)
 		return result
 
+class DetectionScheduler:
+	""" Compute the interval between two captures according to the motion activity, the light,
+	the cost of capture and the lag of event loop caused by the other tasks """
+	instance = [None]
+	def __init__(self, config, pir_detection=False):
+		""" Constructor """
+		self.config = config
+		self.activity = 0
+		self.cost = 0
+		self.lag = 0
+		self.dark = False
+		if pir_detection:
+			# Speed start on pir detection
+			self.interval = PIR_START_INTERVAL
+		else:
+			self.interval = self.get_max()
+		DetectionScheduler.instance[0] = self
+
+	def get_min(self):
+		""" Minimal interval in milliseconds """
+		return max(1, self.config.polling_min)
+
+	def get_max(self):
+		""" Maximal interval in milliseconds """
+		return max(self.get_min(), self.config.polling_max)
+
+	def update(self, motion_found, light, cost):
+		""" Compute the next interval with the motion found, the light of image and the duration of capture and detection in milliseconds """
+		# Average of capture cost
+		self.cost = (self.cost*3 + cost)//4
+
+		# The activity is maximal when a motion is found and decreases with each image without motion
+		if motion_found:
+			self.activity = ACTIVITY_DURATION
+		elif self.activity > 0:
+			self.activity -= 1
+
+		mini = self.get_min()
+		maxi = self.get_max()
+
+		# Without light the motion cannot be detected
+		self.dark = light is not None and light <= DARK_LIGHT
+		if self.dark:
+			interval = maxi
+		else:
+			# The interval grows from minimum to maximum when the activity decreases
+			interval = mini + ((maxi - mini)*(ACTIVITY_DURATION - self.activity))//ACTIVITY_DURATION
+
+		# Let the others tasks run at least half the capture cost and the lag observed
+		interval = max(interval, self.cost//2) + self.lag
+		self.interval = min(max(interval, mini), maxi)
+
+	def get_interval(self):
+		""" Return the current interval in milliseconds """
+		# The frames of detection are streamed to the clients
+		if FrameHub.has_subscribers():
+			return self.get_min()
+		if Server.is_slow():
+			return SLOW_INTERVAL
+		return self.interval
+
+	def get_rate(self):
+		""" Return the current rate in images per second """
+		return 1000. / (self.get_interval() + self.cost)
+
+	async def wait(self):
+		""" Wait the interval before the next capture and measure the lag of event loop """
+		interval = self.get_interval()
+		if interval > 1000:
+			while interval > 0:
+				await uasyncio.sleep_ms(500)
+				interval -= 500
+				await Server.wait_resume(name="motion")
+				# A client waits the frames of detection
+				if FrameHub.has_subscribers():
+					break
+		else:
+			start = strings.ticks()
+			await uasyncio.sleep_ms(interval)
+			lag = strings.ticks() - start - interval
+			if lag < 0:
+				lag = 0
+			self.lag = (self.lag*3 + lag)//4
+
+	@staticmethod
+	def get_status():
+		""" Return the status of scheduler for monitoring """
+		scheduler = DetectionScheduler.instance[0]
+		if scheduler is None:
+			return None
+		return {"interval":scheduler.get_interval(), "rate":scheduler.get_rate(), "activity":scheduler.activity,
+			"cost":scheduler.cost, "lag":scheduler.lag, "dark":scheduler.dark, "slow":Server.is_slow()}
+
 class MovingCounters:
 	""" Manages an event counter with a history """
 	def __init__(self, proof, step):
@@ -0,0 +1,159 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Motion mask stored as a bitmap of squares ignored, with a version, the size of grid and 32 bits words in hexadecimal.
+Example : b"1;20x15;" followed by 10 words of 8 hexadecimal characters. The first square is the most significant bit of first word.
+The old format (a string with one '/' for each square ignored) is still accepted """
+import time
+from server.presence import Presence
+from tools import strings
+
+MASK_VERSION = b"1"
+
+class MotionMask:
+	""" Manage the motion masks and the selection of mask profile by schedule or presence """
+	decoded = [None, None]
+	applied = [None]
+
+	@staticmethod
+	def pack(bits):
+		""" Pack a list of booleans into a list of 32 bits words, the first is the most significant bit """
+		words = []
+		value = 0
+		squares = len(bits)
+		for i in range(squares):
+			if bits[i]:
+				value |= 1
+			if i % 32 == 31:
+				words.append(value)
+				value = 0
+			else:
+				value <<= 1
+		if squares % 32 != 0:
+			words.append(value << (31 - (squares % 32)))
+		return words
+
+	@staticmethod
+	def encode(words, width, height):
+		""" Encode the mask words """
+		result = b"%s;%dx%d;"%(MASK_VERSION, width, height)
+		for word in words:
+			result += b"%08x"%word
+		return result
+
+	@staticmethod
+	def decode(mask):
+		""" Decode the mask, returns (words, width, height) or None if no mask """
+		mask = strings.tobytes(mask)
+		if MotionMask.decoded[0] == mask:
+			return MotionMask.decoded[1]
+		result = None
+		try:
+			if mask[:2] == MASK_VERSION + b";":
+				version, size, hexa = mask.split(b";")
+				width, height = size.split(b"x")
+				words = []
+				for i in range(0, len(hexa), 8):
+					words.append(int(hexa[i:i+8], 16))
+				if max(words + [0]) != 0:
+					result = (words, int(width), int(height))
+			elif b"/" in mask:
+				# Old format, the size of grid is unknown
+				result = (MotionMask.pack([square == 0x2F for square in mask]), len(mask), 1)
+		except Exception:
+			result = None
+		MotionMask.decoded[0] = mask
+		MotionMask.decoded[1] = result
+		return result
+
+	@staticmethod
+	def get_words(mask, squares):
+		""" Return the mask words if it matches the number of squares, or None """
+		decoded = MotionMask.decode(mask)
+		if decoded is not None:
+			words, width, height = decoded
+			if width * height == squares:
+				return words
+		return None
+
+	@staticmethod
+	def apply(diffs, words):
+		""" Remove with a bitwise and the squares masked of the differences words, returns the words and the count of differences """
+		result = []
+		count = 0
+		for i in range(len(diffs)):
+			if words is not None and i < len(words):
+				value = diffs[i] & ~words[i] & 0xFFFFFFFF
+			else:
+				value = diffs[i]
+			result.append(value)
+			while value:
+				value &= value - 1
+				count += 1
+		return result, count
+
+	@staticmethod
+	def select(config):
+		""" Return the mask of the profile selected by the presence or the schedule, else the default mask """
+		profile = None
+		if config.mask_presence != b"" and Presence.is_detected():
+			profile = config.mask_presence
+		else:
+			now = time.localtime()
+			minute = now[3]*60 + now[4]
+			for start, end, name in config.mask_schedule:
+				if (start <= end and start <= minute < end) or (start > end and (minute >= start or minute < end)):
+					profile = name
+					break
+		if profile is not None:
+			profile = strings.tobytes(profile)
+			if profile in config.mask_profiles:
+				return strings.tobytes(config.mask_profiles[profile])
+		return strings.tobytes(config.mask)
+
+	@staticmethod
+	def parse_schedule(text):
+		""" Parse the schedule of profiles written "HH:MM-HH:MM=profile" separated by commas, into [[start, end, profile],...] in minutes of day """
+		result = []
+		for item in strings.tobytes(text).split(b","):
+			item = item.strip()
+			if item != b"":
+				try:
+					period, profile = item.split(b"=")
+					start, end = period.split(b"-")
+					start_hour, start_minute = start.strip().split(b":")
+					end_hour, end_minute = end.strip().split(b":")
+					result.append([int(start_hour)*60 + int(start_minute), int(end_hour)*60 + int(end_minute), profile.strip()])
+				except Exception:
+					pass
+		return result
+
+	@staticmethod
+	def format_schedule(schedule):
+		""" Format the schedule of profiles for the edition """
+		result = []
+		for start, end, profile in schedule:
+			result.append(b"%02d:%02d-%02d:%02d=%s"%(start//60, start%60, end//60, end%60, strings.tobytes(profile)))
+		return b",".join(result)
+
+	@staticmethod
+	def is_changed(config):
+		""" Indicates if the mask selected changed since the last applied """
+		return MotionMask.select(config) != MotionMask.applied[0]
+
+	@staticmethod
+	def get_firmware(config, squares):
+		""" Return the words of mask selected for the firmware (empty list if no mask), and remember it as applied """
+		mask = MotionMask.select(config)
+		MotionMask.applied[0] = mask
+		words = MotionMask.get_words(mask, squares)
+		if words is None:
+			return []
+		return words
+
+	@staticmethod
+	def get_applied(squares):
+		""" Return the words of mask applied, or None """
+		if MotionMask.applied[0] is None:
+			return None
+		return MotionMask.get_words(MotionMask.applied[0], squares)
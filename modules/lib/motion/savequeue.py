@@ -0,0 +1,128 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Write behind queue of motion images to save on sd card, the detection loop only enqueues the image and a writer task saves it """
+import uasyncio
+from motion.historic import Historic
+from server.notifier import Notifier
+from tools import logger,lang,strings
+
+QUEUE_CAPACITY = 4
+
+class SaveQueue:
+	""" Bounded queue of images to save with a dedicated writer task.
+	When the queue is full, the older image without motion detected is dropped,
+	the images with motion detected are never dropped : the producer waits for the writer """
+	queue = []
+	capacity = [QUEUE_CAPACITY]
+	writer = [None]
+	writing = [False]
+	event = None
+	counters = {"queued":0, "written":0, "failed":0, "dropped":0, "max_depth":0, "write_count":0, "write_total_ms":0, "write_last_ms":0, "write_max_ms":0}
+
+	@staticmethod
+	def set_capacity(capacity):
+		""" Change the maximal number of images waiting to be written """
+		SaveQueue.capacity[0] = max(1, capacity)
+
+	@staticmethod
+	def get_depth():
+		""" Number of images waiting to be written """
+		return len(SaveQueue.queue)
+
+	@staticmethod
+	def get_counters():
+		""" Return the queue counters : depth and write latency in milliseconds """
+		result = SaveQueue.counters.copy()
+		result["depth"] = len(SaveQueue.queue)
+		if result["write_count"] > 0:
+			result["write_mean_ms"] = result["write_total_ms"] // result["write_count"]
+		else:
+			result["write_mean_ms"] = 0
+		return result
+
+	@staticmethod
+	def start():
+		""" Start the writer task if not yet started """
+		if SaveQueue.event is None:
+			SaveQueue.event = uasyncio.Event()
+		if SaveQueue.writer[0] is None:
+			SaveQueue.writer[0] = uasyncio.create_task(SaveQueue.task())
+
+	@staticmethod
+	def drop_older():
+		""" Drop the older image without motion detected, return False if all images have a motion detected """
+		for index in range(len(SaveQueue.queue)):
+			if SaveQueue.queue[index][4] is False:
+				path, name = SaveQueue.queue[index][0:2]
+				del SaveQueue.queue[index]
+				SaveQueue.counters["dropped"] += 1
+				logger.syslog("Save queue full, %s/%s dropped"%(path, name), display=False)
+				return True
+		return False
+
+	@staticmethod
+	async def put(path, name, image, motion_info, detected=True, notify=True):
+		""" Add an image to save, return False if the image is dropped """
+		SaveQueue.start()
+		while len(SaveQueue.queue) >= SaveQueue.capacity[0]:
+			if SaveQueue.drop_older() is False:
+				# All images waiting have a motion detected
+				if detected is False:
+					SaveQueue.counters["dropped"] += 1
+					return False
+				# Wait the writer
+				await uasyncio.sleep_ms(20)
+		SaveQueue.queue.append([path, name, image, motion_info, detected, notify])
+		SaveQueue.counters["queued"] += 1
+		if len(SaveQueue.queue) > SaveQueue.counters["max_depth"]:
+			SaveQueue.counters["max_depth"] = len(SaveQueue.queue)
+		SaveQueue.event.set()
+		return True
+
+	@staticmethod
+	async def write():
+		""" Write the older image of queue """
+		path, name, image, motion_info, detected, notify = SaveQueue.queue.pop(0)
+		SaveQueue.writing[0] = True
+		try:
+			start = strings.ticks()
+			# The thumbnail is encoded by the writer without the historic lock, the detection runs before and after
+			await uasyncio.sleep_ms(0)
+			thumbnail = Historic.create_thumbnail(image)
+			await uasyncio.sleep_ms(0)
+			result = await Historic.add_motion(path, name, image, motion_info, thumbnail)
+			duration = strings.ticks() - start
+			SaveQueue.counters["write_count"]    += 1
+			SaveQueue.counters["write_total_ms"] += duration
+			SaveQueue.counters["write_last_ms"]   = duration
+			if duration > SaveQueue.counters["write_max_ms"]:
+				SaveQueue.counters["write_max_ms"] = duration
+			if result is False:
+				SaveQueue.counters["failed"] += 1
+				Notifier.notify(lang.failed_to_save, enabled=notify)
+			else:
+				SaveQueue.counters["written"] += 1
+		finally:
+			SaveQueue.writing[0] = False
+
+	@staticmethod
+	async def task():
+		""" Writer task """
+		while True:
+			try:
+				if len(SaveQueue.queue) == 0:
+					SaveQueue.event.clear()
+					await SaveQueue.event.wait()
+				else:
+					await SaveQueue.write()
+					# Let the detection run between two writes
+					await uasyncio.sleep_ms(0)
+			except Exception as err:
+				logger.syslog(err)
+
+	@staticmethod
+	async def flush():
+		""" Wait that all images in queue are written """
+		while len(SaveQueue.queue) > 0 or SaveQueue.writing[0]:
+			await uasyncio.sleep_ms(20)
@@ -0,0 +1,171 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Accounting of the space used by the motions on the sd card, to choose the days to remove without scanning the sd card """
+import re
+import json
+import uos
+import uasyncio
+from tools import logger,sdcard,filesystem,strings
+
+QUOTA_NAME   = "historic.quota"
+CLEANUP_FREE = 10
+DELETE_BATCH = 16
+
+class StorageQuota:
+	""" Bytes and files stored per day (year/month/day), updated at each save and delete, and persisted with the historic index """
+	days = {}
+	modified = [False]
+
+	@staticmethod
+	def get_filename(root):
+		""" Get the quota filename """
+		return root + "/" + QUOTA_NAME
+
+	@staticmethod
+	def get_day(path):
+		""" Get the day (year/month/day) of a path relative to the sd card """
+		return strings.tostrings(path).lstrip("/")[:10]
+
+	@staticmethod
+	def add(path, size, files=1):
+		""" Add the size of files saved in the path """
+		day = StorageQuota.get_day(path)
+		if day in StorageQuota.days:
+			StorageQuota.days[day][0] += size
+			StorageQuota.days[day][1] += files
+		else:
+			StorageQuota.days[day] = [size, files]
+		StorageQuota.modified[0] = True
+
+	@staticmethod
+	def get_total():
+		""" Get the total of bytes and files stored """
+		size  = 0
+		files = 0
+		for day_size, day_files in StorageQuota.days.values():
+			size  += day_size
+			files += day_files
+		return size, files
+
+	@staticmethod
+	async def load(root):
+		""" Load the quota file, or rebuild it by scanning the sd card if not existing """
+		days = None
+		try:
+			with open(StorageQuota.get_filename(root), "r") as file:
+				days = json.load(file)
+		except Exception:
+			pass
+		if days is None:
+			logger.syslog("Rebuild historic quota")
+			days = await StorageQuota.scan(root)
+		else:
+			# Add the files saved before the loading
+			for day, (size, files) in StorageQuota.days.items():
+				if day in days:
+					days[day][0] += size
+					days[day][1] += files
+				else:
+					days[day] = [size, files]
+		StorageQuota.days = days
+		StorageQuota.modified[0] = True
+		StorageQuota.save(root)
+
+	@staticmethod
+	def save(root):
+		""" Save the quota file if modified """
+		if StorageQuota.modified[0]:
+			try:
+				filename = StorageQuota.get_filename(root)
+				with open(filename + ".tmp", "w") as file:
+					json.dump(StorageQuota.days, file)
+				filesystem.rename(filename + ".tmp", filename)
+				StorageQuota.modified[0] = False
+			except Exception as err:
+				logger.syslog(err)
+
+	@staticmethod
+	async def scan(root):
+		""" Scan the sd card to get the bytes and files stored per day """
+		days = {}
+		for year in StorageQuota.list_dir(root, r"\d\d\d\d"):
+			for month in StorageQuota.list_dir(root + "/" + year, r"\d\d"):
+				for day in StorageQuota.list_dir(root + "/" + year + "/" + month, r"\d\d"):
+					path_day = "%s/%s/%s"%(year, month, day)
+					size  = 0
+					files = 0
+					for hour in StorageQuota.list_dir(root + "/" + path_day, r"\d\dh\d\d"):
+						for fileinfo in filesystem.list_directory(root + "/" + path_day + "/" + hour):
+							if fileinfo[1] & 0xF000 != 0x4000:
+								size  += fileinfo[3]
+								files += 1
+					days[path_day] = [size, files]
+					await uasyncio.sleep_ms(3)
+		return days
+
+	@staticmethod
+	def list_dir(path, pattern):
+		""" List the directories matching the pattern """
+		result = []
+		try:
+			for fileinfo in filesystem.list_directory(path):
+				if fileinfo[1] & 0xF000 == 0x4000 and re.match(pattern, fileinfo[0]):
+					result.append(fileinfo[0])
+		except Exception:
+			pass
+		result.sort()
+		return result
+
+	@staticmethod
+	def get_needed():
+		""" Get the bytes to remove to reach the free space of cleanup """
+		return (sdcard.SdCard.get_max_size() * CLEANUP_FREE // 100) - sdcard.SdCard.get_free_size()
+
+	@staticmethod
+	def select(needed):
+		""" Select the older days to remove to free the bytes needed, the more recent day is never selected """
+		days = sorted(StorageQuota.days.keys())[:-1]
+		result = []
+		for day in days:
+			if needed <= 0 and len(result) > 0:
+				break
+			result.append(day)
+			needed -= StorageQuota.days[day][0]
+		return result
+
+	@staticmethod
+	async def remove_day(root, day, lock):
+		""" Remove all files of the day by batches, the lock is released between each batch """
+		removed = 0
+		path_day = root + "/" + day
+		for hour in StorageQuota.list_dir(path_day, r".*"):
+			path_hour = path_day + "/" + hour
+			filenames = [fileinfo[0] for fileinfo in filesystem.list_directory(path_hour)]
+			for i in range(0, len(filenames), DELETE_BATCH):
+				await lock.acquire()
+				try:
+					for filename in filenames[i:i+DELETE_BATCH]:
+						filesystem.remove(path_hour + "/" + filename)
+						removed += 1
+				finally:
+					lock.release()
+				await uasyncio.sleep_ms(1)
+			StorageQuota.remove_dir(path_hour)
+
+		# Remove the day directory, and the month and year if empty
+		for directory in [path_day, root + "/" + day[:7], root + "/" + day[:4]]:
+			StorageQuota.remove_dir(directory)
+
+		if day in StorageQuota.days:
+			del StorageQuota.days[day]
+			StorageQuota.modified[0] = True
+		return removed
+
+	@staticmethod
+	def remove_dir(directory):
+		""" Remove the directory if empty """
+		try:
+			uos.rmdir(directory)
+		except Exception:
+			pass
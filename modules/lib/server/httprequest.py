@@ -11,6 +11,7 @@ It may sound a bit more complicated, but it's a lot quick.
 """
 import hashlib
 import time
+import struct
 from binascii import hexlify, b2a_base64
 import collections
 import server.stream
@@ -39,6 +40,7 @@ MIMES = {\
 	b".png"   : b"image/png",
 	b".gif"   : b"image/gif",
 	b".jpeg"  : b"image/jpeg",
+	b".mjpeg" : b"image/jpeg",
 	b".svg"   : b"image/svg+xml",
 	b".ico"   : b"image/x-icon",
 	b".bin"   : b"application/octet-stream"
@@ -369,15 +371,19 @@ class ContentFile:
 		if filesystem.exists(filename):
 			with open(strings.tostrings(filename), "rb") as f:
 				found = True
-				result = await streamio.write(b'Content-Type: %s\r\n\r\n'%(self.content_type))
+				f.seek(0,2)
+				size = f.tell()
+				f.seek(0)
+				# The length is known only for a single binary file
+				if self.base64 is False and len(self.filenames) == 1:
+					result = await streamio.write(b'Content-Type: %s\r\nContent-Length: %d\r\n\r\n'%(self.content_type, size))
+				else:
+					result = await streamio.write(b'Content-Type: %s\r\n\r\n'%(self.content_type))
 				if server.stream.Bufferedio.is_enough_memory():
 					step = 1440*10
 				else:
 					step = 512
 				buf = bytearray(step)
-				f.seek(0,2)
-				size = f.tell()
-				f.seek(0)
 
 				if self.base64 and step % 3 != 0:
 					step = (step//3)*3
@@ -420,6 +426,71 @@ class ContentFile:
 			result += await streamio.write(b"File %s not found"%strings.tobytes(filename))
 		return result
 
+class ContentPackedFiles:
+	""" Class that contains a list of files sent in one response, each file is preceded by its length (unsigned 32 bits big endian) """
+	def __init__(self, filenames, content_type=b"application/octet-stream"):
+		""" Constructor """
+		self.filenames = filenames
+		self.content_type = content_type
+		self.buffers = None
+
+	def load(self, max_size):
+		""" Read the files in memory, to send them after the release of resources which protect the files.
+		The files which exceed the maximal size are not kept, the response contains less files than requested """
+		self.buffers = []
+		total = 0
+		for filename in self.filenames:
+			filename = strings.tostrings(filename)
+			if filesystem.exists(filename):
+				if total + filesystem.filesize(filename) > max_size and len(self.buffers) > 0:
+					break
+				with open(filename, "rb") as file:
+					buffer = file.read()
+			else:
+				buffer = b""
+			total += len(buffer)
+			self.buffers.append(buffer)
+		self.filenames = self.filenames[:len(self.buffers)]
+
+	async def serialize(self, streamio):
+		""" Serialize all files, the length of a file not found is 0 """
+		if self.buffers is not None:
+			result = await streamio.write(b'Content-Type: %s\r\nContent-Length: %d\r\n\r\n'%(self.content_type, sum([len(buffer) for buffer in self.buffers]) + 4*len(self.buffers)))
+			for buffer in self.buffers:
+				result += await streamio.write(struct.pack(">I", len(buffer)))
+				if len(buffer) > 0:
+					result += await streamio.write(buffer)
+			return result
+
+		sizes = []
+		for filename in self.filenames:
+			filename = strings.tostrings(filename)
+			sizes.append(filesystem.filesize(filename) if filesystem.exists(filename) else 0)
+		result = await streamio.write(b'Content-Type: %s\r\nContent-Length: %d\r\n\r\n'%(self.content_type, sum(sizes) + 4*len(sizes)))
+		if server.stream.Bufferedio.is_enough_memory():
+			step = 1440*10
+		else:
+			step = 512
+		buf = bytearray(step)
+		for i in range(len(self.filenames)):
+			size = sizes[i]
+			result += await streamio.write(struct.pack(">I", size))
+			if size > 0:
+				with open(strings.tostrings(self.filenames[i]), "rb") as file:
+					while size > 0:
+						length = file.readinto(buf if size >= step else memoryview(buf)[:size])
+						if length == 0:
+							break
+						result += await streamio.write(buf if length == step else buf[:length])
+						size -= length
+				# The file was truncated during the sending, it is padded to respect the announced length
+				if size > 0:
+					zeros = bytes(min(size, step))
+					while size > 0:
+						result += await streamio.write(zeros if size >= len(zeros) else zeros[:size])
+						size -= len(zeros)
+		return result
+
 class ContentBuffer:
 	""" Class that contains a buffer """
 	def __init__(self, filename, buffer, content_type=None):
@@ -546,6 +617,10 @@ class HttpResponse(Http):
 			content = strings.tobytes(logger.exception(err))
 		return await self.send_error(status=b"404", content=content)
 
+	async def send_not_modified(self, headers=None):
+		""" Send not modified, the client web browser can use its cache """
+		return await self.send(status=b"304", headers=headers)
+
 	async def send_ok(self, content=None):
 		""" Send ok to the client web browser """
 		return await self.send_error(status=b"200", content=content)
@@ -50,6 +50,15 @@ def meminfo():
 		result = lang.no_information
 	return result
 
+def mem_free():
+	""" Get the current free memory, returns None if not available """
+	import gc
+	try:
+		# pylint: disable=no-member
+		return gc.mem_free()
+	except:
+		return None
+
 def memdump():
 	""" Dump memory allocated """
 	if filesystem.ismicropython():
@@ -61,6 +61,10 @@ notification_state                      =b"Notify state change"
 suspends_motion_detection               =b"Suspends motion detection on the presence of an occupant"
 permanent_detection                     =b"Permanently archive all motion detections including in the presence of an occupant"
 turn_on_flash                           =b"Turn on the led flash when the light goes down"
+mask_profile                            =b"Name of mask profile modified (empty for the default mask)"
+mask_presence                           =b"Mask profile used when an occupant is present"
+mask_schedule                           =b"Mask profiles by schedule (HH:MM-HH:MM=profile, separated by commas)"
+detection_rate                          =b"Current detection rate"
 pushover_on                             =b"Pushover notification on"
 pushover_off                            =b"Pushover notification off"
 notification_configuration              =b"Notification configuration"
@@ -66,6 +66,10 @@ notification_state                      =b"Notifier changement \xC3\xA9tat"
 suspends_motion_detection               =b"Suspendre la d\xC3\xA9tection de mouvement en pr\xC3\xA9sence d'occupants"
 permanent_detection                     =b"Archiver en permanence toutes les d\xC3\xA9tection de mouvements y compris en pr\xC3\xA9sence d'occupants"
 turn_on_flash                           =b"Allumer le flash LED lorsque la lumi\xC3\xA8re baisse"
+mask_profile                            =b"Nom du profil de masque modifi\xC3\xA9 (vide pour le masque par d\xC3\xA9faut)"
+mask_presence                           =b"Profil de masque utilis\xC3\xA9 en pr\xC3\xA9sence d'un occupant"
+mask_schedule                           =b"Profils de masque par horaire (HH:MM-HH:MM=profil, s\xC3\xA9par\xC3\xA9s par des virgules)"
+detection_rate                          =b"Cadence de d\xC3\xA9tection actuelle"
 pushover_on                             =b"Notification pushover activ\xC3\xA9e"
 pushover_off                            =b"Notification pushover d\xC3\xA9sactiv\xC3\xA9e"
 notification_configuration              =b"Configuration notification"
@@ -0,0 +1,78 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Reader/writer lock for uasyncio, with the measure of the waiting times """
+import uasyncio
+from tools import strings
+
+class RwLock:
+	""" Lock shared by several readers, or exclusive for one writer. The writers waiting have priority over the new readers """
+	def __init__(self):
+		""" Constructor """
+		self.readers = 0
+		self.writer = False
+		self.writers_waiting = 0
+		self.event = uasyncio.Event()
+		self.counters = {
+			"read"         : 0,
+			"read_wait_ms" : 0,
+			"read_max_ms"  : 0,
+			"write"        : 0,
+			"write_wait_ms": 0,
+			"write_max_ms" : 0,
+		}
+
+	async def wait(self):
+		""" Wait a change of lock state """
+		self.event.clear()
+		await self.event.wait()
+
+	def measure(self, kind, start):
+		""" Measure the waiting time of lock """
+		duration = strings.ticks() - start
+		self.counters[kind] += 1
+		self.counters[kind + "_wait_ms"] += duration
+		if duration > self.counters[kind + "_max_ms"]:
+			self.counters[kind + "_max_ms"] = duration
+
+	async def acquire_read(self):
+		""" Acquire the lock shared with the other readers """
+		start = strings.ticks()
+		while self.writer or self.writers_waiting > 0:
+			await self.wait()
+		self.readers += 1
+		self.measure("read", start)
+
+	def release_read(self):
+		""" Release the lock shared """
+		self.readers -= 1
+		if self.readers == 0:
+			self.event.set()
+
+	async def acquire(self):
+		""" Acquire the lock exclusive """
+		start = strings.ticks()
+		self.writers_waiting += 1
+		try:
+			while self.writer or self.readers > 0:
+				await self.wait()
+		finally:
+			self.writers_waiting -= 1
+		self.writer = True
+		self.measure("write", start)
+
+	def release(self):
+		""" Release the lock exclusive """
+		self.writer = False
+		self.event.set()
+
+	def locked(self):
+		""" Indicates if the lock is acquired by a writer or readers """
+		return self.writer or self.readers > 0
+
+	def get_counters(self):
+		""" Get the counters of lock """
+		result = self.counters.copy()
+		result["readers"] = self.readers
+		result["writers_waiting"] = self.writers_waiting
+		return result
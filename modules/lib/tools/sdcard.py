@@ -246,7 +246,9 @@ class SdCard:
 			file = None
 			if SdCard.is_not_enough_space(low=True) is False:
 				try:
-					file = SdCard.create_file(SdCard.get_mountpoint() + "/" + directory, filename, "w")
+					# Binary mode required for bytes on desktop
+					mode = "wb" if type(data) in (type(b""), type(bytearray())) else "w"
+					file = SdCard.create_file(SdCard.get_mountpoint() + "/" + directory, filename, mode)
 					file.write(data)
 					file.close()
 					result = True
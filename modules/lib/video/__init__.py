@@ -2,3 +2,4 @@
 # Copyright (c) 2021 Remi BERTHOLET
 """ Class to manage the camera of the ESP32CAM """
 from video.video import *
+from video.framehub import *
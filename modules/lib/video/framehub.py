@@ -0,0 +1,322 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+# pylint:disable=consider-using-f-string
+""" Hub which captures each frame of the camera once and distributes it to all streaming clients.
+When the motion detection is running, it publishes its frames in the hub, else the hub captures the frames itself.
+The latest frame is kept a short time for the snapshots """
+import random
+import uasyncio
+from video.video import Camera,CameraConfig,OWNER_STREAMING
+from tools import logger,strings,filesystem
+
+FEED_TIMEOUT   = 5000
+FRAME_INTERVAL = 100
+TARGET_FPS     = 10
+STALL_DURATION = 2000
+STEP_UP        = 3
+STEP_DOWN      = 20
+STEP_QUALITY   = 8
+MAX_LEVEL      = 4
+GET_TIMEOUT    = 5000
+SNAPSHOT_TTL   = 3000
+SNAPSHOT_WAIT  = 3000
+FRAMESIZES     = [b"1600x1200",b"1280x1024",b"1024x768",b"800x600",b"640x480",b"400x296",b"320x240",b"240x176",b"160x120"]
+
+class Subscriber:
+	""" Slot of one client, only the latest frame is kept : a slow client drops frames instead of stalling the capture.
+	The frames are paced according to the throughput measured on the client link, each level of degradation of the client lengthens its interval between frames """
+	def __init__(self, name, fps=TARGET_FPS):
+		""" Constructor """
+		self.name = name
+		self.frame = None
+		self.event = uasyncio.Event()
+		self.received = 0
+		self.dropped = 0
+		self.closed = False
+		self.budget = 1000 // max(1, fps)
+		self.throughput = 0
+		self.sent = 0
+		self.stalled = 0
+		self.level = 0
+		self.slow = 0
+		self.fast = 0
+		self.next_frame = 0
+
+	def put(self, frame):
+		""" Put the latest frame, the previous not yet read is dropped """
+		if self.frame is not None:
+			self.dropped += 1
+		self.frame = frame
+		self.received += 1
+		self.event.set()
+
+	async def get(self, timeout=GET_TIMEOUT):
+		""" Wait and get the latest frame, returns None if the subscriber is closed or if no frame received before the timeout in milliseconds """
+		if self.frame is None and self.closed is False:
+			self.event.clear()
+			try:
+				await uasyncio.wait_for_ms(self.event.wait(), timeout)
+			except uasyncio.TimeoutError:
+				pass
+		frame = self.frame
+		self.frame = None
+		return frame
+
+	async def pace(self):
+		""" Wait the time of next frame to not exceed the target fps or the throughput of link """
+		delay = self.next_frame - strings.ticks()
+		if delay > 0:
+			await uasyncio.sleep_ms(delay)
+		else:
+			# Let the other tasks run
+			await uasyncio.sleep_ms(0)
+
+	def get_interval(self):
+		""" Get the interval in milliseconds between two frames of this client, according to its level """
+		return self.budget * (1 + self.level)
+
+	def measure(self, length, duration):
+		""" Measure the throughput of link with the duration in milliseconds of the sending of a frame """
+		self.sent += 1
+		self.throughput = (self.throughput*3 + (length * 1000) // max(1, duration))//4
+		self.next_frame = strings.ticks() + max(0, self.get_interval() - duration)
+
+		# If the link stalled, the frame kept is too old, the next captured is waited
+		if duration >= STALL_DURATION:
+			self.stalled += 1
+			if self.frame is not None:
+				self.frame = None
+				self.dropped += 1
+
+		# The sending takes more than twice the interval of frames : the frames of this client are spaced out
+		if duration > self.get_interval() * 2:
+			self.fast = 0
+			self.slow += 1
+			if self.slow >= STEP_UP and self.level < MAX_LEVEL:
+				self.level += 1
+				self.slow = 0
+		# The sending takes less than half the interval of previous level : the frames of this client are brought closer
+		elif duration < (self.budget * max(1, self.level)) // 2:
+			self.slow = 0
+			self.fast += 1
+			if self.fast >= STEP_DOWN and self.level > 0:
+				self.level -= 1
+				self.fast = 0
+		else:
+			self.slow = 0
+			self.fast = 0
+
+	def close(self):
+		""" Close the subscriber and wake up the reader """
+		self.closed = True
+		self.frame = None
+		self.event.set()
+
+class FrameHub:
+	""" Singleton class which distributes the frames of camera to the subscribers """
+	subscribers = []
+	task = [None]
+	last_feed = [None]
+	feeding = [False]
+	capturing = [False]
+	config = [None]
+	durty = [False]
+	level = [0]
+	last_frame = [None]
+	last_time = [0]
+	frame_id = [random.getrandbits(30)]
+	snapshot_waiting = [False]
+	snapshot_lock = uasyncio.Lock()
+	counters = {"published":0, "captured":0, "fed":0, "snapshot":0, "snapshot_captured":0}
+
+	@staticmethod
+	def set_config(config):
+		""" Set the camera configuration used when the hub captures the frames itself """
+		FrameHub.config[0] = config
+		FrameHub.durty[0] = True
+
+	@staticmethod
+	def get_config():
+		""" Get the camera configuration used when the hub captures the frames itself """
+		return FrameHub.config[0]
+
+	@staticmethod
+	def get_level():
+		""" Get the level of degradation of the frames captured by the hub, it is the lowest of subscribers to not penalize the fast links.
+		This level is only used for the capture, each subscriber is paced with its own level """
+		level = None
+		for subscriber in FrameHub.subscribers:
+			if level is None or subscriber.level < level:
+				level = subscriber.level
+		return 0 if level is None else level
+
+	@staticmethod
+	def get_stepped_config(config, level):
+		""" Get the camera configuration with the resolution and the quality decreased according to the level """
+		if level == 0:
+			return config
+		result = CameraConfig()
+		for name in ["activated","pixformat","brightness","contrast","saturation","hmirror","vflip","flash_level"]:
+			setattr(result, name, getattr(config, name))
+		result.quality = min(63, config.quality + level * STEP_QUALITY)
+		if config.framesize in FRAMESIZES:
+			result.framesize = FRAMESIZES[min(len(FRAMESIZES)-1, FRAMESIZES.index(config.framesize) + level)]
+		else:
+			result.framesize = config.framesize
+		return result
+
+	@staticmethod
+	def subscribe(name, fps=TARGET_FPS):
+		""" Add a subscriber and start the capture task if not yet started """
+		subscriber = Subscriber(name, fps)
+		FrameHub.subscribers.append(subscriber)
+		if FrameHub.task[0] is None:
+			FrameHub.task[0] = uasyncio.create_task(FrameHub.capture_task())
+		return subscriber
+
+	@staticmethod
+	def unsubscribe(subscriber):
+		""" Remove a subscriber """
+		if subscriber in FrameHub.subscribers:
+			FrameHub.subscribers.remove(subscriber)
+		subscriber.close()
+
+	@staticmethod
+	def close_subscribers():
+		""" Close all subscribers, their clients stop to wait the frames """
+		for subscriber in FrameHub.subscribers:
+			subscriber.close()
+		FrameHub.subscribers.clear()
+
+	@staticmethod
+	def has_subscribers():
+		""" Indicates if at least one client waits the frames """
+		return len(FrameHub.subscribers) > 0
+
+	@staticmethod
+	def publish(frame):
+		""" Distribute the frame to all subscribers, and keep it for the snapshots """
+		FrameHub.counters["published"] += 1
+		FrameHub.last_frame[0] = frame
+		FrameHub.last_time[0] = strings.ticks()
+		FrameHub.frame_id[0] += 1
+		for subscriber in FrameHub.subscribers:
+			subscriber.put(frame)
+
+	@staticmethod
+	def set_feeding(state):
+		""" Indicates if the motion detection runs and publishes its frames """
+		if state and FrameHub.feeding[0] is False:
+			FrameHub.last_feed[0] = strings.ticks()
+		FrameHub.feeding[0] = state
+
+	@staticmethod
+	def feed(motion):
+		""" Publish the frame captured by the motion detection, the image is copied only if a client waits it """
+		FrameHub.last_feed[0] = strings.ticks()
+		# The motion detection changed the camera configuration
+		FrameHub.capturing[0] = False
+		if motion is not None and (len(FrameHub.subscribers) > 0 or FrameHub.snapshot_waiting[0]):
+			FrameHub.counters["fed"] += 1
+			FrameHub.publish(motion.get_image())
+			# The snapshot waiting is served, the next frames are no longer copied for it
+			FrameHub.snapshot_waiting[0] = False
+
+	@staticmethod
+	def is_fed():
+		""" Indicates if the motion detection publishes its frames """
+		if FrameHub.feeding[0] is False or FrameHub.last_feed[0] is None:
+			return False
+		return strings.ticks() - FrameHub.last_feed[0] < FEED_TIMEOUT
+
+	@staticmethod
+	async def capture():
+		""" Capture a frame with the streaming configuration when the motion detection does not run """
+		reserved = await Camera.reserve(FrameHub, timeout=1)
+		try:
+			if reserved:
+				Camera.open()
+				level = FrameHub.get_level()
+				if (FrameHub.durty[0] or FrameHub.capturing[0] is False or FrameHub.level[0] != level) and FrameHub.config[0] is not None:
+					Camera.configure(FrameHub.get_stepped_config(FrameHub.config[0], level), OWNER_STREAMING)
+					FrameHub.durty[0] = False
+					FrameHub.level[0] = level
+				FrameHub.capturing[0] = True
+				image = await Camera.capture()
+				if image is not None:
+					FrameHub.counters["captured"] += 1
+					FrameHub.publish(image)
+		finally:
+			if reserved:
+				await Camera.unreserve(FrameHub)
+
+	@staticmethod
+	def is_fresh():
+		""" Indicates if the latest frame is younger than the time to live """
+		return FrameHub.last_frame[0] is not None and strings.ticks() - FrameHub.last_time[0] < SNAPSHOT_TTL
+
+	@staticmethod
+	def get_etag():
+		""" Get the etag of the latest frame """
+		return b'"%08x"'%FrameHub.frame_id[0]
+
+	@staticmethod
+	async def get_snapshot():
+		""" Get the latest frame, if it is too old the next frame of motion detection is waited or a single capture is done.
+		Returns None if the camera failed """
+		FrameHub.counters["snapshot"] += 1
+		await FrameHub.snapshot_lock.acquire()
+		try:
+			# If the frame was renewed while waiting the lock, it is shared
+			if FrameHub.is_fresh() is False:
+				# Wait the next frame of motion detection, it is copied only while a snapshot waits
+				FrameHub.snapshot_waiting[0] = True
+				start = strings.ticks()
+				while FrameHub.is_fed() and FrameHub.is_fresh() is False and strings.ticks() - start < SNAPSHOT_WAIT:
+					await uasyncio.sleep_ms(FRAME_INTERVAL)
+				FrameHub.snapshot_waiting[0] = False
+
+				# If the motion detection does not run or is too slow
+				if FrameHub.is_fresh() is False:
+					FrameHub.counters["snapshot_captured"] += 1
+					await FrameHub.capture()
+		finally:
+			FrameHub.snapshot_lock.release()
+		# The capture failed or timed out, an old frame is not served
+		if FrameHub.is_fresh() is False:
+			return None
+		return FrameHub.last_frame[0]
+
+	@staticmethod
+	async def capture_task():
+		""" Task which captures the frames while subscribers exist and the motion detection does not publish its frames """
+		try:
+			while len(FrameHub.subscribers) > 0:
+				if FrameHub.is_fed():
+					FrameHub.capturing[0] = False
+					await uasyncio.sleep_ms(FRAME_INTERVAL)
+				else:
+					await FrameHub.capture()
+					if filesystem.ismicropython():
+						await uasyncio.sleep_ms(0)
+					else:
+						await uasyncio.sleep_ms(FRAME_INTERVAL)
+		except Exception as err:
+			logger.syslog(err)
+		finally:
+			FrameHub.close_subscribers()
+			FrameHub.capturing[0] = False
+			FrameHub.task[0] = None
+
+	@staticmethod
+	def get_counters():
+		""" Get the counters of hub """
+		result = FrameHub.counters.copy()
+		result["subscribers"] = len(FrameHub.subscribers)
+		result["level"] = FrameHub.level[0]
+		result["dropped"] = 0
+		result["stalled"] = 0
+		for subscriber in FrameHub.subscribers:
+			result["dropped"] += subscriber.dropped
+			result["stalled"] += subscriber.stalled
+		return result
@@ -9,10 +9,19 @@ as well as a lot of adjustment on the camera, not available on the other firmwar
 # pylint: disable=multiple-statements
 import time
 import uasyncio
-from tools import info,system,jsonconfig,logger
+from tools import info,jsonconfig,logger,strings
 if info.iscamera():
 	import camera
 
+RETRY_MAX          = 5
+RETRY_DELAY        = 50
+BREAKER_RATE       = 50
+BREAKER_DURATION   = 5000
+BREAKER_MAX        = 60000
+STAT_CAMERA        = 20000
+OWNER_MOTION       = "motion"
+OWNER_STREAMING    = "streaming"
+
 class CameraConfig(jsonconfig.JsonConfig):
 	""" Class that collects the camera rendering configuration """
 	def __init__(self):
@@ -112,9 +121,17 @@ class Camera:
 	opened = False
 	lock = uasyncio.Lock()
 	modified = [False]
-	success = [0]
-	failed  = [0]
-	newFailed = [0]
+	# Shadow of the settings programmed on the sensor, and the owner of each
+	settings = {}
+	owners = {}
+	counters = {"success":0, "failed":0, "retried":0, "new_failed":0, "lost":0, "breaker_opened":0, "breaker_refused":0, "settings_applied":0, "settings_skipped":0, "reinit_failed":0}
+	# Failure rate in percent, with exponential moving average
+	failure_rate = [0]
+	# Circuit breaker : end of opening in ticks and duration of next opening
+	breaker_end = [None]
+	breaker_duration = [BREAKER_DURATION]
+	# The reinitialization failed, the camera stays closed until the breaker allows a new try
+	broken = [False]
 	config = None
 
 	@staticmethod
@@ -203,7 +220,10 @@ class Camera:
 		Camera.get_config()
 		if Camera.is_activated():
 			result = True
-			if Camera.opened is False:
+			if Camera.broken[0]:
+				# The circuit breaker tries again the reinitialization
+				result = False
+			elif Camera.opened is False:
 				for i in range(10):
 					res = camera.init()
 					if res is False:
@@ -218,6 +238,7 @@ class Camera:
 				if result:
 					# Photo on 800x600, motion detection / 8 (100x75), each square detection 8x8 (12.5 x 9.375)
 					Camera.opened = True
+					Camera.clear_settings()
 		else:
 			result = False
 		return result
@@ -225,14 +246,22 @@ class Camera:
 	@staticmethod
 	def get_stat():
 		""" Statistic """
-		return Camera.success[0], Camera.failed[0]
+		return Camera.counters["success"], Camera.counters["failed"]
 
 	@staticmethod
 	def reset_stat():
 		""" Reset statistic """
-		Camera.success[0] = 0
-		Camera.failed [0] = 0
-		Camera.newFailed[0] = 0
+		Camera.counters["success"] = 0
+		Camera.counters["failed"] = 0
+		Camera.counters["new_failed"] = 0
+
+	@staticmethod
+	def get_counters():
+		""" Get the counters of camera captures """
+		result = Camera.counters.copy()
+		result["failure_rate"] = Camera.failure_rate[0]
+		result["breaker_open"] = Camera.breaker_end[0] is not None
+		return result
 
 	@staticmethod
 	def close():
@@ -240,6 +269,8 @@ class Camera:
 		if Camera.opened is True:
 			camera.deinit()
 			Camera.opened = False
+			Camera.clear_settings()
+		Camera.broken[0] = False
 
 	@staticmethod
 	def is_opened():
@@ -247,15 +278,15 @@ class Camera:
 		return Camera.opened
 
 	@staticmethod
-	def capture():
-		""" Capture an image on the camera """
-		return Camera.retry(camera.capture)
+	async def capture():
+		""" Capture an image on the camera, returns None if the camera failed """
+		return await Camera.retry(camera.capture)
 
 	@staticmethod
-	def motion():
-		""" Get the motion informations.
+	async def motion():
+		""" Get the motion informations, returns None if the camera failed.
 		This contains a jpeg image, with matrices of the different color RGB """
-		return Camera.retry(camera.motion)
+		return await Camera.retry(camera.motion)
 
 	@staticmethod
 	def flash(level=0):
@@ -263,38 +294,97 @@ class Camera:
 		camera.flash(level)
 
 	@staticmethod
-	def retry(callback):
-		""" Retry camera action and manage error """
+	def is_available():
+		""" Indicates if the circuit breaker allows the capture """
+		if Camera.breaker_end[0] is None:
+			return True
+		# When the opening duration elapsed, one capture is tried
+		return strings.ticks() >= Camera.breaker_end[0]
+
+	@staticmethod
+	async def retry(callback):
+		""" Retry camera action with an exponential backoff which lets the other tasks run.
+		When the failure rate is too high, the circuit breaker refuses the captures during a while and the camera is reinitialized """
 		result = None
+		if Camera.broken[0] and Camera.is_available():
+			# The previous reinitialization failed, it is tried again when the opening of breaker elapsed
+			Camera.reinit()
+			if Camera.broken[0]:
+				Camera.update_breaker(False)
 		if Camera.opened:
-			retry = 10
-			while 1:
-				if retry <= 0:
-					system.reboot("Reboot forced after camera problem")
+			if Camera.is_available() is False:
+				Camera.counters["breaker_refused"] += 1
+				return None
+
+			delay = RETRY_DELAY
+			for retry in range(RETRY_MAX):
 				try:
 					result = callback()
-					Camera.success[0] += 1
+					Camera.counters["success"] += 1
 					break
 				except ValueError:
-					Camera.failed[0] += 1
-					Camera.newFailed[0] += 1
-					if retry <= 3:
-						logger.syslog("Failed to get image %d retry before reset"%retry)
-					retry -= 1
-					time.sleep(0.5)
-			total = Camera.success[0] + Camera.failed[0]
-			STAT_CAMERA=20000
-			if (total % STAT_CAMERA) == 0:
-				if Camera.success[0] != 0:
-					newFailed = 100.-((Camera.newFailed[0]*100)/STAT_CAMERA)
-					failed    = 100.-((Camera.failed[0]*100)/total)
-				else:
-					newFailed = 0.
-					failed    = 0.
-				logger.syslog("Camera stat : last %-3.1f%%, total %-3.1f%% success on %d"%(newFailed, failed, total))
-				Camera.newFailed[0] = 0
+					Camera.counters["failed"] += 1
+					Camera.counters["new_failed"] += 1
+					if retry < RETRY_MAX - 1:
+						Camera.counters["retried"] += 1
+						await uasyncio.sleep_ms(delay)
+						delay *= 2
+			Camera.update_breaker(result is not None)
+			Camera.log_stat()
 		return result
 
+	@staticmethod
+	def update_breaker(success):
+		""" Update the failure rate and the state of circuit breaker """
+		if success:
+			Camera.failure_rate[0] = (Camera.failure_rate[0]*7)//8
+			if Camera.breaker_end[0] is not None:
+				logger.syslog("Camera recovered")
+			Camera.breaker_end[0] = None
+			Camera.breaker_duration[0] = BREAKER_DURATION
+		else:
+			Camera.counters["lost"] += 1
+			Camera.failure_rate[0] = (Camera.failure_rate[0]*7 + 100)//8
+			# If the failure rate too high or the capture tried after an opening failed
+			if Camera.failure_rate[0] >= BREAKER_RATE or Camera.breaker_end[0] is not None:
+				Camera.counters["breaker_opened"] += 1
+				logger.syslog("Camera failed, captures suspended %d s"%(Camera.breaker_duration[0]//1000))
+				Camera.breaker_end[0] = strings.ticks() + Camera.breaker_duration[0]
+				Camera.breaker_duration[0] = min(Camera.breaker_duration[0]*2, BREAKER_MAX)
+				if Camera.broken[0] is False:
+					Camera.reinit()
+
+	@staticmethod
+	def reinit():
+		""" Reinitialize the camera after failures, if it failed the camera is closed to be initialized again on the next try """
+		if Camera.opened or Camera.broken[0]:
+			camera.deinit()
+			# The sensor restarted with its default settings, they must be restored
+			Camera.clear_settings()
+			Camera.modified[0] = True
+			if camera.init() is False:
+				logger.syslog("Camera not reinitialized")
+				Camera.counters["reinit_failed"] += 1
+				Camera.opened = False
+				Camera.broken[0] = True
+			else:
+				Camera.opened = True
+				Camera.broken[0] = False
+
+	@staticmethod
+	def log_stat():
+		""" Log the statistic of captures """
+		total = Camera.counters["success"] + Camera.counters["failed"]
+		if total > 0 and (total % STAT_CAMERA) == 0:
+			if Camera.counters["success"] != 0:
+				new_failed = 100.-((Camera.counters["new_failed"]*100)/STAT_CAMERA)
+				failed     = 100.-((Camera.counters["failed"]*100)/total)
+			else:
+				new_failed = 0.
+				failed     = 0.
+			logger.syslog("Camera stat : last %-3.1f%%, total %-3.1f%% success on %d"%(new_failed, failed, total))
+			Camera.counters["new_failed"] = 0
+
 	@staticmethod
 	async def reserve(object_, timeout=0, suspension=None):
 		""" Reserve the camera, is used to stream the output of the camera
@@ -308,7 +398,7 @@ class Camera:
 
 	@staticmethod
 	def is_modified():
-		""" Indicates that the camera configuration has been changed """
+		""" Indicates that the camera configuration has been changed by another owner than the motion detection """
 		return Camera.modified[0]
 
 	@staticmethod
@@ -317,10 +407,48 @@ class Camera:
 		Camera.modified[0] = False
 
 	@staticmethod
-	def framesize(resolution):
+	def clear_settings():
+		""" Forget the settings applied, the sensor was reset with its default values """
+		Camera.settings.clear()
+		Camera.owners.clear()
+
+	@staticmethod
+	def get_owner(name):
+		""" Get the owner of the last change of a setting """
+		return Camera.owners.get(name, None)
+
+	@staticmethod
+	def set(name, value, setter, owner=None):
+		""" Apply the setting on the sensor only if its value changed.
+		Returns True if the sensor was programmed """
+		result = False
+		if Camera.opened:
+			if name in Camera.settings and Camera.settings[name] == value:
+				Camera.counters["settings_skipped"] += 1
+			else:
+				setter()
+				Camera.settings[name] = value
+				Camera.owners[name] = owner
+				Camera.counters["settings_applied"] += 1
+				if owner != OWNER_MOTION:
+					Camera.modified[0] = True
+				result = True
+		return result
+
+	@staticmethod
+	def apply(settings, owner=None):
+		""" Apply a batch of settings [(name, value),...], only the settings changed are programmed on the sensor.
+		Returns the number of settings changed """
+		result = 0
+		for name, value in settings:
+			if getattr(Camera, name)(value, owner):
+				result += 1
+		return result
+
+	@staticmethod
+	def framesize(resolution, owner=None):
 		""" Configure the frame size """
 		val = None
-		Camera.modified[0] = True
 		if resolution == b"UXGA"  or resolution == b"1600x1200" :val = camera.FRAMESIZE_UXGA
 		if resolution == b"SXGA"  or resolution == b"1280x1024" :val = camera.FRAMESIZE_SXGA
 		if resolution == b"XGA"   or resolution == b"1024x768"  :val = camera.FRAMESIZE_XGA
@@ -330,16 +458,13 @@ class Camera:
 		if resolution == b"QVGA"  or resolution == b"320x240"   :val = camera.FRAMESIZE_QVGA
 		if resolution == b"HQVGA" or resolution == b"240x176"   :val = camera.FRAMESIZE_HQVGA
 		if resolution == b"QQVGA" or resolution == b"160x120"   :val = camera.FRAMESIZE_QQVGA
-		if Camera.opened and val is not None:
-			# print("Framesize %s"%strings.tostrings(resolution))
-			camera.framesize(val)
-		# else:
-			# print("Framesize not set")
+		if val is not None:
+			return Camera.set("framesize", val, lambda: camera.framesize(val), owner)
+		return False
 
 	@staticmethod
-	def pixformat(format_):
+	def pixformat(format_, owner=None):
 		""" Change the format of image """
-		Camera.modified[0] = True
 		val = None
 		if format_ == b"RGB565"    : val=camera.PIXFORMAT_RGB565
 		if format_ == b"YUV422"    : val=camera.PIXFORMAT_YUV422
@@ -349,88 +474,68 @@ class Camera:
 		if format_ == b"RAW"       : val=camera.PIXFORMAT_RAW
 		if format_ == b"RGB444"    : val=camera.PIXFORMAT_RGB444
 		if format_ == b"RGB555"    : val=camera.PIXFORMAT_RGB555
-		if Camera.opened and val is not None:
-			# print("Pixformat %s"%strings.tostrings(format_))
-			camera.pixformat(val)
-		# else:
-			# print("Pixformat not set")
+		if val is not None:
+			return Camera.set("pixformat", val, lambda: camera.pixformat(val), owner)
+		return False
 
 	@staticmethod
-	def quality(val=None, modified=True):
+	def register(name, callback, val, owner):
+		""" Set a register of sensor if changed, or get its value if val is None """
+		if val is None:
+			if Camera.opened:
+				return callback()
+			return None
+		return Camera.set(name, val, lambda: callback(val), owner)
+
+	@staticmethod
+	def quality(val=None, owner=None):
 		""" Configure the compression """
-		Camera.modified[0] = modified
-		if Camera.opened:
-			# print("Quality %d"%val)
-			return camera.quality(val)
-		return None
+		return Camera.register("quality", camera.quality, val, owner)
 
 	@staticmethod
-	def brightness(val=None):
+	def brightness(val=None, owner=None):
 		""" Change the brightness """
-		Camera.modified[0] = True
-		if Camera.opened:
-			# print("Brightness %d"%val)
-			return camera.brightness(val)
-		return None
+		return Camera.register("brightness", camera.brightness, val, owner)
 
 	@staticmethod
-	def contrast(val=None):
+	def contrast(val=None, owner=None):
 		""" Change the contrast """
-		Camera.modified[0] = True
-		if Camera.opened:
-			# print("Contrast %d"%val)
-			return camera.contrast(val)
-		return None
+		return Camera.register("contrast", camera.contrast, val, owner)
 
 	@staticmethod
-	def saturation(val=None):
+	def saturation(val=None, owner=None):
 		""" Change the saturation """
-		Camera.modified[0] = True
-		if Camera.opened:
-			# print("Saturation %d"%val)
-			return camera.saturation(val)
-		return None
+		return Camera.register("saturation", camera.saturation, val, owner)
 
 	@staticmethod
-	def sharpness(val=None):
+	def sharpness(val=None, owner=None):
 		""" Change the sharpness """
-		Camera.modified[0] = True
-		if Camera.opened:
-			# print("Sharpness %d"%val)
-			return camera.sharpness(val)
-		return None
+		return Camera.register("sharpness", camera.sharpness, val, owner)
 
 	@staticmethod
-	def hmirror(val=None):
+	def hmirror(val=None, owner=None):
 		""" Set horizontal mirroring """
-		Camera.modified[0] = True
-		if Camera.opened:
-			# print("Hmirror %d"%val)
-			return camera.hmirror(val)
-		return None
+		return Camera.register("hmirror", camera.hmirror, val, owner)
 
 	@staticmethod
-	def vflip(val=None):
+	def vflip(val=None, owner=None):
 		""" Set the vertical flip """
-		Camera.modified[0] = True
-		if Camera.opened:
-			# print("Vflip %d"%val)
-			return camera.vflip(val)
-		return None
+		return Camera.register("vflip", camera.vflip, val, owner)
 
 	@staticmethod
-	def configure(config):
-		""" Configure the camera """
+	def configure(config, owner=None):
+		""" Configure the camera, only the settings changed are programmed on the sensor """
 		if Camera.opened:
-			Camera.pixformat (config.pixformat)
-			Camera.framesize (config.framesize)
-			Camera.quality   (config.quality)
-			Camera.brightness(config.brightness)
-			Camera.contrast  (config.contrast)
-			Camera.saturation(config.saturation)
-			Camera.hmirror   (config.hmirror)
-			Camera.vflip     (config.vflip)
-			Camera.flash     (config.flash_level)
+			Camera.apply([
+				("pixformat",  config.pixformat),
+				("framesize",  config.framesize),
+				("quality",    config.quality),
+				("brightness", config.brightness),
+				("contrast",   config.contrast),
+				("saturation", config.saturation),
+				("hmirror",    config.hmirror),
+				("vflip",      config.vflip)], owner)
+			Camera.flash(config.flash_level)
 
 	@staticmethod
 	def get_config():
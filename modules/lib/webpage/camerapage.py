@@ -6,7 +6,7 @@ from server.httprequest    import *
 from htmltemplate          import *
 from webpage.mainpage      import main_frame
 from webpage.streamingpage import *
-from video                 import Camera
+from video                 import Camera,FrameHub
 from tools                 import lang,info
 
 @HttpServer.add_route(b'/camera', menu=lang.menu_camera, item=lang.item_camera, available=info.iscamera() and Camera.is_activated())
@@ -45,6 +45,22 @@ async def camera_configure(request, response, args):
 	Streaming.activity()
 	await response.send_ok()
 
+@HttpServer.add_route(b'/camera/snapshot.jpg', available=info.iscamera() and Camera.is_activated())
+async def camera_snapshot(request, response, args):
+	""" Send the latest frame captured, shared with the motion detection and the streaming """
+	try:
+		image = await FrameHub.get_snapshot()
+		# The camera is not available
+		if image is None:
+			await response.send_error(b"503")
+		# If the frame not changed since the last request of client
+		elif request.get_header(b"If-None-Match") == FrameHub.get_etag():
+			await response.send_not_modified(headers={b"ETag":FrameHub.get_etag()})
+		else:
+			await response.send_buffer(b"snapshot.jpg", image, headers={b"ETag":FrameHub.get_etag(), b"Cache-Control":b"no-cache", b"Content-Length":b"%d"%len(image)})
+	except Exception as err:
+		await response.send_not_found(err)
+
 @HttpServer.add_route(b'/camera/onoff', menu=lang.menu_camera, item=lang.item_onoff, available=info.iscamera())
 async def camera_on_off(request, response, args):
 	""" Camera command page """
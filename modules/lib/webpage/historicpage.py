@@ -7,9 +7,14 @@ from server.server         import Server
 from htmltemplate          import *
 from webpage.mainpage      import main_frame
 from webpage.streamingpage import Streaming
-from motion                import Historic
+from server.httprequest    import ContentPackedFiles
+from motion                import Historic, MAX_MOTIONS
 from video                 import Camera
-from tools                 import lang,info, strings
+from tools                 import lang,info, strings, filesystem
+
+MAX_BATCH_SIZE = 256*1024
+MAX_FILE_SIZE  = 128*1024
+MEMORY_MARGIN  = 64*1024
 
 def get_days_pagination(last_days, request):
 	""" Get the pagination html part of days """
@@ -68,7 +73,7 @@ async def historic(request, response, args):
 	""" Historic motion detection page """
 	Streaming.stop()
 	Historic.get_root()
-	last_days = await Historic.get_last_days()
+	last_days = await Historic.get_days()
 	pagination_begin, pagination_end,current_day = get_days_pagination(last_days, request)
 
 	if pagination_end is not None and pagination_begin is not None:
@@ -95,11 +100,12 @@ async def historic(request, response, args):
 			window.onload = load_historic;
 
 			var current_day = '%s';
+			const PAGE_LENGTH = 100;
 
-			var historic = null;
+			var historic = [];
 			var last_id = 0;
+			var page_complete = false;
 			var historic_request = new XMLHttpRequest();
-			var image_request    = new XMLHttpRequest();
 
 			const MOTION_FILENAME =0;
 			const MOTION_WIDTH    =1;
@@ -111,7 +117,7 @@ async def historic(request, response, args):
 			function load_historic()
 			{
 				historic_request.onreadystatechange = historic_loaded;
-				historic_request.open("GET","historic/historic.json",true);
+				historic_request.open("GET","historic/historic.json?day=" + encodeURIComponent(current_day) + "&offset=" + historic.length + "&limit=" + PAGE_LENGTH,true);
 				historic_request.send();
 			}
 
@@ -121,22 +127,73 @@ async def historic(request, response, args):
 				{
 					if (historic_request.status === 200)
 					{
-						historic = JSON.parse(historic_request.responseText);
-						select_day();
-						load_image();
+						var motions = JSON.parse(historic_request.responseText);
+						for (var i = 0; i < motions.length; i++)
+						{
+							motions[i][MOTION_DIFFS] = decode_diffs(motions[i]);
+						}
+						page_complete = motions.length == PAGE_LENGTH;
+						if (motions.length > 0)
+						{
+							load_images(historic.length, motions.length);
+						}
+						historic = historic.concat(motions);
 					}
 				}
 			}
 
-			function load_image()
+			// Load all images of the page in one request, each image is preceded by its length (32 bits big endian)
+			function load_images(offset, count)
 			{
-				if (historic.length > 0)
+				fetch("/historic/batch?day=" + encodeURIComponent(current_day) + "&offset=" + offset + "&limit=" + count + "&thumbnails=1")
+				.then(response =>
 				{
-					var motion = historic[last_id];
-					image_request.onreadystatechange = image_loaded;
-					image_request.open("GET","/historic/images/" + motion[MOTION_FILENAME],true);
-					image_request.send();
-				}
+					var reader  = response.body.getReader();
+					var pending = new Uint8Array(0);
+					var received = 0;
+
+					function read_images()
+					{
+						reader.read().then(({done, value}) =>
+						{
+							if (value)
+							{
+								var merged = new Uint8Array(pending.length + value.length);
+								merged.set(pending);
+								merged.set(value, pending.length);
+								pending = merged;
+								while (pending.length >= 4)
+								{
+									var length = new DataView(pending.buffer, pending.byteOffset, 4).getUint32(0);
+									if (pending.length < 4 + length)
+									{
+										break;
+									}
+									add_image(new Blob([pending.slice(4, 4 + length)], {type:"image/jpeg"}));
+									pending = pending.slice(4 + length);
+									received += 1;
+								}
+							}
+							if (done)
+							{
+								// The response is limited by the memory of device, the next images are requested
+								if (received > 0 && received < count)
+								{
+									load_images(offset + received, count - received);
+								}
+								else if (page_complete)
+								{
+									setTimeout(load_historic, 1);
+								}
+							}
+							else
+							{
+								read_images();
+							}
+						});
+					}
+					read_images();
+				});
 			}
 
 			function rtrim(x, characters)
@@ -161,29 +218,6 @@ async def historic(request, response, args):
 				return x.substr(start);
 			}
 
-			function get_day(id)
-			{
-				var filename = historic[id][MOTION_FILENAME];
-				filename = ltrim(filename, "/");
-				filename = filename.split("/");
-				return filename[1]+"/"+filename[2]+"/"+filename[3];
-			}
-
-			function select_day()
-			{
-				if (historic.length > 0)
-				{
-					for (i = 0; i < historic.length; i++)
-					{
-						if (get_day(i) == current_day)
-						{
-							last_id = i;
-							break;
-						}
-					}
-				}
-			}
-
 			function get_quality()
 			{
 				if (/iPhone|iPad|iPod|Android/i.test(navigator.userAgent))
@@ -196,62 +230,86 @@ async def historic(request, response, args):
 				}
 			}
 
-			function image_loaded()
+			function add_image(blob)
 			{
-				if (image_request.readyState === XMLHttpRequest.DONE)
+				// Empty image if the file not found
+				if (blob.size > 0)
 				{
-					if (image_request.status === 200)
-					{
-						var motion = historic[last_id];
-
-						var div = document.createElement("div");
-							div.className = "col-lg-2  pb-1";
-
-							var canvas = document.createElement("canvas");
-								canvas.width     = motion[MOTION_WIDTH ] * get_quality();
-								canvas.height    = motion[MOTION_HEIGHT] * get_quality();
-								canvas.id        = last_id;
-								canvas.className = "w-100";
-								canvas.setAttribute("data-bs-toggle","modal");
-								canvas.setAttribute("data-bs-target","#zoom_window");
-								canvas.onclick = e => 
+					var motion = historic[last_id];
+
+					var div = document.createElement("div");
+						div.className = "col-lg-2  pb-1";
+
+						var canvas = document.createElement("canvas");
+							canvas.width     = motion[MOTION_WIDTH ] * get_quality();
+							canvas.height    = motion[MOTION_HEIGHT] * get_quality();
+							canvas.id        = last_id;
+							canvas.className = "w-100";
+							canvas.setAttribute("data-bs-toggle","modal");
+							canvas.setAttribute("data-bs-target","#zoom_window");
+							canvas.onclick = e => 
+								{
+									var view = document.getElementById('zoom_image');
+									var destCtx = view.getContext('2d');
+									view.width     = motion[MOTION_WIDTH ] * get_quality();
+									view.height    = motion[MOTION_HEIGHT] * get_quality();
+
+									// Show the thumbnail, and replace it by the full image when loaded
+									destCtx.drawImage(canvas, 0, 0);
+									fetch("/historic/images/" + motion[MOTION_FILENAME])
+									.then(response => response.blob())
+									.then(blob =>
 									{
-										var view = document.getElementById('zoom_image');
-										var destCtx = view.getContext('2d');
-										view.width     = motion[MOTION_WIDTH ] * get_quality();
-										view.height    = motion[MOTION_HEIGHT] * get_quality();
+										var full = new Image();
+											full.src    = URL.createObjectURL(blob);
+											full.onload = function(){show_motion(canvas.id, full, view); URL.revokeObjectURL(full.src);};
+									});
+								};
 
-										destCtx.drawImage(canvas, 0, 0);
-									};
+						var image = new Image();
+							image.src        = URL.createObjectURL(blob);
+							image.onload     = function(){show_motion(canvas.id, image); URL.revokeObjectURL(image.src);};
 
-							var image = new Image();
-								image.src        = 'data:image/jpeg;base64,' + image_request.response;
-								image.onload     = function(){show_motion(canvas.id, image);};
+						div.appendChild(canvas);
 
-							div.appendChild(canvas);
+					if (last_id == 0)
+					{
+						document.getElementById('motions').replaceChildren(div);
+					}
+					else
+					{
+						document.getElementById('motions').appendChild(div);
+					}
+				}
+				last_id = last_id + 1;
+			}
 
-						if (last_id == 0)
-						{
-							document.getElementById('motions').replaceChildren(div);
-						}
-						else
+			// Decode the run length encoded differences ("R" followed by the hexadecimal lengths of runs without and with difference)
+			// into a string with one character by square
+			function decode_diffs(motion)
+			{
+				var diffs = motion[MOTION_DIFFS];
+				if (typeof diffs === 'string' && diffs.startsWith("R"))
+				{
+					var squares = (motion[MOTION_WIDTH]/motion[MOTION_SQUAREX]) * (motion[MOTION_HEIGHT]/motion[MOTION_SQUAREY]);
+					var result = "";
+					var square = " ";
+					if (diffs.length > 1)
+					{
+						var runs = diffs.substr(1).split(",");
+						for (var run = 0; run < runs.length; run++)
 						{
-							document.getElementById('motions').appendChild(div);
-						}
-						last_id = last_id + 1;
-						if (last_id < historic.length-1)
-						{
-							if (get_day(last_id) == current_day)
-							{
-								setTimeout(load_image, 1);
-							}
+							result += square.repeat(parseInt(runs[run], 16));
+							square = (square == " ") ? "#" : " ";
 						}
 					}
-					else 
+					if (result.length < squares)
 					{
-						setTimeout(load_image, 1);
+						result += " ".repeat(squares - result.length);
 					}
+					return result;
 				}
+				return diffs;
 			}
 
 			function get_difference(motion, x, y)
@@ -280,13 +338,16 @@ async def historic(request, response, args):
 				}
 			}
 
-			function show_motion(id, image)
+			function show_motion(id, image, canvas)
 			{
 				var x;
 				var y;
 
 				var motion = historic[id];
-				var canvas = document.getElementById(id);
+				if (canvas === undefined)
+				{
+					canvas = document.getElementById(id);
+				}
 				var ctx = canvas.getContext('2d');
 
 				var squarex = motion[MOTION_SQUAREX] * get_quality();
@@ -294,7 +355,8 @@ async def historic(request, response, args):
 				var maxx = (motion[MOTION_WIDTH] /squarex) * get_quality();
 				var maxy = (motion[MOTION_HEIGHT]/squarey) * get_quality();
 
-				ctx.drawImage(image, 0, 0, motion[MOTION_WIDTH ]  , motion[MOTION_HEIGHT], 0, 0, motion[MOTION_WIDTH ] * get_quality(), motion[MOTION_HEIGHT] * get_quality());
+				// The image can be the thumbnail or the full image
+				ctx.drawImage(image, 0, 0, motion[MOTION_WIDTH ] * get_quality(), motion[MOTION_HEIGHT] * get_quality());
 
 				ctx.strokeStyle = "red";
 				ctx.lineWidth =  1 * get_quality();
@@ -391,41 +453,93 @@ async def historic(request, response, args):
 
 @HttpServer.add_route(b'/historic/historic.json', available=info.iscamera() and Camera.is_activated())
 async def historic_json(request, response, args):
-	""" Send historic json file """
+	""" Send historic json file, all the historic or only a part of the motions of one day """
 	Server.slow_down()
 	try:
-		await response.send_buffer(b"historic.json", await Historic.get_json())
+		# If the historic not changed since the last request of browser
+		if request.get_header(b"If-None-Match") == Historic.get_etag():
+			await response.send_not_modified(headers={b"ETag":Historic.get_etag()})
+		else:
+			day = request.params.get(b"day", None)
+			if day is None:
+				content = await Historic.get_json()
+			else:
+				offset = int(request.params.get(b"offset", b"0"))
+				limit  = int(request.params.get(b"limit",  b"%d"%MAX_MOTIONS))
+				content = await Historic.get_day_json(day, offset, limit)
+			await response.send_buffer(b"historic.json", content, headers={b"ETag":Historic.get_etag(), b"Cache-Control":b"no-cache"})
 	except Exception as err:
 		await response.send_not_found(err)
 
-@HttpServer.add_route(b'/historic/images/.*', available=info.iscamera() and Camera.is_activated())
-async def historic_image(request, response, args):
-	""" Send historic image """
+def get_load_size(maximum):
+	""" Get the bytes which can be loaded in memory, according to the current free memory with a margin for the other tasks """
+	free = info.mem_free()
+	if free is None:
+		return maximum
+	return max(0, min(maximum, (free - MEMORY_MARGIN)//2))
+
+@HttpServer.add_route(b'/historic/batch', available=info.iscamera() and Camera.is_activated())
+async def historic_batch(request, response, args):
+	""" Send the images or the thumbnails of a part of the motions of one day in one response.
+	The files are read before the sending to not keep the camera reserved during the transfer """
 	Server.slow_down()
+	content = None
 	reserved = await Camera.reserve(Historic, timeout=5, suspension=15)
 	try:
 		if reserved:
-			await Historic.acquire()
-			await response.send_file(strings.tostrings(request.path[len("/historic/images/"):]), base64=True)
-		else:
-			await response.send_not_found()
+			await Historic.acquire_shared()
+			day    = request.params.get(b"day", b"")
+			offset = int(request.params.get(b"offset", b"0"))
+			limit  = int(request.params.get(b"limit",  b"%d"%MAX_MOTIONS))
+			thumbnails = request.params.get(b"thumbnails", b"0") == b"1"
+			filenames = []
+			for item in Historic.get_day_items(day, offset, limit):
+				filenames.append(Historic.get_thumbnail(item[0]) if thumbnails else item[0])
+			content = ContentPackedFiles(filenames)
+			# The size loaded depends on the memory free now, at least one file is sent to let the client progress
+			content.load(get_load_size(MAX_BATCH_SIZE))
 	finally:
 		if reserved:
-			await Historic.release()
+			await Historic.release_shared()
 			await Camera.unreserve(Historic)
+	if content is not None:
+		await response.send(content=content, headers={b"Cache-Control":b"no-cache"})
+	else:
+		await response.send_not_found()
 
-@HttpServer.add_route(b'/historic/download/.*', available=info.iscamera() and Camera.is_activated())
-async def download_image(request, response, args):
-	""" Download historic image """
-	Server.slow_down()
+async def send_historic_file(response, filename, headers=None):
+	""" Send a file of historic, it is read with the camera reserved and the historic lock shared, both are released before the sending.
+	A file too large to be loaded in memory is sent without lock, the files of historic never change """
+	buffer = None
 	reserved = await Camera.reserve(Historic, timeout=5, suspension=15)
 	try:
 		if reserved:
-			await Historic.acquire()
-			await response.send_file(strings.tostrings(request.path[len("/historic/download/"):]), base64=False)
-		else:
-			await response.send_not_found()
+			await Historic.acquire_shared()
+			try:
+				if filesystem.exists(filename) and filesystem.filesize(filename) <= get_load_size(MAX_FILE_SIZE):
+					with open(filename, "rb") as file:
+						buffer = file.read()
+			finally:
+				await Historic.release_shared()
 	finally:
 		if reserved:
-			await Historic.release()
 			await Camera.unreserve(Historic)
+	if reserved is False:
+		await response.send_not_found()
+	elif buffer is not None:
+		await response.send_buffer(filename, buffer, headers=headers)
+	else:
+		await response.send_file(filename, base64=False, headers=headers)
+
+@HttpServer.add_route(b'/historic/images/.*', available=info.iscamera() and Camera.is_activated())
+async def historic_image(request, response, args):
+	""" Send historic image """
+	Server.slow_down()
+	# The images of historic never change, the browser can keep them in its cache
+	await send_historic_file(response, strings.tostrings(request.path[len("/historic/images/"):]), headers={b"Cache-Control":b"max-age=86400, immutable"})
+
+@HttpServer.add_route(b'/historic/download/.*', available=info.iscamera() and Camera.is_activated())
+async def download_image(request, response, args):
+	""" Download historic image """
+	Server.slow_down()
+	await send_historic_file(response, strings.tostrings(request.path[len("/historic/download/"):]))
@@ -6,13 +6,20 @@ from htmltemplate          import *
 from webpage.mainpage      import main_frame, manage_default_button
 from webpage.streamingpage import *
 from video                 import CameraConfig, Camera
-from motion                import SnapConfig, MotionConfig
+from motion                import SnapConfig, MotionConfig, MotionMask, DetectionScheduler
 import uasyncio
 from tools                 import lang, info
 
 zone_config = CameraConfig()
 
-def zone_masking(config, disabled):
+def get_detection_rate():
+	""" Return the current rate of motion detection """
+	status = DetectionScheduler.get_status()
+	if status is None:
+		return b"-"
+	return b"%.1f images/s, interval %d ms, cost %d ms, lag %d ms"%(status["rate"], status["interval"], status["cost"], status["lag"])
+
+def zone_masking(mask, disabled):
 	""" displays an html page to hide certain area of the camera, in order to ignore movements """
 	_ = SnapConfig.get()
 
@@ -84,6 +91,57 @@ def zone_masking(config, disabled):
 			
 				var initMask='%s';
 				var disabled = %d;
+				var maskWidth = %d;
+				var maskHeight = %d;
+
+				function decodeMask(mask)
+				{
+					var bits = [];
+					if (mask.startsWith("1;"))
+					{
+						var hexa = mask.split(";")[2];
+						for (word = 0; word * 8 < hexa.length; word ++)
+						{
+							var value = parseInt(hexa.substr(word*8, 8), 16);
+							for (bit = 31; bit >= 0; bit --)
+							{
+								bits.push((value >>> bit) & 1);
+							}
+						}
+					}
+					else
+					{
+						for (id = 0; id < mask.length; id ++)
+						{
+							bits.push(mask.charAt(id) == "/" ? 1 : 0);
+						}
+					}
+					return bits;
+				}
+
+				function encodeMask(bits)
+				{
+					var hexa = "";
+					var empty = true;
+					for (word = 0; word * 32 < bits.length; word ++)
+					{
+						var value = 0;
+						for (bit = 0; bit < 32; bit ++)
+						{
+							value = value * 2 + (bits[word*32 + bit] ? 1 : 0);
+						}
+						if (value != 0)
+						{
+							empty = false;
+						}
+						hexa += ("00000000" + value.toString(16)).slice(-8);
+					}
+					if (empty)
+					{
+						return "";
+					}
+					return "1;" + maskWidth + "x" + maskHeight + ";" + hexa;
+				}
 				function check(box)
 				{
 					if (pressed)
@@ -104,6 +162,7 @@ def zone_masking(config, disabled):
 				function onLoadZoneMasking()
 				{
 					var table = document.getElementById("zone_masking");
+					var maskBits = decodeMask(initMask);
 					var id = 0;
 					for (line = 0; line < %d; line ++)
 					{
@@ -111,7 +170,7 @@ def zone_masking(config, disabled):
 						for (column = 0; column < %d; column ++)
 						{
 							var tag = 'type="checkbox" class="zoneMask" onmousemove="check(this)" id="'+id+'"';
-							if (initMask.charAt(id) == "/")
+							if (maskBits[id])
 							{
 								tag += " checked ";
 							}
@@ -127,20 +186,12 @@ def zone_masking(config, disabled):
 				}
 				function onValidZoneMasking()
 				{
-					var result = ""
+					var bits = [];
 					for (id = 0; id < %d; id ++)
 					{
-						var cell = document.getElementById(id);
-						if (cell.checked)
-						{
-							result += "/";
-						}
-						else
-						{
-							result += " ";
-						}
+						bits.push(document.getElementById(id).checked ? 1 : 0);
 					}
-					document.getElementById('mask').value = result;
+					document.getElementById('mask').value = encodeMask(bits);
 				}
 				function onClearZoneMasking()
 				{
@@ -159,7 +210,7 @@ def zone_masking(config, disabled):
 					}
 				}
 			</script>
-"""%(buttons,maxi,config.mask,disabled,height,width,maxi,maxi,maxi))
+"""%(buttons,maxi,mask,disabled,width,height,height,width,maxi,maxi,maxi))
 	return result
 
 @HttpServer.add_route(b'/motion/config', menu=lang.menu_motion, item=lang.item_motion, available=info.iscamera() and Camera.is_activated())
@@ -171,15 +222,35 @@ async def motion(request, response, args):
 
 	# Read motion config
 	config = MotionConfig()
+	config.load()
+	default_mask = config.mask
+	profile = request.params.get(b"profile", b"")
+
+	def save_profile(request, config):
+		""" Store the mask modified in its profile, and the schedule of profiles """
+		if profile != b"":
+			config.mask_profiles[profile] = config.mask
+			config.mask = default_mask
+		config.mask_schedule = MotionMask.parse_schedule(request.params.get(b"mask_schedule", b""))
 
 	# Keep activated status
-	disabled, action, submit = manage_default_button(request, config, onclick=b"onValidZoneMasking()")
+	disabled, action, submit = manage_default_button(request, config, callback=save_profile, onclick=b"onValidZoneMasking()")
+
+	if profile != b"":
+		mask = config.mask_profiles.get(profile, b"")
+	else:
+		mask = config.mask
 
 	page = main_frame(request, response, args, lang.motion_detection_configuration,
 		Form([
 			Switch(text=lang.activated, name=b"activated", checked=config.activated, disabled=disabled),
+			Edit(text=lang.detection_rate, value=get_detection_rate(), disabled=True),
 			Streaming.get_html(request),
-			zone_masking(config, disabled),
+			zone_masking(mask, disabled),
+			# The profile selects the mask displayed and modified, it is always submitted
+			Edit(text=lang.mask_profile,  name=b"profile",       value=profile),
+			Edit(text=lang.mask_presence, name=b"mask_presence", value=config.mask_presence, disabled=disabled),
+			Edit(text=lang.mask_schedule, name=b"mask_schedule", value=MotionMask.format_schedule(config.mask_schedule), placeholder=b"08:00-18:00=day,22:00-06:00=night", disabled=disabled),
 			Slider(text=lang.detects_a_movement,          name=b"differences_detection",        min=b"1",  max=b"64", step=b"1",  value=b"%d"%config.differences_detection,         disabled=disabled),
 			Slider(text=lang.motion_detection_sensitivity,          name=b"sensitivity",        min=b"0",  max=b"100", step=b"5",  value=b"%d"%config.sensitivity,         disabled=disabled),
 			Switch(text=lang.notification_motion, name=b"notify",       checked=config.notify,       disabled=disabled),
@@ -5,43 +5,42 @@ from server.httpserver  import HttpServer
 from server.httprequest import *
 from server.server      import Server
 from htmltemplate       import *
-from video              import Camera
+from video              import Camera,FrameHub
+from video.framehub     import TARGET_FPS
 import uasyncio
-from tools              import logger,tasking,info,watchdog
+from tools              import logger,tasking,info,watchdog,strings
+
+MAX_STREAMINGS = 8
 
 class Streaming:
-	""" Management class of video streaming of the camera via an html page """
+	""" Management class of video streaming of the camera via an html page, several clients can watch at the same time """
 	streaming_id = [0]
+	streamings = []
+	actives = []
 	inactivity = [None]
-	config = [None]
-	durty = [False]
 
 	@staticmethod
 	def set_config(config):
-		""" Set current configuration """
-		Streaming.config[0] = config
-		Streaming.durty[0] = True
+		""" Set current configuration, used when the motion detection does not run """
+		FrameHub.set_config(config)
 
 	@staticmethod
 	def get_config():
 		""" Get current configuration """
-		return Streaming.config[0]
-
-	@staticmethod
-	def is_durty():
-		""" Indicates if the configuration changed """
-		return Streaming.durty[0]
-
-	@staticmethod
-	def reset_durty():
-		""" Reset the configuration changed flag """
-		Streaming.durty[0] = False
+		return FrameHub.get_config()
 
 	@staticmethod
 	def get_html(request):
 		""" Return streaming html part with javascript code """
 		Streaming.activity()
 		Streaming.streaming_id[0] += id(request)
+		Streaming.streamings.append(Streaming.streaming_id[0])
+		# Forget the older pages which do not stream, the streamings in progress are never interrupted
+		if len(Streaming.streamings) > MAX_STREAMINGS:
+			for streaming_id in Streaming.streamings:
+				if streaming_id not in Streaming.actives:
+					Streaming.streamings.remove(streaming_id)
+					break
 		return Tag(b"""
 		<p>
 			<div style="position: relative;">
@@ -64,79 +63,99 @@ class Streaming:
 
 	@staticmethod
 	def get_streaming_id():
-		""" Return the current streaming id """
+		""" Return the last streaming id """
 		return Streaming.streaming_id[0]
 
+	@staticmethod
+	def is_streaming(streaming_id):
+		""" Indicates if the streaming is still allowed """
+		return streaming_id in Streaming.streamings
+
+	@staticmethod
+	def start(streaming_id):
+		""" Start a streaming, returns False if too many clients are already streaming """
+		if len(Streaming.actives) >= MAX_STREAMINGS:
+			return False
+		Streaming.actives.append(streaming_id)
+		return True
+
+	@staticmethod
+	def end(streaming_id):
+		""" End a streaming """
+		if streaming_id in Streaming.actives:
+			Streaming.actives.remove(streaming_id)
+
 	@staticmethod
 	def stop():
-		""" Stop streaming """
+		""" Stop all streamings """
 		Streaming.streaming_id[0] += 1
+		Streaming.streamings.clear()
+		FrameHub.close_subscribers()
 
 @HttpServer.add_route(b'/camera/start', available=info.iscamera() and Camera.is_activated())
 async def camera_start_streaming(request, response, args):
-	""" Start video streaming """
+	""" Start video streaming, the frames are shared with the other clients and the motion detection """
 	Server.slow_down()
 	if request.name != "StreamingServer":
 		return
 
+	subscriber = None
+	writer = None
+	currentstreaming_id = None
 	try:
-		writer = None
 		currentstreaming_id = int(request.params[b"streaming_id"])
-		reserved = await Camera.reserve(request, timeout=20, suspension=15)
-		if reserved:
-			failed = False
-			Camera.open()
-
-			response.set_status(b"200")
-			response.set_header(b"Content-Type"               ,b"multipart/x-mixed-replace")
-			response.set_header(b"Transfer-Encoding"          ,b"chunked")
-			response.set_header(b"Access-Control-Allow-Origin",b"*")
-
-			await response.serialize(response.streamio)
-			writer = response.streamio
-			identifier = b"\r\n%x\r\n\r\n--%s\r\n\r\n"%(len(response.identifier) + 6, response.identifier)
-			frame = b'%s36\r\nContent-Type: image/jpeg\r\nContent-Length: %8d\r\n\r\n\r\n%x\r\n'
-
-			if filesystem.ismicropython():
-				micropython = True
-			else:
-				micropython = False
-
-			if Streaming.is_durty():
-				Camera.configure(Streaming.get_config())
-				Streaming.reset_durty()
-
-			image = Camera.capture()
+		# Too many clients already streaming, the new one is rejected
+		if Streaming.start(currentstreaming_id) is False:
+			currentstreaming_id = None
+			await response.send_error(b"503")
+			return
+		subscriber = FrameHub.subscribe(id(request), int(request.params.get(b"fps", b"%d"%TARGET_FPS)))
+
+		response.set_status(b"200")
+		response.set_header(b"Content-Type"               ,b"multipart/x-mixed-replace")
+		response.set_header(b"Transfer-Encoding"          ,b"chunked")
+		response.set_header(b"Access-Control-Allow-Origin",b"*")
+
+		await response.serialize(response.streamio)
+		writer = response.streamio
+		identifier = b"\r\n%x\r\n\r\n--%s\r\n\r\n"%(len(response.identifier) + 6, response.identifier)
+		frame = b'%s36\r\nContent-Type: image/jpeg\r\nContent-Length: %8d\r\n\r\n\r\n%x\r\n'
+
+		failed = False
+		separator = b""
+		last_image = None
+		while Streaming.is_streaming(currentstreaming_id):
+			# Wait the time of next frame according to the throughput of client
+			await subscriber.pace()
+
+			# Wait the latest frame, the frames captured during the sending are dropped
+			image = await subscriber.get()
+			if image is None:
+				if subscriber.closed:
+					break
+				# No frame captured, the last frame is sent again to detect the client disconnected
+				image = last_image
+				if image is None:
+					continue
+			last_image = image
 			length = len(image)
+			start = strings.ticks()
 			try:
-				await writer.write(frame%(b"", length, length))
+				await writer.write(frame%(separator, length, length))
 				await writer.write(image)
 			except Exception as err:
 				failed = True
-				currentstreaming_id = 0
-
-			while currentstreaming_id == Streaming.get_streaming_id():
-				if Streaming.is_durty():
-					Camera.configure(Streaming.get_config())
-					Streaming.reset_durty()
-				image = Camera.capture()
-				length = len(image)
-				try:
-					await writer.write(frame%(identifier, length, length))
-					await writer.write(image)
-				except Exception as err:
-					failed = True
-					break
-				if micropython is False:
-					await uasyncio.sleep(0.1)
-			if failed is False:
-				await writer.write(identifier)
-		else:
-			pass
+				break
+			subscriber.measure(length, strings.ticks() - start)
+			separator = identifier
+		if failed is False:
+			await writer.write(identifier)
 	except Exception as err:
 		logger.syslog(err)
 	finally:
-		if reserved:
-			await Camera.unreserve(request)
+		if currentstreaming_id is not None:
+			Streaming.end(currentstreaming_id)
+		if subscriber:
+			FrameHub.unsubscribe(subscriber)
 		if writer:
 			await writer.close()
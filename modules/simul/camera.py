@@ -1,6 +1,11 @@
 # Distributed under MIT License
 # Copyright (c) 2021 Remi BERTHOLET
 """ Simulation ESP32CAM camera class, used on desktop to debug with vscode """
+try:
+	import numpy
+except ImportError:
+	numpy = None
+import jpegdecoder
 _current = 0
 _opened = False
 _pixformat     = 0
@@ -78,17 +83,23 @@ def deinit():
 		return True
 	return False
 
+_frames = ["Test2.jpg", "Test1.jpg"]
+
+def set_frames(filenames):
+	""" Set the list of jpeg files returned in loop by the capture (used to replay recorded frames) """
+	global _frames
+	global _current
+	_frames = list(filenames)
+	_current = 0
+
 def capture():
 	""" Capture image """
 	global _opened
 	global _current
 	if _opened:
-		if _current == 0:
-			data = open("Test2.jpg","rb").read()
-			_current = 1
-		else:
-			data = open("Test1.jpg","rb").read()
-			_current = 0
+		with open(_frames[_current],"rb") as file:
+			data = file.read()
+		_current = (_current + 1) % len(_frames)
 		return data
 	return None
 
@@ -143,72 +154,235 @@ def configure(pin_pwdn = 32,
 		- flash_led          : GPIO pin for flash led or 0 to disable
 	"""
 
+MAX_LINES = 4
+MAX_HISTO = 16
+
+# Motion detection configuration shared by all motions (like the firmware)
+_motion_configuration = {
+	"errorLights":[[0,0,0,0]]*MAX_LINES,
+	"errorHistos":[[0,0,0,0]]*MAX_LINES,
+	"mask":[]
+}
+
+def _divide(numerator, denominator):
+	""" Integer division truncated toward zero like in C """
+	result = abs(numerator) // abs(denominator)
+	if (numerator < 0) != (denominator < 0):
+		result = -result
+	return result
+
+def _lines_configure(points):
+	""" Extract lines from the lists of points, returns a list of [x, y, a, b] """
+	if len(points) != MAX_LINES:
+		raise TypeError("Motions bad configure size for points")
+	lines = []
+	for i in range(len(points)):
+		x, y = points[i]
+		if i > 0:
+			previous_x, previous_y = lines[i-1][0], lines[i-1][1]
+			if x - previous_x == 0:
+				raise TypeError("Motions configure divide 0 for points")
+			a = _divide((y - previous_y) << 8, x - previous_x)
+			b = y - ((a * x) >> 8)
+		else:
+			a = 0
+			b = 0
+		lines.append([x, y, a, b])
+	return lines
+
+def _lines_get_y(lines, x):
+	""" Compute Y value according to X """
+	for i in range(1, len(lines)):
+		if x >= lines[i-1][0] and x < lines[i][0]:
+			return ((lines[i][2] * x) >> 8) + lines[i][3]
+	return 0
+
+def _lines_get_y_array(lines, x):
+	""" Compute Y values according to an array of X (numpy vectorized) """
+	conditions = []
+	choices = []
+	for i in range(1, len(lines)):
+		conditions.append((x >= lines[i-1][0]) & (x < lines[i][0]))
+		choices.append(((lines[i][2] * x) >> 8) + lines[i][3])
+	return numpy.select(conditions, choices, 0)
+
+def _pack_diffs(diffs):
+	""" Pack the differences into a list of 32 bits integers, the first square is the most significant bit """
+	result = []
+	value = 0
+	diff_max = len(diffs)
+	for i in range(diff_max):
+		if diffs[i]:
+			value |= 1
+		if i % 32 == 31:
+			result.append(value)
+			value = 0
+		else:
+			value <<= 1
+	value <<= (31 - (diff_max % 32))
+	result.append(value)
+	return result
+
 class Motion:
-	""" Class motion detection returned by the detect function """
-	size_base = [10*1024]
-	size_direction = [1]
-	def __init__(self, motion_):
-		""" Constructor of motion """
-		self.size = self.size_base[0]
-		if self.size_direction[0] == 1:
-			self.size_base[0] += 1024
-			if self.size_base[0] > 66*1024:
-				self.size_direction[0] = 0
+	""" Software motion detection, with the same behaviour as the firmware motion detection.
+	The jpeg image is decoded with the scale 1/8, and reduced into squares of light.
+	The computation is vectorized with numpy if it is installed, otherwise it is done in pure python. """
+	def __init__(self, image):
+		""" Constructor of motion with a jpeg image """
+		if image is None or type(image) not in (type(b""), type(bytearray())):
+			raise TypeError("Bad image")
+		self.image = bytes(image)
+		try:
+			width, height, rgb = jpegdecoder.decode(self.image)
+		except Exception as err:
+			raise ValueError("Camera esp_jpg_decode failed") from err
+		self.width  = width
+		self.height = height
+		self.square_x = 8 if width  % 8 == 0 else 5
+		self.square_y = 8 if height % 8 == 0 else 5
+		self.diff_width  = width  // self.square_x
+		self.diff_height = height // self.square_y
+		self.diff_max    = self.diff_width * self.diff_height
+		self.diffs = [0]*self.diff_max
+		square = self.square_x * self.square_y
+		if numpy is not None:
+			pixels = numpy.frombuffer(bytes(rgb), dtype=numpy.uint8).reshape(height, width, 3).astype(numpy.int32)
+			lights = (pixels.max(axis=2) + pixels.min(axis=2)) >> 1
+			self.histo = numpy.bincount((lights // MAX_HISTO).ravel(), minlength=MAX_HISTO)[:MAX_HISTO] // square
+			lights = lights[:self.diff_height*self.square_y, :self.diff_width*self.square_x]
+			lights = lights.reshape(self.diff_height, self.square_y, self.diff_width, self.square_x)
+			self.lights = lights.sum(axis=(1,3)).ravel() // square
+			self.max_light = int(self.lights.max())
+			self.min_light = int(self.lights.min())
 		else:
-			self.size_base[0] -= 1024
-			if self.size_base[0] < 10*1024:
-				self.size_direction[0] = 1
+			self.histo  = [0]*MAX_HISTO
+			self.lights = [0]*self.diff_max
+			index = 0
+			for y in range(height):
+				line = (y // self.square_y) * self.diff_width
+				for x in range(width):
+					red, green, blue = rgb[index], rgb[index+1], rgb[index+2]
+					index += 3
+					light = (max(red, green, blue) + min(red, green, blue)) >> 1
+					self.histo[light // MAX_HISTO] += 1
+					if y < self.diff_height*self.square_y and x < self.diff_width*self.square_x:
+						self.lights[line + x // self.square_x] += light
+			self.lights = [light // square for light in self.lights]
+			self.histo  = [histo // square for histo in self.histo]
+			self.max_light = max(self.lights)
+			self.min_light = min(self.lights)
 
 	def deinit (self):
 		""" Deinit motion """
 
+	def get_diff_histo(self, previous):
+		""" Compute the difference of histogram """
+		diff = 0
+		for i in range(MAX_HISTO):
+			diff += abs(int(self.histo[i]) - int(previous.histo[i]))
+		if diff > self.diff_max:
+			return 0
+		return 256 - ((diff << 8) // self.diff_max)
+
 	def compare(self, other):
 		""" Compare two motion detection """
+		if not isinstance(other, Motion):
+			raise TypeError("Not motion object")
+		if self.diff_max != other.diff_max:
+			return None
+		diff_histo = self.get_diff_histo(other)
+		err_histo  = _lines_get_y(_motion_configuration["errorHistos"], diff_histo)
+		mask = _motion_configuration["mask"]
+		if len(mask) != (self.diff_max + 31) // 32:
+			mask = None
+
+		if numpy is not None:
+			light = numpy.maximum(self.lights, other.lights)
+			err_light = _lines_get_y_array(_motion_configuration["errorLights"], light)
+			diffs = ((numpy.abs(self.lights - other.lights) * err_histo) >> 8) > err_light
+			if mask is not None:
+				diffs &= numpy.unpackbits(numpy.array(mask, dtype=">u4").view(numpy.uint8))[:self.diff_max] == 0
+			self.diffs = diffs.astype(numpy.uint8).tolist()
+			count = int(diffs.sum())
+		else:
+			count = 0
+			for i in range(self.diff_max):
+				light = max(self.lights[i], other.lights[i])
+				err_light = _lines_get_y(_motion_configuration["errorLights"], light)
+				if ((abs(self.lights[i] - other.lights[i]) * err_histo) >> 8) > err_light and (mask is None or (mask[i >> 5] & (0x80000000 >> (i & 31))) == 0):
+					self.diffs[i] = 1
+					count += 1
+				else:
+					self.diffs[i] = 0
+
 		return {
-			'feature': {'light': 37, 'saturation': 13},
-			'path': '2021-04-25 11-37-00',
-			'diff': {'squarex': 40, 'squarey': 40, 'width': 20, 'height': 15, 'max': 300, 'count': 0, 'light': 94, 'errhisto':256, 'diffhisto':256},
-			'index': 5417,
-			'image': '21-04-25 11-37-01 Id=5417 D=129.jpg',
-			'date': '2021-04-25 11-37-01',
-			'motion_id': 46,
-			'geometry': {'height': 600, 'width': 800}
+			"diff":
+			{
+				"count"    : count,
+				"max"      : self.diff_max,
+				"squarex"  : self.square_x*8,
+				"squarey"  : self.square_y*8,
+				"width"    : self.diff_width,
+				"height"   : self.diff_height,
+				"diffhisto": diff_histo,
+				"errhisto" : err_histo,
+				"diffs"    : _pack_diffs(self.diffs)
+			},
+			"geometry": {"width": self.width * 8, "height": self.height * 8}
 		}
 
 	def configure(self, config):
 		""" Configure motion detection """
+		if type(config) != type({}):
+			raise TypeError("Motions bad parameters")
+		_motion_configuration["errorLights"] = _lines_configure(config["errorLights"])
+		_motion_configuration["errorHistos"] = _lines_configure(config["errorHistos"])
+		# The mask is a list of 32 bits words, the first square is the most significant bit of first word
+		mask = config.get("mask", [])
+		if type(mask) not in (type([]), type(())):
+			raise TypeError("Bad mask type")
+		_motion_configuration["mask"] = [word & 0xFFFFFFFF for word in mask]
 
 	def get_image(self):
 		""" Get the image from motion """
-		return b""
+		return self.image
 
 	def get_size(self):
 		""" Get the size of image """
-		return self.size
+		return len(self.image)
 
 	def get_light(self):
 		""" Get light level """
-		return 128
+		return int(sum(self.lights)) // self.diff_max
+
+	def get_lights(self, buffer=None):
+		""" Get the light of each square in the bytearray given or in a new bytearray """
+		if buffer is None:
+			buffer = bytearray(self.diff_max)
+		elif len(buffer) != self.diff_max:
+			raise ValueError("Bad lights buffer size")
+		if numpy:
+			buffer[:] = numpy.minimum(self.lights, 255).astype(numpy.uint8).tobytes()
+		else:
+			for i in range(self.diff_max):
+				buffer[i] = min(255, int(self.lights[i]))
+		return buffer
 
 	def extract(self):
 		""" Extract the motion informations """
-		return []
-
-	def get_size(self):
-		""" Return the size of image buffer """
-		return 0
+		return [self.image, [int(light) for light in self.lights], list(self.diffs), [int(histo) for histo in self.histo]]
 
 	def get_max_light(self):
 		""" Get maximal light detected """
-		return 256
+		return self.max_light
 
 	def get_min_light(self):
 		""" Get minimal light detected """
-		return 0
+		return self.min_light
 
 def motion():
 	""" Get motion detection """
-	return Motion(None)
+	return Motion(capture())
 
 def pixformat(val=None):
 	""" Set or get pixformat """
@@ -399,6 +573,10 @@ def colorbar      (val=None):
 		_colorbar = val
 	return _colorbar
 
+def thumbnail(image, quality):
+	""" Create a thumbnail of jpeg image reduced by 4 """
+	return jpegdecoder.thumbnail(image, quality)
+
 def isavailable():
 	""" Indicates if the camera module is available or not """
 	return True
@@ -0,0 +1,324 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Simulation of the esp_jpg_decode function with the scale 1/8, used on desktop by the software motion detection.
+With this scale, each pixel is the mean of a 8x8 jpeg block, only the DC coefficient of each block is required,
+no inverse DCT is done. Pillow is used if installed, otherwise a pure python baseline jpeg decoder is used. """
+try:
+	from io import BytesIO
+	from PIL import Image
+except ImportError:
+	Image = None
+
+ZIGZAG_LENGTH = 64
+THUMBNAIL_MAX_WIDTH  = 200
+THUMBNAIL_MAX_HEIGHT = 150
+
+class HuffmanTable:
+	""" Huffman table of a jpeg file """
+	def __init__(self, counts, values):
+		""" Constructor with the number of codes for each length (1 to 16) and the values """
+		self.values = values
+		self.maxcode = [-1]*17
+		self.valptr  = [0]*17
+		self.mincode = [0]*17
+		code = 0
+		index = 0
+		for length in range(1, 17):
+			count = counts[length-1]
+			if count > 0:
+				self.valptr [length] = index
+				self.mincode[length] = code
+				code  += count
+				index += count
+				self.maxcode[length] = code - 1
+			code <<= 1
+
+class BitReader:
+	""" Read the entropy coded data bit per bit """
+	def __init__(self, data):
+		""" Constructor, the data must be unstuffed """
+		self.data = data
+		self.position = 0
+		self.accumulator = 0
+		self.bits = 0
+
+	def read_bit(self):
+		""" Read one bit """
+		if self.bits == 0:
+			if self.position < len(self.data):
+				self.accumulator = self.data[self.position]
+				self.position += 1
+			else:
+				self.accumulator = 0
+			self.bits = 8
+		self.bits -= 1
+		return (self.accumulator >> self.bits) & 1
+
+	def read_bits(self, count):
+		""" Read many bits """
+		result = 0
+		for i in range(count):
+			result = (result << 1) | self.read_bit()
+		return result
+
+	def decode(self, table):
+		""" Decode a huffman value """
+		code = 0
+		maxcode = table.maxcode
+		for length in range(1, 17):
+			code = (code << 1) | self.read_bit()
+			if code <= maxcode[length]:
+				return table.values[table.valptr[length] + code - table.mincode[length]]
+		raise ValueError("Jpeg bad huffman code")
+
+	def receive_extend(self, size):
+		""" Read a signed value of size bits """
+		if size == 0:
+			return 0
+		value = self.read_bits(size)
+		if value < (1 << (size - 1)):
+			value -= (1 << size) - 1
+		return value
+
+class Component:
+	""" Jpeg color component """
+	def __init__(self, identifier, horizontal, vertical, quantization):
+		""" Constructor """
+		self.identifier   = identifier
+		self.horizontal   = horizontal
+		self.vertical     = vertical
+		self.quantization = quantization
+		self.dc_table     = None
+		self.ac_table     = None
+		self.blocks_per_line = 0
+		self.blocks_per_column = 0
+		self.dcs          = None
+		self.predictor    = 0
+
+def unstuff(data):
+	""" Remove the stuffed bytes and split the scan on restart markers """
+	segments = []
+	segment = bytearray()
+	i = 0
+	length = len(data)
+	while i < length:
+		byte = data[i]
+		if byte == 0xFF and i + 1 < length:
+			marker = data[i+1]
+			if marker == 0x00:
+				segment.append(0xFF)
+				i += 2
+				continue
+			elif marker >= 0xD0 and marker <= 0xD7:
+				segments.append(segment)
+				segment = bytearray()
+				i += 2
+				continue
+			elif marker == 0xFF:
+				i += 1
+				continue
+			else:
+				break
+		segment.append(byte)
+		i += 1
+	segments.append(segment)
+	return segments, i
+
+def decode_python(data):
+	""" Decode the jpeg with the scale 1/8, return the width, height and a bytearray with the RGB pixels """
+	# pylint:disable=too-many-locals,too-many-branches,too-many-statements
+	quantizations = {}
+	dc_tables = {}
+	ac_tables = {}
+	components = []
+	width = height = 0
+	restart_interval = 0
+	position = 2
+	if data[0:2] != b"\xFF\xD8":
+		raise ValueError("Not a jpeg image")
+	while position < len(data):
+		if data[position] != 0xFF:
+			position += 1
+			continue
+		marker = data[position+1]
+		if marker == 0xFF:
+			position += 1
+			continue
+		if marker == 0xD9:
+			break
+		length = (data[position+2] << 8) | data[position+3]
+		segment = data[position+4:position+2+length]
+		if marker == 0xDB:
+			offset = 0
+			while offset < len(segment):
+				precision = segment[offset] >> 4
+				table_id  = segment[offset] & 0x0F
+				if precision == 0:
+					quantizations[table_id] = segment[offset+1]
+					offset += 1 + ZIGZAG_LENGTH
+				else:
+					quantizations[table_id] = (segment[offset+1] << 8) | segment[offset+2]
+					offset += 1 + ZIGZAG_LENGTH*2
+		elif marker == 0xC4:
+			offset = 0
+			while offset < len(segment):
+				table_class = segment[offset] >> 4
+				table_id    = segment[offset] & 0x0F
+				counts = segment[offset+1:offset+17]
+				total  = sum(counts)
+				values = list(segment[offset+17:offset+17+total])
+				if table_class == 0:
+					dc_tables[table_id] = HuffmanTable(counts, values)
+				else:
+					ac_tables[table_id] = HuffmanTable(counts, values)
+				offset += 17 + total
+		elif marker == 0xC0 or marker == 0xC1:
+			height = (segment[1] << 8) | segment[2]
+			width  = (segment[3] << 8) | segment[4]
+			for i in range(segment[5]):
+				offset = 6 + i*3
+				components.append(Component(segment[offset], segment[offset+1] >> 4, segment[offset+1] & 0x0F, segment[offset+2]))
+		elif marker >= 0xC2 and marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+			raise ValueError("Only baseline jpeg supported")
+		elif marker == 0xDD:
+			restart_interval = (segment[0] << 8) | segment[1]
+		elif marker == 0xDA:
+			scan_components = []
+			for i in range(segment[0]):
+				identifier = segment[1 + i*2]
+				tables     = segment[2 + i*2]
+				for component in components:
+					if component.identifier == identifier:
+						component.dc_table = dc_tables[tables >> 4]
+						component.ac_table = ac_tables[tables & 0x0F]
+						scan_components.append(component)
+			if len(scan_components) != len(components) and len(components) > 1:
+				raise ValueError("Non interleaved jpeg not supported")
+			segments, consumed = unstuff(data[position+2+length:])
+			decode_scan(width, height, components, segments, restart_interval)
+			position = position + 2 + length + consumed
+			continue
+		position += 2 + length
+
+	if width == 0 or len(components) == 0 or components[0].dcs is None:
+		raise ValueError("Jpeg decode failed")
+
+	# Convert the DC coefficients into pixels
+	scaled_width  = (width  + 7) // 8
+	scaled_height = (height + 7) // 8
+	horizontal_max = max([component.horizontal for component in components])
+	vertical_max   = max([component.vertical   for component in components])
+	planes = []
+	for component in components:
+		quantization = quantizations.get(component.quantization, 1)
+		plane = bytearray(scaled_width*scaled_height)
+		index = 0
+		for y in range(scaled_height):
+			block_y = (y * component.vertical) // vertical_max
+			line    = block_y * component.blocks_per_line
+			for x in range(scaled_width):
+				block_x = (x * component.horizontal) // horizontal_max
+				value = ((component.dcs[line + block_x] * quantization) >> 3) + 128
+				plane[index] = 0 if value < 0 else (255 if value > 255 else value)
+				index += 1
+		planes.append(plane)
+
+	rgb = bytearray(scaled_width*scaled_height*3)
+	if len(planes) >= 3:
+		luminances, blues, reds = planes[0], planes[1], planes[2]
+		for i in range(scaled_width*scaled_height):
+			luminance = luminances[i]
+			blue = blues[i] - 128
+			red  = reds[i]  - 128
+			r = luminance + ((91881 * red) >> 16)
+			g = luminance - ((22554 * blue + 46802 * red) >> 16)
+			b = luminance + ((116130 * blue) >> 16)
+			rgb[i*3  ] = 0 if r < 0 else (255 if r > 255 else r)
+			rgb[i*3+1] = 0 if g < 0 else (255 if g > 255 else g)
+			rgb[i*3+2] = 0 if b < 0 else (255 if b > 255 else b)
+	else:
+		luminances = planes[0]
+		for i in range(scaled_width*scaled_height):
+			rgb[i*3] = rgb[i*3+1] = rgb[i*3+2] = luminances[i]
+	return scaled_width, scaled_height, rgb
+
+def decode_scan(width, height, components, segments, restart_interval):
+	""" Decode the entropy coded data, only the DC coefficients are kept """
+	horizontal_max = max([component.horizontal for component in components])
+	vertical_max   = max([component.vertical   for component in components])
+	if len(components) == 1:
+		component = components[0]
+		component.horizontal = component.vertical = 1
+		horizontal_max = vertical_max = 1
+		mcus_per_line   = (width  + 7) // 8
+		mcus_per_column = (height + 7) // 8
+	else:
+		mcus_per_line   = (width  + 8*horizontal_max - 1) // (8*horizontal_max)
+		mcus_per_column = (height + 8*vertical_max   - 1) // (8*vertical_max)
+
+	for component in components:
+		component.blocks_per_line   = mcus_per_line   * component.horizontal
+		component.blocks_per_column = mcus_per_column * component.vertical
+		component.dcs = [0]*(component.blocks_per_line*component.blocks_per_column)
+		component.predictor = 0
+
+	segment_index = 0
+	reader = BitReader(segments[0])
+	mcu = 0
+	for mcu_y in range(mcus_per_column):
+		for mcu_x in range(mcus_per_line):
+			if restart_interval and mcu > 0 and mcu % restart_interval == 0:
+				segment_index += 1
+				if segment_index < len(segments):
+					reader = BitReader(segments[segment_index])
+				for component in components:
+					component.predictor = 0
+			mcu += 1
+			for component in components:
+				for block_y in range(component.vertical):
+					for block_x in range(component.horizontal):
+						# Decode the DC coefficient
+						size = reader.decode(component.dc_table)
+						component.predictor += reader.receive_extend(size)
+						row = mcu_y*component.vertical + block_y
+						column = mcu_x*component.horizontal + block_x
+						component.dcs[row*component.blocks_per_line + column] = component.predictor
+
+						# Skip all AC coefficients
+						ac_table = component.ac_table
+						k = 1
+						while k < ZIGZAG_LENGTH:
+							value = reader.decode(ac_table)
+							run  = value >> 4
+							size = value & 0x0F
+							if size == 0:
+								if run != 15:
+									break
+								k += 16
+							else:
+								k += run
+								reader.read_bits(size)
+								k += 1
+
+def decode(data):
+	""" Decode the jpeg with the scale 1/8, return the width, height and a bytearray with the RGB pixels """
+	if Image is not None:
+		image = Image.open(BytesIO(data))
+		image.draft("RGB", ((image.size[0] + 7) // 8, (image.size[1] + 7) // 8))
+		image = image.convert("RGB")
+		return image.size[0], image.size[1], bytearray(image.tobytes())
+	return decode_python(data)
+
+def thumbnail(data, quality):
+	""" Reduce the jpeg with the scale 1/4 or 1/8 by the DCT scaling of decoder, and encode it in jpeg """
+	if Image is None:
+		raise NotImplementedError("Thumbnail requires Pillow")
+	image = Image.open(BytesIO(data))
+	scale = 4
+	# The larger images are reduced by 8 to bound the duration of encoding
+	if (image.size[0] + 3) // 4 > THUMBNAIL_MAX_WIDTH or (image.size[1] + 3) // 4 > THUMBNAIL_MAX_HEIGHT:
+		scale = 8
+	image.draft("RGB", ((image.size[0] + scale - 1) // scale, (image.size[1] + scale - 1) // scale))
+	output = BytesIO()
+	image.convert("RGB").save(output, "JPEG", quality=quality)
+	return output.getvalue()
@@ -7,3 +7,7 @@ from asyncio import *
 async def sleep_ms(duration):
 	""" Sleep milliseconds """
 	await sleep(duration/1000)
+
+async def wait_for_ms(awaitable, timeout):
+	""" Wait an awaitable with a timeout in milliseconds """
+	return await wait_for(awaitable, timeout/1000)
@@ -13,6 +13,7 @@
 
 #ifdef CONFIG_ESP32CAM
 	#include "esp_camera.h"
+	#include "img_converters.h"
 #endif
 #define TAG "camera"
 
@@ -155,8 +156,8 @@ const mp_obj_type_t Motion_type;
 
 typedef struct 
 {
-	uint8_t * mask_data;
-	uint16_t  mask_length;
+	uint32_t * mask_words;
+	uint16_t   mask_count;
 	Line_t errorLights[MAX_LINES];
 	Line_t errorHistos[MAX_LINES];
 } MotionConfiguration_t;
@@ -514,6 +515,127 @@ STATIC mp_obj_t camera_decode(mp_obj_t image_in, mp_obj_t write_callback_in)
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_2(camera_decode_obj, camera_decode);
 
+// Maximal size of thumbnail, the larger images are reduced by 8 instead of 4 to bound the duration of encoding
+#define THUMBNAIL_MAX_WIDTH   200
+#define THUMBNAIL_MAX_HEIGHT  150
+#define THUMBNAIL_BUFFER_SIZE (THUMBNAIL_MAX_WIDTH * THUMBNAIL_MAX_HEIGHT * 3)
+
+// Buffer of pixels decoded, allocated with the first thumbnail and reused by the next ones
+static uint8_t * thumbnail_buffer = NULL;
+
+typedef struct 
+{
+	uint16_t       height;
+	uint16_t       width;
+	const uint8_t *input;
+	uint8_t       *output;
+	bool           tooLarge;
+} Thumbnail_t;
+
+// Write the pixels decoded in the thumbnail buffer
+static bool camera_thumbnailImage(void * arg, uint16_t x, uint16_t y, uint16_t w, uint16_t h, uint8_t *data)
+{
+	Thumbnail_t * thumbnail = (Thumbnail_t *)arg;
+
+	if(!data)
+	{
+		// First access, get the size of image and check that it holds in the buffer
+		if(x == 0 && y == 0)
+		{
+			if (w > THUMBNAIL_MAX_WIDTH || h > THUMBNAIL_MAX_HEIGHT || w * h * 3 > THUMBNAIL_BUFFER_SIZE)
+			{
+				thumbnail->tooLarge = true;
+				return false;
+			}
+			thumbnail->width  = w;
+			thumbnail->height = h;
+			thumbnail->output = thumbnail_buffer;
+		}
+	}
+	else if (thumbnail->output)
+	{
+		int Y, X;
+		uint8_t * pixel;
+		for (Y = y; Y < (y + h); Y ++)
+		{
+			pixel = &thumbnail->output[(Y * thumbnail->width + x) * 3];
+			for (X = 0; X < w; X ++) 
+			{
+				// The decoder gives the pixels in order blue, green, red
+				pixel[0] = data[X*3 + 2];
+				pixel[1] = data[X*3 + 1];
+				pixel[2] = data[X*3];
+				pixel += 3;
+			}
+			data += (w * 3);
+		}
+	}
+	return true;
+}
+
+static uint32_t camera_thumbnailRead(void * arg, size_t index, uint8_t *buf, size_t len)
+{
+	Thumbnail_t * thumbnail = (Thumbnail_t *)arg;
+	if(buf) 
+	{
+		memcpy(buf, thumbnail->input + index, len);
+	}
+	return len;
+}
+
+// Create a thumbnail of jpeg image, reduced by 4 or 8 by the jpeg decoder (only the low frequencies of DCT are used) and encoded in jpeg
+STATIC mp_obj_t camera_thumbnail(mp_obj_t image_in, mp_obj_t quality_in)
+{
+	mp_obj_t result = mp_const_none;
+	if (mp_obj_is_str_or_bytes(image_in))
+	{
+		Thumbnail_t thumbnail;
+		uint8_t * jpeg = NULL;
+		size_t jpegLength = 0;
+		GET_STR_DATA_LEN(image_in, imageData, imageLength);
+
+		if (thumbnail_buffer == NULL)
+		{
+			thumbnail_buffer = (uint8_t *)_malloc(THUMBNAIL_BUFFER_SIZE);
+		}
+
+		if (thumbnail_buffer)
+		{
+			memset(&thumbnail, 0, sizeof(thumbnail));
+			thumbnail.input = imageData;
+
+			esp_err_t ret = esp_jpg_decode(imageLength, JPG_SCALE_4X, camera_thumbnailRead, camera_thumbnailImage, (void*)&thumbnail);
+
+			// If the image reduced by 4 is too large, it is reduced by 8
+			if (ret != ESP_OK && thumbnail.tooLarge)
+			{
+				memset(&thumbnail, 0, sizeof(thumbnail));
+				thumbnail.input = imageData;
+				ret = esp_jpg_decode(imageLength, JPG_SCALE_8X, camera_thumbnailRead, camera_thumbnailImage, (void*)&thumbnail);
+			}
+
+			if (ret == ESP_OK && thumbnail.output)
+			{
+				if (fmt2jpg(thumbnail.output, thumbnail.width * thumbnail.height * 3, thumbnail.width, thumbnail.height, PIXFORMAT_RGB888, mp_obj_get_int(quality_in), &jpeg, &jpegLength))
+				{
+					result = mp_obj_new_bytes(jpeg, jpegLength);
+					free(jpeg);
+				}
+			}
+		}
+		if (result == mp_const_none)
+		{
+			mp_raise_ValueError(MP_ERROR_TEXT("Thumbnail failed"));
+		}
+	}
+	else
+	{
+		mp_raise_ValueError(MP_ERROR_TEXT("Invalid image buffer"));
+	}
+	return result;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_2(camera_thumbnail_obj, camera_thumbnail);
+
 
 STATIC mp_obj_t camera_capture()
 {
@@ -925,6 +1047,43 @@ STATIC mp_obj_t Motion_get_min_light(mp_obj_t self_in)
 }
 STATIC MP_DEFINE_CONST_FUN_OBJ_1(Motion_get_min_light_obj, Motion_get_min_light);
 
+// get_lights method, fills the bytearray given (or a new bytearray) with the light of each square, without copying the image
+STATIC mp_obj_t Motion_get_lights(size_t n_args, const mp_obj_t *args)
+{
+	Motion_t *motion = args[0];
+	mp_obj_t res = mp_const_none;
+	if (motion)
+	{
+		uint8_t * data;
+		int i;
+
+		// If a buffer is given it is reused
+		if (n_args > 1 && args[1] != mp_const_none)
+		{
+			mp_buffer_info_t bufinfo;
+			mp_get_buffer_raise(args[1], &bufinfo, MP_BUFFER_WRITE);
+			if (bufinfo.len != motion->diffMax)
+			{
+				mp_raise_ValueError(MP_ERROR_TEXT("Bad lights buffer size"));
+			}
+			data = bufinfo.buf;
+			res = args[1];
+		}
+		else
+		{
+			data = m_new(uint8_t, motion->diffMax);
+			res = mp_obj_new_bytearray_by_ref(motion->diffMax, data);
+		}
+
+		for (i = 0; i < motion->diffMax; i++)
+		{
+			data[i] = motion->lights[i] > 255 ? 255 : motion->lights[i];
+		}
+	}
+	return res;
+}
+STATIC MP_DEFINE_CONST_FUN_OBJ_VAR_BETWEEN(Motion_get_lights_obj, 1, 2, Motion_get_lights);
+
 // Check if difference detected in the current pixel
 bool Motion_isDifference(Motion_t * motion, int x, int y)
 {
@@ -1082,87 +1241,42 @@ STATIC int Motion_computeDiff(Motion_t *self, Motion_t *previous, mp_obj_t resul
 		pPreviousLights ++;
 	}
 
-	mp_obj_t diffsVal       = mp_obj_new_list(0, NULL);
-	u_int32_t diffVal = 0;
-
-	char * diffs = (char*)_malloc(sizeof(char) * self->diffMax + 1);
-	if (motionConfiguration.mask_length > 0 && motionConfiguration.mask_length == self->diffMax)
+	// Pack the differences in 32 bits words, the first square is the most significant bit.
+	// The squares masked are removed with a bitwise and of the mask words
+	mp_obj_t diffsVal = mp_obj_new_list(0, NULL);
+	int words = (self->diffMax + 31) / 32;
+	uint32_t * pMask = (motionConfiguration.mask_count == words) ? motionConfiguration.mask_words : 0;
+	int word;
+	int bit;
+	pDiffs = self->diffs;
+	for (word = 0; word < words; word++)
 	{
-		int ignored = 0;
-		uint8_t * pMask = motionConfiguration.mask_data;
-		pDiffs         = self->diffs;
-		for (i = 0; i < self->diffMax; i++)
+		uint32_t diffVal = 0;
+		for (bit = 0; bit < 32 && word * 32 + bit < self->diffMax; bit++)
 		{
-			if (*pDiffs)
-			{
-				if (*pMask == '/')
-				{
-					diffs[i] = ' ';
-					diffDetected --;
-					ignored ++;
-					*pDiffs = 0;
-					// ESP_LOGE(TAG,"ignored = %d %c %d", i, *pMask, diffDetected);
-				}
-				else
-				{
-					diffs[i] = '#';
-					diffVal |= 1;
-				}
-			}
-			else
-			{
-				diffs[i] = ' ';
-			}
-
-			if (i %32 == 31)
-			{
-				mp_obj_list_append(diffsVal, mp_obj_new_int(diffVal));
-				diffVal = 0;
-			}
-			else
+			if (pDiffs[word * 32 + bit])
 			{
-				diffVal <<= 1;
+				diffVal |= 0x80000000 >> bit;
 			}
-
-			pDiffs++;
-			pMask++;
 		}
 
-		diffVal <<= (31 - (self->diffMax%32));
-		mp_obj_list_append(diffsVal, mp_obj_new_int(diffVal));
-		//ESP_LOGE(TAG,"ignored=%d diff=%d",  ignored, diffDetected);
-	}
-	else
-	{
-		int count = 0;
-		pDiffs    = self->diffs;
-		for (i = 0; i < self->diffMax; i++)
+		if (pMask)
 		{
-			if (*pDiffs)
+			uint32_t ignored = diffVal & pMask[word];
+			if (ignored)
 			{
-				diffs[i] = '#';
-				diffVal |= 1;
-				count ++;
-			}
-			else
-			{
-				diffs[i] = ' ';
-			}
-
-			if (i %32 == 31)
-			{
-				mp_obj_list_append(diffsVal, mp_obj_new_int(diffVal));
-				diffVal = 0;
-			}
-			else
-			{
-				diffVal <<= 1;
+				diffDetected -= __builtin_popcount(ignored);
+				diffVal &= ~pMask[word];
+				for (bit = 0; bit < 32 && word * 32 + bit < self->diffMax; bit++)
+				{
+					if (ignored & (0x80000000 >> bit))
+					{
+						pDiffs[word * 32 + bit] = 0;
+					}
+				}
 			}
-
-			pDiffs++;
 		}
-		diffVal <<= (31 - (self->diffMax%32));
-		mp_obj_list_append(diffsVal, mp_obj_new_int(diffVal));
+		mp_obj_list_append(diffsVal, mp_obj_new_int_from_uint(diffVal));
 	}
 
 	mp_obj_t diffdict = mp_obj_new_dict(0);
@@ -1176,7 +1290,6 @@ STATIC int Motion_computeDiff(Motion_t *self, Motion_t *previous, mp_obj_t resul
 		mp_obj_dict_store(diffdict, mp_obj_new_str("errhisto"  , strlen("errhisto"))  ,  mp_obj_new_int(errHisto));
 		mp_obj_dict_store(diffdict, mp_obj_new_str("diffs"     , strlen("diffs"))     ,  diffsVal);
 	mp_obj_dict_store(result, mp_obj_new_str("diff"     , strlen("diff")), diffdict);
-	_free((void**)&diffs);
 	return diffDetected;
 }
 
@@ -1239,26 +1352,31 @@ STATIC mp_obj_t Motion_configure(mp_obj_t self_in, mp_obj_t params_in)
 		mp_obj_t errorHistos = mp_obj_dict_get(params_in, MP_OBJ_NEW_QSTR(MP_QSTR_errorHistos));
 		Lines_configure(errorHistos, motionConfiguration.errorHistos, MAX_LINES);
 
+		// The mask is a list of 32 bits words, the first square is the most significant bit of first word
 		mp_obj_t mask_in = mp_obj_dict_get(params_in, MP_OBJ_NEW_QSTR(MP_QSTR_mask));
-		if (mp_obj_is_str_or_bytes(mask_in))
+		if (mp_obj_is_type(mask_in, &mp_type_list) || mp_obj_is_type(mask_in, &mp_type_tuple))
 		{
-			GET_STR_DATA_LEN(mask_in, mask_data, mask_length);
-			if (motionConfiguration.mask_data)
+			size_t mask_count;
+			mp_obj_t *mask_items;
+			mp_obj_get_array(mask_in, &mask_count, &mask_items);
+			if (motionConfiguration.mask_words)
 			{
-				_free((void**)&motionConfiguration.mask_data);
-				motionConfiguration.mask_data = 0;
-				motionConfiguration.mask_length = 0;
+				_free((void**)&motionConfiguration.mask_words);
+				motionConfiguration.mask_words = 0;
+				motionConfiguration.mask_count = 0;
 			}
 
-			if (mask_length > 0)
+			if (mask_count > 0)
 			{
-				motionConfiguration.mask_data = _malloc(mask_length + 1);
-				if (motionConfiguration.mask_data)
+				motionConfiguration.mask_words = _malloc(sizeof(uint32_t) * mask_count);
+				if (motionConfiguration.mask_words)
 				{
-					memcpy(motionConfiguration.mask_data, mask_data, mask_length);
-					motionConfiguration.mask_length = mask_length;
-					motionConfiguration.mask_data[mask_length] = '\0';
-					//ESP_LOGE(TAG,"|%s|",motionConfiguration.mask_data);
+					size_t i;
+					for (i = 0; i < mask_count; i++)
+					{
+						motionConfiguration.mask_words[i] = (uint32_t)mp_obj_get_int_truncated(mask_items[i]);
+					}
+					motionConfiguration.mask_count = mask_count;
 				}
 			}
 		}
@@ -1291,6 +1409,7 @@ STATIC const mp_rom_map_elem_t Motion_locals_dict_table[] =
 	{ MP_ROM_QSTR(MP_QSTR_get_light),         MP_ROM_PTR(&Motion_get_light_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_get_min_light),     MP_ROM_PTR(&Motion_get_min_light_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_get_max_light),     MP_ROM_PTR(&Motion_get_max_light_obj) },
+	{ MP_ROM_QSTR(MP_QSTR_get_lights),        MP_ROM_PTR(&Motion_get_lights_obj) },
 };
 STATIC MP_DEFINE_CONST_DICT(Motion_locals_dict, Motion_locals_dict_table);
 
@@ -1335,6 +1454,7 @@ STATIC const mp_rom_map_elem_t camera_module_globals_table[] = {
 	{ MP_ROM_QSTR(MP_QSTR_motion             ), MP_ROM_PTR(&camera_motion_detect_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_flash              ), MP_ROM_PTR(&camera_flash_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_decode             ), MP_ROM_PTR(&camera_decode_obj) },
+	{ MP_ROM_QSTR(MP_QSTR_thumbnail          ), MP_ROM_PTR(&camera_thumbnail_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_pixformat          ), MP_ROM_PTR(&camera_pixformat_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_aec_value          ), MP_ROM_PTR(&camera_aec_value_obj) },
 	{ MP_ROM_QSTR(MP_QSTR_framesize          ), MP_ROM_PTR(&camera_framesize_obj) },
@@ -0,0 +1,21 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Configuration of unit tests, the modules are run with the simulation of micropython modules """
+import os
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(ROOT, "modules", "simul"))
+sys.path.insert(0, os.path.join(ROOT, "modules", "lib"))
+
+def pytest_configure(config):
+	""" The modules write their configuration and logs in the current directory when they are imported """
+	os.chdir(tempfile.mkdtemp(prefix="pycameresp"))
+
+@pytest.fixture(autouse=True)
+def working_directory(tmp_path, monkeypatch):
+	""" Run each test in a temporary directory, the modules write their configuration and logs in the current directory """
+	monkeypatch.chdir(tmp_path)
+	return tmp_path
@@ -0,0 +1,60 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the blobs analysis of differences grid """
+from motion.motion import label_blobs
+
+def to_words(rows):
+	""" Convert the rows of characters ('#' for difference) into the 32 bits words of bitmap """
+	bits = "".join(rows)
+	words = [0]*((len(bits) + 31) // 32)
+	for i in range(len(bits)):
+		if bits[i] == "#":
+			words[i >> 5] |= 0x80000000 >> (i & 31)
+	return words, len(rows[0]), len(rows)
+
+def test_empty():
+	""" No difference, no blob """
+	words, width, height = to_words(["....", "...."])
+	assert label_blobs(words, width, height) == []
+
+def test_separated_blobs():
+	""" The blobs are sorted by decreasing area with their bounding box """
+	words, width, height = to_words([
+		"##....#",
+		"##.....",
+		"......#",
+		"......#"])
+	assert label_blobs(words, width, height) == [[0,0,2,2,4],[6,2,1,2,2],[6,0,1,1,1]]
+
+def test_diagonal():
+	""" The squares touching by a corner are in the same blob (8-connectivity) """
+	words, width, height = to_words([
+		"#...",
+		".#..",
+		"..#.",
+		"...#"])
+	assert label_blobs(words, width, height) == [[0,0,4,4,4]]
+
+def test_merge():
+	""" A blob shaped U is labelled twice on the first rows, then merged """
+	words, width, height = to_words([
+		"#...#",
+		"#...#",
+		"#####"])
+	assert label_blobs(words, width, height) == [[0,0,5,3,9]]
+
+def test_upper_right():
+	""" The upper right neighbour joins the blobs """
+	words, width, height = to_words([
+		"..#.",
+		".#..",
+		"#..."])
+	assert label_blobs(words, width, height) == [[0,0,3,3,3]]
+
+def test_grid_across_words():
+	""" The rows are not aligned on the words """
+	rows = ["."*100 for i in range(75)]
+	rows[40] = "."*30 + "#"*10 + "."*60
+	rows[41] = "."*30 + "#"*10 + "."*60
+	words, width, height = to_words(rows)
+	assert label_blobs(words, width, height) == [[30,40,10,2,20]]
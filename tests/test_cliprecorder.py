@@ -0,0 +1,74 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the clip file of motion events """
+import struct
+import pytest
+import uasyncio
+from motion.cliprecorder import ClipRecorder, read_index, CLIP_MAGIC, MAX_PENDING_SIZE
+from motion.historic import Historic
+from motion.motion import MotionConfig
+from motion.storagequota import StorageQuota
+
+@pytest.fixture
+def recorder(tmp_path, monkeypatch):
+	""" Clip recorder writing in a temporary directory """
+	monkeypatch.setattr(Historic, "get_root", lambda: str(tmp_path))
+	monkeypatch.setattr(StorageQuota, "days", {})
+	return ClipRecorder(MotionConfig())
+
+def test_footer_and_index(recorder, tmp_path):
+	""" The clip is the concatenation of images followed by the index and the footer """
+	images = [b"\xff\xd8first\xff\xd9", b"\xff\xd8second image\xff\xd9", b"\xff\xd8third\xff\xd9"]
+	recorder.open("2026/10/01/10h00", "clip.mjpeg", 1000, {})
+	for i in range(len(images)):
+		recorder.write(images[i], 1000 + i*500)
+	recorder.close()
+
+	filename = str(tmp_path) + "/2026/10/01/10h00/clip.mjpeg"
+	with open(filename, "rb") as file:
+		content = file.read()
+	total = sum([len(image) for image in images])
+	assert content[:total] == b"".join(images)
+	assert content[-12:] == CLIP_MAGIC + struct.pack("<II", len(images), total)
+	assert len(content) == total + (len(images) + 1)*12
+
+	index = read_index(filename)
+	assert index == [(0, len(images[0]), 0), (len(images[0]), len(images[1]), 500), (len(images[0]) + len(images[1]), len(images[2]), 1000)]
+	for i in range(len(images)):
+		offset, length, duration = index[i]
+		assert content[offset:offset+length] == images[i]
+	assert StorageQuota.days["2026/10/01"] == [len(content), 1]
+	# The clip closed must be added in the historic
+	assert recorder.closed == ["2026/10/01/10h00", "clip.mjpeg", {}, None]
+
+def test_not_a_clip(tmp_path):
+	""" A file without footer is refused """
+	filename = str(tmp_path) + "/image.jpg"
+	with open(filename, "wb") as file:
+		file.write(b"\xff\xd8" + b"\x00"*20 + b"\xff\xd9")
+	with pytest.raises(ValueError):
+		read_index(filename)
+
+def test_pending_images_dropped(recorder, monkeypatch):
+	""" When the writer is late, the older images are dropped to bound the memory, the image of thumbnail is kept """
+	added = []
+	async def add_clip(path, filename, motion_info, thumbnail=None):
+		added.append((path, filename, thumbnail))
+		return True
+	monkeypatch.setattr(Historic, "add_clip", add_clip)
+	monkeypatch.setattr(Historic, "create_thumbnail", lambda image: b"thumbnail")
+	image = b"\x00"*(MAX_PENDING_SIZE // 4)
+	async def main():
+		recorder.put(["open", "2026/10/01/10h00", "clip.mjpeg", 0, {}])
+		recorder.put(["image", image, 0, True])
+		for i in range(6):
+			recorder.put(["image", image, i, False])
+		assert recorder.dropped == 3
+		assert recorder.pending_size <= MAX_PENDING_SIZE
+		assert [item[3] for item in recorder.pending[1:]] == [True, False, False, False]
+		recorder.put(["close"])
+		await recorder.flush()
+	uasyncio.run(main())
+	assert len(read_index(str(Historic.get_root()) + "/2026/10/01/10h00/clip.mjpeg")) == 4
+	assert added == [("2026/10/01/10h00", "clip.mjpeg", b"thumbnail")]
+	assert recorder.pending_size == 0
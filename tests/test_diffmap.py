@@ -0,0 +1,36 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the run length encoding of differences map """
+import random
+from motion.diffmap import DiffMap
+
+def test_round_trip():
+	""" The decoding of encoding gives the same words """
+	squares = DiffMap.get_squares(800, 600, 8, 8)
+	generator = random.Random(1)
+	for density in [0, 1, 10, 50, 100]:
+		words = [0]*((squares + 31) // 32)
+		for i in range(squares):
+			if generator.randrange(100) < density:
+				words[i >> 5] |= 0x80000000 >> (i & 31)
+		encoded = DiffMap.encode(words, squares)
+		assert DiffMap.is_encoded(encoded)
+		assert DiffMap.decode(encoded, squares) == words
+
+def test_encode():
+	""" The runs start with the squares without difference, the last run without difference is omitted """
+	assert DiffMap.encode([0], 32) == "R"
+	assert DiffMap.encode([0x80000000], 32) == "R0,1"
+	assert DiffMap.encode([0x30000000], 32) == "R2,2"
+	assert DiffMap.encode([0xFFFFFFFF, 0x80000000], 40) == "R0,21"
+
+def test_squares_not_multiple_of_word():
+	""" The bits beyond the number of squares are ignored """
+	assert DiffMap.encode([0xFFFFFFFF], 4) == "R0,4"
+	assert DiffMap.decode("R0,4", 4) == [0xF0000000]
+
+def test_legacy():
+	""" The old format with one character by square is converted """
+	legacy = " #  ##" + " "*26
+	assert DiffMap.from_legacy(legacy) == "R1,1,2,2"
+	assert DiffMap.decode(DiffMap.from_legacy(legacy), len(legacy)) == [0x4C000000]
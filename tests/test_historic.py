@@ -0,0 +1,57 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the index of historic per day """
+import pytest
+import uasyncio
+from motion.historic import Historic
+from motion.diffmap import DiffMap
+
+SQUARES = DiffMap.get_squares(800, 600, 50, 50)
+
+@pytest.fixture
+def historic(monkeypatch):
+	""" Empty historic """
+	monkeypatch.setattr(Historic, "historic", [])
+	monkeypatch.setattr(Historic, "days_index", [None])
+	monkeypatch.setattr(Historic, "json_cache", [None])
+	return Historic.historic
+
+def create_item(day, name):
+	""" Create an historic item of 800x600 with squares of 50x50 """
+	return ["sd/%s/10h00/%s"%(day, name), 800, 600, DiffMap.encode([0]*((SQUARES + 31) // 32), SQUARES), 50, 50]
+
+def get_names(day):
+	""" Get the names of motions of the day """
+	return [item[0].split("/")[-1] for item in Historic.get_day_items(day)]
+
+def test_add_item(historic):
+	""" The items added are inserted in the index built, the more recent first """
+	Historic.add_item(create_item("2026/10/01", "01.jpg"))
+	index = Historic.get_days_index()
+	Historic.add_item(create_item("2026/10/01", "03.jpg"))
+	Historic.add_item(create_item("2026/10/01", "02.jpg"))
+	Historic.add_item(create_item("2026/10/02", "01.jpg"))
+	assert Historic.get_days_index() is index
+	assert get_names("2026/10/01") == ["03.jpg", "02.jpg", "01.jpg"]
+	assert get_names("2026/10/02") == ["01.jpg"]
+	assert uasyncio.run(Historic.get_days()) == [b"2026/10/02", b"2026/10/01"]
+
+def test_reduce_history(historic, monkeypatch):
+	""" The items removed from the historic are removed from the index """
+	monkeypatch.setattr("motion.historic.MAX_MOTIONS", 2)
+	Historic.add_item(create_item("2026/10/01", "01.jpg"))
+	Historic.add_item(create_item("2026/10/02", "01.jpg"))
+	Historic.add_item(create_item("2026/10/02", "02.jpg"))
+	index = Historic.get_days_index()
+	uasyncio.run(Historic.reduce_history())
+	assert Historic.get_days_index() is index
+	assert uasyncio.run(Historic.get_days()) == [b"2026/10/02"]
+	assert get_names("2026/10/02") == ["02.jpg", "01.jpg"]
+
+def test_invalidate(historic):
+	""" The index is rebuilt after a full invalidation """
+	Historic.add_item(create_item("2026/10/01", "01.jpg"))
+	index = Historic.get_days_index()
+	Historic.invalidate()
+	assert Historic.get_days_index() is not index
+	assert get_names("2026/10/01") == ["01.jpg"]
@@ -0,0 +1,104 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the binary index of historic """
+import os
+import shutil
+import uasyncio
+import motion.historicindex
+from motion.historicindex import HistoricIndex, RECORD_SIZE, HEADER_SIZE
+from motion.diffmap import DiffMap
+from tools.rwlock import RwLock
+
+SQUARES = DiffMap.get_squares(800, 600, 50, 50)
+
+def create_item(directory, name):
+	""" Create an historic item of 800x600 with squares of 50x50 """
+	diffs = [0]*((SQUARES + 31) // 32)
+	diffs[3] = 0x00F00000
+	return [directory + "/" + name, 800, 600, DiffMap.encode(diffs, SQUARES), 50, 50]
+
+def test_pack_unpack():
+	""" The record gives back the item, with the differences run length encoded """
+	item = create_item("/sd/2026/10/01/10h00", "10h00m01s.jpg")
+	record = HistoricIndex.pack(item)
+	assert len(record) == RECORD_SIZE
+	assert HistoricIndex.unpack(record) == item
+
+def test_pack_words():
+	""" The differences can be given as words """
+	words = [0]*((SQUARES + 31) // 32)
+	words[0] = 0x80000001
+	item = ["/sd/image.jpg", 800, 600, words, 50, 50]
+	assert HistoricIndex.unpack(HistoricIndex.pack(item))[3] == DiffMap.encode(words, SQUARES)
+
+def test_pack_too_large():
+	""" The items which exceed the record are not stored """
+	assert HistoricIndex.pack(create_item("/sd", "x"*200)) is None
+	assert HistoricIndex.pack(["/sd/image.jpg", 1600, 1200, [0]*100, 8, 8]) is None
+
+def fill_index(root, days, count):
+	""" Create an index with motions in several days """
+	HistoricIndex.create(HistoricIndex.get_filename(root))
+	for day in days:
+		os.makedirs(root + "/" + day)
+		for i in range(count):
+			assert HistoricIndex.append(root, create_item(root + "/" + day, "%02d.jpg"%i))
+
+def get_names(root):
+	""" Get the names of motions in index """
+	return [item[0][len(root)+1:] for item in uasyncio.run(HistoricIndex.load(root, 1000))]
+
+def test_load(tmp_path):
+	""" The more recent records are read """
+	root = str(tmp_path)
+	fill_index(root, ["2026/10/01/10h00"], 5)
+	assert get_names(root) == ["2026/10/01/10h00/%02d.jpg"%i for i in range(5)]
+	assert len(uasyncio.run(HistoricIndex.load(root, 2))) == 2
+	assert uasyncio.run(HistoricIndex.load(root + "/nothing", 2)) is None
+
+def test_compact(tmp_path):
+	""" The records of directories removed are dropped """
+	root = str(tmp_path)
+	fill_index(root, ["2026/10/01/10h00", "2026/10/02/10h00"], 3)
+	lock = RwLock()
+	shutil.rmtree(root + "/2026/10/01")
+	uasyncio.run(HistoricIndex.compact(root, lock))
+	assert get_names(root) == ["2026/10/02/10h00/%02d.jpg"%i for i in range(3)]
+	assert os.path.getsize(HistoricIndex.get_filename(root)) == HEADER_SIZE + 3*RECORD_SIZE
+	assert lock.locked() is False
+
+def test_compact_nothing_removed(tmp_path):
+	""" The index is not rewritten if all records are kept """
+	root = str(tmp_path)
+	fill_index(root, ["2026/10/01/10h00"], 3)
+	filename = HistoricIndex.get_filename(root)
+	os.utime(filename, (0, 0))
+	uasyncio.run(HistoricIndex.compact(root, RwLock()))
+	assert os.path.getmtime(filename) == 0
+	assert os.path.exists(filename + ".tmp") is False
+
+def test_compact_maximal_size(tmp_path, monkeypatch):
+	""" The older records beyond the maximal size are dropped """
+	root = str(tmp_path)
+	fill_index(root, ["2026/10/01/10h00"], 5)
+	monkeypatch.setattr(motion.historicindex, "MAX_RECORDS", 2)
+	uasyncio.run(HistoricIndex.compact(root, RwLock()))
+	assert get_names(root) == ["2026/10/01/10h00/03.jpg", "2026/10/01/10h00/04.jpg"]
+
+def test_compact_append(tmp_path):
+	""" The records appended while the compaction waits the lock exclusive are kept """
+	root = str(tmp_path)
+	fill_index(root, ["2026/10/01/10h00", "2026/10/02/10h00"], 2)
+	shutil.rmtree(root + "/2026/10/01")
+	async def main():
+		lock = RwLock()
+		await lock.acquire_read()
+		task = uasyncio.create_task(HistoricIndex.compact(root, lock))
+		# The compaction copies the records with the lock shared, then waits the lock exclusive
+		while lock.writers_waiting == 0:
+			await uasyncio.sleep_ms(1)
+		HistoricIndex.append(root, create_item(root + "/2026/10/02/10h00", "new.jpg"))
+		lock.release_read()
+		await task
+	uasyncio.run(main())
+	assert get_names(root) == ["2026/10/02/10h00/00.jpg", "2026/10/02/10h00/01.jpg", "2026/10/02/10h00/new.jpg"]
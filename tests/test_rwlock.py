@@ -0,0 +1,76 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the reader/writer lock """
+import uasyncio
+from tools.rwlock import RwLock
+
+def test_readers_shared():
+	""" Several readers hold the lock together """
+	async def main():
+		lock = RwLock()
+		await lock.acquire_read()
+		await uasyncio.wait_for_ms(lock.acquire_read(), 100)
+		assert lock.readers == 2
+		assert lock.locked()
+		lock.release_read()
+		lock.release_read()
+		assert lock.locked() is False
+	uasyncio.run(main())
+
+def test_writer_exclusive():
+	""" The writer waits the readers, and the readers wait the writer """
+	async def main():
+		lock = RwLock()
+		events = []
+		async def writer():
+			await lock.acquire()
+			events.append("write")
+			await uasyncio.sleep_ms(20)
+			events.append("end write")
+			lock.release()
+		async def reader():
+			await lock.acquire_read()
+			events.append("read")
+			lock.release_read()
+
+		await lock.acquire_read()
+		task = uasyncio.create_task(writer())
+		await uasyncio.sleep_ms(10)
+		assert events == []
+		lock.release_read()
+		await uasyncio.sleep_ms(5)
+		await reader()
+		await task
+		assert events == ["write", "end write", "read"]
+	uasyncio.run(main())
+
+def test_writer_priority():
+	""" A writer waiting has priority over the new readers """
+	async def main():
+		lock = RwLock()
+		events = []
+		async def writer():
+			await lock.acquire()
+			events.append("write")
+			lock.release()
+		async def reader():
+			await lock.acquire_read()
+			events.append("read")
+			lock.release_read()
+
+		await lock.acquire_read()
+		writing = uasyncio.create_task(writer())
+		await uasyncio.sleep_ms(5)
+		reading = uasyncio.create_task(reader())
+		await uasyncio.sleep_ms(5)
+		# The new reader is blocked by the writer waiting
+		assert events == []
+		assert lock.get_counters()["writers_waiting"] == 1
+		lock.release_read()
+		await writing
+		await reading
+		assert events == ["write", "read"]
+		counters = lock.get_counters()
+		assert counters["read"] == 2
+		assert counters["write"] == 1
+	uasyncio.run(main())
@@ -0,0 +1,65 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the write behind queue of motion images """
+import pytest
+import uasyncio
+from motion.savequeue import SaveQueue
+from motion.historic import Historic
+
+@pytest.fixture(autouse=True)
+def save_queue(monkeypatch):
+	""" Empty queue with a capacity of two images, the images written are recorded instead of saved on sd card """
+	written = []
+	async def add_motion(path, name, image, motion_info, thumbnail=None):
+		written.append(name)
+		return True
+	monkeypatch.setattr(Historic, "add_motion", add_motion)
+	monkeypatch.setattr(Historic, "create_thumbnail", lambda image: None)
+	monkeypatch.setattr(SaveQueue, "queue", [])
+	monkeypatch.setattr(SaveQueue, "writer", [None])
+	monkeypatch.setattr(SaveQueue, "capacity", [2])
+	monkeypatch.setattr(SaveQueue, "counters", dict.fromkeys(SaveQueue.counters, 0))
+	monkeypatch.setattr(SaveQueue, "event", None)
+	return written
+
+def get_names():
+	""" Get the names of images waiting in the queue """
+	return [item[1] for item in SaveQueue.queue]
+
+def test_drop_older_without_detection(save_queue):
+	""" When the queue is full, the older image without motion detected is dropped """
+	async def main():
+		assert await SaveQueue.put("path", "a", b"", {}, detected=True)
+		assert await SaveQueue.put("path", "b", b"", {}, detected=False)
+		assert await SaveQueue.put("path", "c", b"", {}, detected=True)
+		assert get_names() == ["a", "c"]
+		assert SaveQueue.get_counters()["dropped"] == 1
+		await SaveQueue.flush()
+	uasyncio.run(main())
+	assert save_queue == ["a", "c"]
+
+def test_image_without_detection_dropped(save_queue):
+	""" When all images waiting have a motion detected, the new image without detection is dropped """
+	async def main():
+		await SaveQueue.put("path", "a", b"", {}, detected=True)
+		await SaveQueue.put("path", "b", b"", {}, detected=True)
+		assert await SaveQueue.put("path", "c", b"", {}, detected=False) is False
+		assert get_names() == ["a", "b"]
+		await SaveQueue.flush()
+	uasyncio.run(main())
+	assert save_queue == ["a", "b"]
+	assert SaveQueue.get_counters()["dropped"] == 1
+
+def test_detection_never_dropped(save_queue):
+	""" When all images waiting have a motion detected, the producer waits the writer """
+	async def main():
+		await SaveQueue.put("path", "a", b"", {}, detected=True)
+		await SaveQueue.put("path", "b", b"", {}, detected=True)
+		assert await SaveQueue.put("path", "c", b"", {}, detected=True)
+		await SaveQueue.flush()
+	uasyncio.run(main())
+	assert save_queue == ["a", "b", "c"]
+	counters = SaveQueue.get_counters()
+	assert counters["dropped"] == 0
+	assert counters["written"] == 3
+	assert counters["max_depth"] == 2
@@ -0,0 +1,42 @@
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Tests of the accounting of the space used by the motions """
+import pytest
+from motion.storagequota import StorageQuota
+
+@pytest.fixture(autouse=True)
+def days(monkeypatch):
+	""" Quota of three days """
+	monkeypatch.setattr(StorageQuota, "days", {})
+	monkeypatch.setattr(StorageQuota, "modified", [False])
+	StorageQuota.add("/2026/10/03/10h00", 300, 3)
+	StorageQuota.add("2026/10/01/10h00", 100, 1)
+	StorageQuota.add("2026/10/02/10h00", 200, 2)
+	StorageQuota.add("2026/10/01/11h00", 50)
+	return StorageQuota.days
+
+def test_add(days):
+	""" The sizes are added per day """
+	assert days == {"2026/10/01":[150, 2], "2026/10/02":[200, 2], "2026/10/03":[300, 3]}
+	assert StorageQuota.get_total() == (650, 7)
+	assert StorageQuota.modified[0]
+
+def test_select_older():
+	""" The older days are selected until the bytes needed are freed """
+	assert StorageQuota.select(100) == ["2026/10/01"]
+	assert StorageQuota.select(150) == ["2026/10/01"]
+	assert StorageQuota.select(151) == ["2026/10/01", "2026/10/02"]
+
+def test_select_nothing_needed():
+	""" At least one day is selected, the cleanup is requested because the space is low """
+	assert StorageQuota.select(0) == ["2026/10/01"]
+	assert StorageQuota.select(-100) == ["2026/10/01"]
+
+def test_select_never_the_more_recent():
+	""" The more recent day is never selected, even if the bytes needed are not freed """
+	assert StorageQuota.select(10000) == ["2026/10/01", "2026/10/02"]
+
+def test_select_single_day(monkeypatch):
+	""" With a single day nothing is selected """
+	monkeypatch.setattr(StorageQuota, "days", {"2026/10/03":[300, 3]})
+	assert StorageQuota.select(1000) == []
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# Distributed under MIT License
+# Copyright (c) 2021 Remi BERTHOLET
+""" Replay recorded jpeg frames through the motion detection with the simulated camera,
+and measure the speed, the latency of each stage, the detection precision and the memory used.
+The results are written in json to be compared between versions. """
+# pylint:disable=consider-using-f-string
+# pylint:disable=wrong-import-position
+# pylint:disable=import-error
+# pylint:disable=unspecified-encoding
+import sys
+import os
+import os.path
+import time
+import json
+import glob
+import argparse
+import asyncio
+import tempfile
+import tracemalloc
+
+MODULES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "modules"))
+sys.path.insert(0, os.path.join(MODULES_DIR, "simul"))
+sys.path.insert(0, os.path.join(MODULES_DIR, "lib"))
+
+STAGES = ["capture", "compare", "detect", "save"]
+
+class StageTimer:
+	""" Accumulate the durations of a stage """
+	def __init__(self):
+		""" Constructor """
+		self.durations = []
+		self.nested = 0.
+
+	def add(self, duration):
+		""" Add a duration in seconds """
+		self.durations.append(duration)
+
+	def get_result(self):
+		""" Return the statistics of stage in milliseconds """
+		durations = sorted(self.durations)
+		count = len(durations)
+		if count == 0:
+			return {"count":0, "total_ms":0., "mean_ms":0., "median_ms":0., "p95_ms":0., "max_ms":0.}
+		return {
+			"count"    : count,
+			"total_ms" : sum(durations)*1000.,
+			"mean_ms"  : sum(durations)*1000./count,
+			"median_ms": durations[count//2]*1000.,
+			"p95_ms"   : durations[min(count-1, (count*95)//100)]*1000.,
+			"max_ms"   : durations[-1]*1000.
+		}
+
+def load_labels(filename):
+	""" Load the ground truth : the set of frames names with a motion.
+	The file can be a json list of names, a json dictionary name:boolean,
+	or a text file with one name per line optionally followed by ,0 or ,1 """
+	labels = set()
+	if filename.lower().endswith(".json"):
+		with open(filename) as file:
+			content = json.load(file)
+		if type(content) == type({}):
+			for name, motion in content.items():
+				if motion:
+					labels.add(os.path.basename(name))
+		else:
+			for name in content:
+				labels.add(os.path.basename(name))
+	else:
+		with open(filename) as file:
+			for line in file:
+				line = line.strip()
+				if line == "" or line[0] == "#":
+					continue
+				spl = line.split(",")
+				if len(spl) == 1 or spl[1].strip() not in ["0", "false", "False"]:
+					labels.add(os.path.basename(spl[0].strip()))
+	return labels
+
+def get_detection_result(frames, detected, labels):
+	""" Compute the precision and recall against the ground truth """
+	names = set(os.path.basename(frame) for frame in frames)
+	true_positive  = len(detected & labels)
+	false_positive = len(detected - labels)
+	false_negative = len((labels & names) - detected)
+	true_negative  = len(names - detected - labels)
+	result = {
+		"true_positive" : true_positive,
+		"false_positive": false_positive,
+		"false_negative": false_negative,
+		"true_negative" : true_negative,
+		"precision"     : None,
+		"recall"        : None
+	}
+	if true_positive + false_positive > 0:
+		result["precision"] = true_positive / (true_positive + false_positive)
+	if true_positive + false_negative > 0:
+		result["recall"] = true_positive / (true_positive + false_negative)
+	return result
+
+def configure_motion(config, settings):
+	""" Change the motion configuration with the list of name=value """
+	for setting in settings:
+		name, value = setting.split("=", 1)
+		if not hasattr(config, name):
+			raise ValueError("Unknown motion configuration '%s'"%name)
+		current = getattr(config, name)
+		if type(current) == type(True):
+			value = value.lower() in ["1", "true", "yes", "on"]
+		elif type(current) == type(0):
+			value = int(value)
+		elif type(current) == type(b""):
+			value = value.encode("utf8")
+		setattr(config, name, value)
+
+async def replay(frames, settings, loops, heap):
+	""" Replay the frames in the motion detection """
+	# pylint:disable=too-many-locals
+	import camera
+	from motion.motion import Motion, MotionConfig, ImageMotion
+	from motion.savequeue import SaveQueue
+	from motion.historic import Historic
+	from video import Camera
+	from tools import builddate, strings
+
+	timers = {}
+	for stage in STAGES:
+		timers[stage] = StageTimer()
+
+	config = MotionConfig()
+	config.activated = True
+	configure_motion(config, settings)
+
+	camera.set_frames(frames)
+	Camera.open()
+	motion = Motion(config)
+	motion.resume()
+
+	# Measure the compare and the save called inside the detect and the capture
+	compare = motion.compare
+	def timed_compare(display=True):
+		start = time.perf_counter()
+		try:
+			return compare(display)
+		finally:
+			duration = time.perf_counter() - start
+			timers["compare"].add(duration)
+			timers["compare"].nested += duration
+	motion.compare = timed_compare
+
+	save = ImageMotion.save
+	async def timed_save(self):
+		start = time.perf_counter()
+		try:
+			return await save(self)
+		finally:
+			duration = time.perf_counter() - start
+			timers["save"].add(duration)
+			timers["save"].nested += duration
+	ImageMotion.save = timed_save
+
+	frame_of_index = {}
+	detected = set()
+	count = 0
+	if heap:
+		tracemalloc.start()
+	start = time.perf_counter()
+	for loop in range(loops):
+		for frame in frames:
+			# Capture
+			timers["save"].nested = 0.
+			begin = time.perf_counter()
+			detection = await motion.capture()
+			timers["capture"].add(time.perf_counter() - begin - timers["save"].nested)
+			frame_of_index[motion.images[0].index] = os.path.basename(frame)
+			if detection is not None:
+				motion.deinit_image(detection[1])
+
+			# Detect
+			timers["compare"].nested = 0.
+			begin = time.perf_counter()
+			motion.detect(False)
+			timers["detect"].add(time.perf_counter() - begin - timers["compare"].nested)
+
+			for image in motion.images:
+				if image.get_motion_detected():
+					detected.add(frame_of_index[image.index])
+			count += 1
+	duration = time.perf_counter() - start
+	await SaveQueue.flush()
+	motion.clip.stop()
+	await motion.clip.flush()
+	peak = None
+	if heap:
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	motion.cleanup()
+	ImageMotion.save = save
+
+	result = {
+		"version"  : strings.tostrings(builddate.date),
+		"frames"   : count,
+		"duration" : duration,
+		"fps"      : count / duration if duration > 0 else 0.,
+		"stages"   : {},
+		"peak_heap": peak,
+		"save_queue": SaveQueue.get_counters(),
+		"historic_lock": Historic.get_lock_counters(),
+		"camera": Camera.get_counters(),
+		"config"   : json.loads(config.to_string())
+	}
+	for stage in STAGES:
+		result["stages"][stage] = timers[stage].get_result()
+	return result, detected
+
+def motionbench(directory, labels_filename=None, output=None, settings=None, loops=1, heap=False):
+	""" Replay all jpeg of the directory and return the results """
+	frames = sorted(glob.glob(os.path.join(os.path.abspath(directory), "*.jpg")))
+	if len(frames) == 0:
+		raise ValueError("No jpeg found in '%s'"%directory)
+	if labels_filename is not None:
+		labels_filename = os.path.abspath(labels_filename)
+	if output is not None:
+		output = os.path.abspath(output)
+
+	# Work in a temporary directory to not pollute the configurations and the sd card
+	current_dir = os.getcwd()
+	with tempfile.TemporaryDirectory() as working_dir:
+		os.chdir(working_dir)
+		try:
+			os.mkdir("sd")
+			result, detected = asyncio.run(replay(frames, settings or [], loops, heap))
+		finally:
+			os.chdir(current_dir)
+
+	result["directory"] = os.path.abspath(directory)
+	result["detected"]  = sorted(detected)
+	if labels_filename is not None:
+		result["detection"] = get_detection_result(frames, detected, load_labels(labels_filename))
+
+	if output is not None:
+		with open(output, "w") as file:
+			json.dump(result, file, indent=1)
+	return result
+
+def show(result):
+	""" Display the summary of results """
+	print("\nFrames    : %d in %.2f s (%.1f frames/s)"%(result["frames"], result["duration"], result["fps"]))
+	for stage in STAGES:
+		stat = result["stages"][stage]
+		print("%-10s: count %5d  mean %8.3f ms  p95 %8.3f ms  max %8.3f ms"%(stage, stat["count"], stat["mean_ms"], stat["p95_ms"], stat["max_ms"]))
+	queue = result["save_queue"]
+	print("Save queue: written %d  failed %d  dropped %d  max depth %d  write mean %d ms  max %d ms"%(queue["written"], queue["failed"], queue["dropped"], queue["max_depth"], queue["write_mean_ms"], queue["write_max_ms"]))
+	lock = result["historic_lock"]
+	print("Lock      : read %d  wait max %d ms  write %d  wait max %d ms"%(lock["read"], lock["read_max_ms"], lock["write"], lock["write_max_ms"]))
+	cam = result["camera"]
+	print("Camera    : success %d  failed %d  retried %d  lost %d  breaker opened %d  reinit failed %d"%(cam["success"], cam["failed"], cam["retried"], cam["lost"], cam["breaker_opened"], cam["reinit_failed"]))
+	if result["peak_heap"] is not None:
+		print("Peak heap : %d bytes"%result["peak_heap"])
+	detection = result.get("detection")
+	if detection is not None:
+		precision = "%.3f"%detection["precision"] if detection["precision"] is not None else "-"
+		recall    = "%.3f"%detection["recall"]    if detection["recall"]    is not None else "-"
+		print("Detection : precision %s recall %s (tp=%d fp=%d fn=%d tn=%d)"%(precision, recall,
+			detection["true_positive"], detection["false_positive"], detection["false_negative"], detection["true_negative"]))
+
+def main():
+	""" Command line """
+	parser = argparse.ArgumentParser(description="Replay recorded jpeg frames through the motion detection and measure it")
+	parser.add_argument("directory",                                help="directory with the jpeg frames, replayed in alphabetic order")
+	parser.add_argument("-l", "--labels",                           help="ground truth file with the names of frames with motion (.json or text)")
+	parser.add_argument("-o", "--output",                           help="json file with the results")
+	parser.add_argument("-s", "--set",     action="append",         help="change motion configuration, example : -s sensitivity=60", default=[])
+	parser.add_argument("-n", "--loops",   type=int, default=1,     help="number of replay of frames")
+	parser.add_argument("--heap",          action="store_true",     help="trace the peak of python heap (the latencies are much slower)")
+	args = parser.parse_args()
+	result = motionbench(args.directory, args.labels, args.output, args.set, args.loops, args.heap)
+	show(result)
+
+if __name__ == "__main__":
+	main()